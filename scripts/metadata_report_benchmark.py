@@ -0,0 +1,180 @@
+"""Compare /metadata/ row building with make_*_cell against the compiled column cells.
+
+Embeds the experiments of the test inserts (links resolved by uuid, accession, name
+or alias, --depth levels deep), with their files and replicates, and builds every
+metadata.tsv cell of every file row both ways, --repeat times over. Columns whose
+links the inserts alone can't resolve (calculated names) are left out of both.
+
+    bin/python scripts/metadata_report_benchmark.py
+    bin/python scripts/metadata_report_benchmark.py --repeat 200
+"""
+import argparse
+import json
+import os
+import time
+from urllib.parse import unquote
+
+from encoded.reports.constants import METADATA_COLUMN_TO_FIELDS_MAPPING
+from encoded.reports.metadata import (
+    compile_experiment_cell,
+    compile_file_cell,
+    make_experiment_cell,
+    make_file_cell,
+)
+
+INSERTS = os.path.join(os.path.dirname(__file__), '..', 'src', 'encoded', 'tests', 'data', 'inserts')
+KEY_PROPERTIES = ['uuid', 'accession', 'name', 'email', 'aliases']
+# Links the experiment search results leave as @id paths
+UNEMBEDDED = {'dataset', 'derived_from', 'controlled_by', 'supersedes', 'possible_controls', 'experiment'}
+
+
+def item_keys(item_type, item):
+    for key in KEY_PROPERTIES:
+        values = item.get(key, [])
+        for value in values if isinstance(values, list) else [values]:
+            yield value
+    if item_type == 'biosample_type':
+        yield '{}_{}'.format(item['classification'].replace(' ', '_'), item['term_id'].replace(':', '_'))
+    elif item_type == 'platform':
+        yield item['term_id']
+
+
+def link_key(value):
+    # /platforms/OBI%3A0002001/ -> OBI:0002001
+    if value.startswith('/') and value.count('/') >= 2:
+        value = value.strip('/').split('/')[-1]
+    return unquote(value)
+
+
+def load_inserts(inserts):
+    objects = {}
+    items = {}
+    for filename in sorted(os.listdir(inserts)):
+        if not filename.endswith('.json'):
+            continue
+        item_type = filename[:-len('.json')]
+        with open(os.path.join(inserts, filename)) as insert:
+            items[item_type] = json.load(insert)
+        for item in items[item_type]:
+            for key in item_keys(item_type, item):
+                objects[key] = item
+    return objects, items
+
+
+def embed(value, objects, depth):
+    if isinstance(value, list):
+        return [embed(v, objects, depth) for v in value]
+    if isinstance(value, dict):
+        return {k: v if k in UNEMBEDDED else embed(v, objects, depth) for k, v in value.items()}
+    if depth and isinstance(value, str) and link_key(value) in objects:
+        return embed(objects[link_key(value)], objects, depth - 1)
+    return value
+
+
+def embedded_experiments(objects, items, depth):
+    files = {}
+    replicates = {}
+    for file_ in items.get('file', []):
+        files.setdefault(file_.get('dataset'), []).append(file_)
+    for replicate in items.get('replicate', []):
+        replicates.setdefault(replicate.get('experiment'), []).append(replicate)
+    experiments = []
+    for experiment in items['experiment']:
+        experiment = dict(experiment)
+        keys = [experiment['uuid'], experiment['accession']]
+        experiment['files'] = [f for key in keys for f in files.get(key, [])]
+        experiment['replicates'] = [r for key in keys for r in replicates.get(key, [])]
+        experiments.append(embed(experiment, objects, depth))
+    return [experiment for experiment in experiments if experiment['files']]
+
+
+def split_mapping(mapping):
+    experiment_mapping = {}
+    file_mapping = {}
+    for column, fields in mapping.items():
+        if fields[0].startswith('files'):
+            file_mapping[column] = [field.replace('files.', '') for field in fields]
+        else:
+            experiment_mapping[column] = fields
+    return experiment_mapping, file_mapping
+
+
+def usable_mapping(mapping, items, make_cell):
+    usable = {}
+    for column, fields in mapping.items():
+        try:
+            for item in items:
+                make_cell(fields, item)
+        except AttributeError:
+            continue
+        usable[column] = fields
+    return usable
+
+
+def make_cells_rows(experiments, experiment_mapping, file_mapping):
+    rows = 0
+    for experiment in experiments:
+        experiment_data = {
+            column: make_experiment_cell(fields, experiment)
+            for column, fields in experiment_mapping.items()
+        }
+        for file_ in experiment['files']:
+            file_data = {
+                column: make_file_cell(fields, file_)
+                for column, fields in file_mapping.items()
+            }
+            file_data.update(experiment_data)
+            rows += 1
+    return rows
+
+
+def compiled_cells_rows(experiments, experiment_mapping, file_mapping):
+    experiment_cells = {column: compile_experiment_cell(fields) for column, fields in experiment_mapping.items()}
+    file_cells = {column: compile_file_cell(fields) for column, fields in file_mapping.items()}
+    rows = 0
+    for experiment in experiments:
+        experiment_data = {
+            column: cell(experiment)
+            for column, cell in experiment_cells.items()
+        }
+        for file_ in experiment['files']:
+            file_data = {
+                column: cell(file_)
+                for column, cell in file_cells.items()
+            }
+            file_data.update(experiment_data)
+            rows += 1
+    return rows
+
+
+def measure(build_rows, experiments, experiment_mapping, file_mapping, repeat):
+    begin = time.time()
+    rows = 0
+    for _ in range(repeat):
+        rows += build_rows(experiments, experiment_mapping, file_mapping)
+    return rows, time.time() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inserts', default=INSERTS, help='Directory of insert json files')
+    parser.add_argument('--depth', type=int, default=4, help='Levels of links to embed')
+    parser.add_argument('--repeat', type=int, default=50, help='Passes over the experiments')
+    args = parser.parse_args()
+
+    objects, items = load_inserts(args.inserts)
+    experiments = embedded_experiments(objects, items, args.depth)
+    experiment_mapping, file_mapping = split_mapping(METADATA_COLUMN_TO_FIELDS_MAPPING)
+    columns = len(experiment_mapping) + len(file_mapping)
+    experiment_mapping = usable_mapping(experiment_mapping, experiments, make_experiment_cell)
+    file_mapping = usable_mapping(file_mapping, [f for e in experiments for f in e['files']], make_file_cell)
+    print('%d experiments, %d files, %d of %d columns' % (
+        len(experiments), sum(len(e['files']) for e in experiments),
+        len(experiment_mapping) + len(file_mapping), columns))
+    for (label, build_rows) in [('make_cell', make_cells_rows), ('compiled', compiled_cells_rows)]:
+        rows, took = measure(build_rows, experiments, experiment_mapping, file_mapping, args.repeat)
+        print('    %-10s %8d rows %10.0f rows/sec' % (label, rows, rows / took))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Compare the slim closures of generate-ontology with the list based traversal they replaced.
+
+Builds a synthetic ontology DAG of --terms terms, each with up to --parents parents among the
+terms before it and a --slims fraction of them slim terms, then times both ways of computing
+every term's slims and checks that they agree.
+
+    bin/python scripts/ontology_closure_benchmark.py --terms 20000
+"""
+import argparse
+import random
+import time
+
+from encoded.commands.generate_ontology import (
+    getClosures,
+    getSlimBits,
+    getSlimIndex,
+    getSlims,
+    slim_types,
+)
+from encoded.commands.manual_slims import slim_shims
+
+
+def synthetic_terms(count, parents, slims, seed=0):
+    rand = random.Random(seed)
+    slim_ids = list(getSlimIndex())
+    ids = []
+    for i in range(count):
+        if slim_ids and rand.random() < slims:
+            ids.append(slim_ids.pop())
+        else:
+            ids.append('SYN:%07d' % i)
+    terms = {}
+    for i, term in enumerate(ids):
+        data = list({ids[rand.randrange(i)] for _ in range(rand.randint(1, parents))}) if i else []
+        develops_from = [ids[rand.randrange(i)]] if i and rand.random() < 0.1 else []
+        terms[term] = {
+            'data': data,
+            'data_with_develops_from': list(set(data) | set(develops_from)),
+        }
+    return terms
+
+
+def iterative_children(nodes, terms, closure):
+    results = []
+    while 1:
+        new_nodes = []
+        if len(nodes) == 0:
+            break
+        for node in nodes:
+            results.append(node)
+            if terms[node][closure]:
+                for child in terms[node][closure]:
+                    if child not in results:
+                        new_nodes.append(child)
+        nodes = list(set(new_nodes))
+    return list(set(results))
+
+
+def list_slims(terms):
+    slims = {}
+    for term in terms:
+        closure = iterative_children(terms[term]['data'], terms, 'data') + [term]
+        closure_with_develops_from = iterative_children(
+            terms[term]['data_with_develops_from'], terms, 'data_with_develops_from') + [term]
+        for slim_type, slim_terms in slim_types.items():
+            if slim_type == 'developmental':
+                found = closure_with_develops_from
+            else:
+                found = closure
+            slims[(term, slim_type)] = [slim_terms[slim_term] for slim_term in slim_terms if slim_term in found]
+            shim = slim_shims.get(slim_type, {}).get(term, '')
+            if shim:
+                slims[(term, slim_type)] = list(shim)
+    return slims
+
+
+def bitset_slims(terms):
+    slim_index = getSlimIndex()
+    slim_bits = getSlimBits(slim_index)
+    closures = getClosures(terms, 'data', slim_index)
+    closures_with_develops_from = getClosures(terms, 'data_with_develops_from', slim_index)
+    for term in terms:
+        terms[term]['closure'] = closures[term]
+        terms[term]['closure_with_develops_from'] = closures_with_develops_from[term]
+    slims = {}
+    for term in terms:
+        for slim_type in slim_types:
+            slims[(term, slim_type)] = getSlims(term, terms, slim_type, slim_bits)
+    return slims
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--terms', type=int, default=5000, help='Synthetic ontology terms')
+    parser.add_argument('--parents', type=int, default=3, help='Most parents of a term')
+    parser.add_argument('--slims', type=float, default=0.05, help='Fraction of terms that are slim terms')
+    parser.add_argument('--skip-list', action='store_true', help='Only time the bitset closures')
+    args = parser.parse_args()
+
+    terms = synthetic_terms(args.terms, args.parents, args.slims)
+    edges = sum(len(term['data_with_develops_from']) for term in terms.values())
+    print('%d terms, %d edges' % (len(terms), edges))
+
+    begin = time.time()
+    slims = bitset_slims(terms)
+    print('bitset closures: %7.2fs' % (time.time() - begin))
+    if args.skip_list:
+        return
+    begin = time.time()
+    expected = list_slims(terms)
+    print('list closures:   %7.2fs' % (time.time() - begin))
+    assert slims == expected
+    print('slims match')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Compare peak memory, rows/sec and bulk request sizes of indexing a bed file into regions es.
+
+Runs the old path (whole file in memory, csv, a list of dicts per chrom, bulk of 500 docs)
+against RegionIndexer.add_to_regions_es fed by the streaming bed_regions parser, the way
+add_encoded_file_to_regions_es does, over ENCFF002COS (the region indexer test fixture) and
+over a synthetic bed of --rows rows.
+
+Without --es the bulk requests are serialized and counted but not sent anywhere. With --es
+they go to that elasticsearch, in benchmark_ prefixed chrom indices removed afterwards.
+
+    bin/python scripts/region_bed_benchmark.py
+    bin/python scripts/region_bed_benchmark.py --fixture ENCFF002COS.bed.gz --rows 5000000 --es http://localhost:9200
+"""
+import argparse
+import csv
+import gzip
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import certifi
+import urllib3
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+from elasticsearch.serializer import JSONSerializer
+
+from encoded.region_indexer import (
+    REGIONS_FLUSH_SIZE,
+    RESIDENT_REGIONSET_KEY,
+    RegionIndexer,
+    bed_positions,
+    bed_regions,
+    region_docs,
+)
+
+FIXTURE_URL = 'https://www.encodeproject.org/files/ENCFF002COS/@@download/ENCFF002COS.bed.gz'
+CHROMS = ['chr%s' % chrom for chrom in list(range(1, 23)) + ['X', 'Y']]
+ASSEMBLY = 'GRCh38'
+FILE_UUID = '00000000-0000-0000-0000-00000000bed0'
+
+
+class NullIndices(object):
+    def exists(self, *args, **kwargs):
+        return True
+
+    def exists_type(self, *args, **kwargs):
+        return True
+
+
+class NullES(object):
+    '''Stands in for regions es without --es, every request succeeds.'''
+
+    class Transport(object):
+        serializer = JSONSerializer()
+
+    def __init__(self):
+        self.transport = self.Transport()
+        self.indices = NullIndices()
+
+    def bulk(self, body, **kwargs):
+        return {'items': [{'index': {'status': 201}} for _ in range(body.count('\n') // 2)]}
+
+    def index(self, *args, **kwargs):
+        pass
+
+    def delete(self, *args, **kwargs):
+        pass
+
+
+def count_requests(es):
+    '''Wraps es.bulk to record the number and largest size of bulk requests.'''
+    stats = {'requests': 0, 'largest': 0}
+    send = es.bulk
+
+    def counted_bulk(body, **kwargs):
+        stats['requests'] += 1
+        stats['largest'] = max(stats['largest'], len(body))
+        return send(body, **kwargs)
+    es.bulk = counted_bulk
+    return stats
+
+
+def benchmark_indexer(es, flush_size):
+    indexer = RegionIndexer.__new__(RegionIndexer)
+    indexer.regions_es = es
+    indexer.residents_index = RESIDENT_REGIONSET_KEY
+    indexer.known_indices = set()
+    indexer.known_indices_lock = threading.Lock()
+    indexer.flush_size = flush_size
+    indexer.layout = 'nested'
+    indexer.peak_store = None
+    return indexer
+
+
+def benchmark_regions(regions, counter):
+    '''Keeps benchmark docs out of the real chrom indices and counts rows.'''
+    for (chrom, positions) in regions:
+        counter['rows'] += len(positions)
+        yield ('benchmark_' + chrom, positions)
+
+
+def legacy_add(indexer, path, counter):
+    '''The parse and bulk add_encoded_file_to_regions_es did before streaming.'''
+    file_in_mem = io.BytesIO()
+    with open(path, 'rb') as raw:
+        file_in_mem.write(raw.read())
+    file_in_mem.seek(0)
+    file_data = {}
+    with gzip.open(file_in_mem, mode='rt') as file:
+        for row in csv.reader(file, delimiter='\t'):
+            chrom, start, end = row[0].lower(), int(row[1]), int(row[2])
+            if chrom in file_data:
+                file_data[chrom].append({'start': start + 1, 'end': end + 1})
+            else:
+                file_data[chrom] = [{'start': start + 1, 'end': end + 1}]
+    actions = []
+    for (chrom, positions) in benchmark_regions(file_data.items(), counter):
+        indexer.ensure_index(chrom, ASSEMBLY, {})
+        actions.extend(region_docs(FILE_UUID, ASSEMBLY, chrom, 0, positions))
+    bulk(indexer.regions_es, actions, chunk_size=500)
+
+
+def streaming_add(indexer, path, counter):
+    '''add_encoded_file_to_regions_es once the body is fetched.'''
+    with io.TextIOWrapper(gzip.GzipFile(path, mode='rb')) as file:
+        regions = bed_positions(bed_regions(file, indexer.flush_size))
+        if not indexer.add_to_regions_es(FILE_UUID, ASSEMBLY, 'DNase-seq', benchmark_regions(regions, counter)):
+            raise RuntimeError('add_to_regions_es failed')
+
+
+def synthetic_bed(path, rows):
+    '''Writes an unsorted narrowPeak-like gzipped bed, the way IDR thresholded peaks come.'''
+    rand = random.Random(0)
+    with gzip.open(path, mode='wt') as bed:
+        for i in range(rows):
+            start = rand.randint(0, 200000000)
+            bed.write('%s\t%d\t%d\tpeak%d\t1000\t.\t%.2f\t-1\t%.2f\t%d\n' % (
+                rand.choice(CHROMS), start, start + rand.randint(150, 2000), i,
+                rand.random() * 100, rand.random() * 10, rand.randint(0, 150)))
+
+
+def fetch_fixture(path):
+    http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+    r = http.request('GET', FIXTURE_URL)
+    if r.status != 200:
+        raise RuntimeError('Could not download %s: %d' % (FIXTURE_URL, r.status))
+    with open(path, 'wb') as out:
+        out.write(r.data)
+
+
+def measure(add, path, args):
+    es = Elasticsearch([args.es], timeout=120) if args.es else NullES()
+    stats = count_requests(es)
+    indexer = benchmark_indexer(es, args.flush_size)
+    counter = {'rows': 0}
+    tracemalloc.start()
+    begin = time.time()
+    add(indexer, path, counter)
+    took = time.time() - begin
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if args.es:
+        for chrom in {index for (index, doc_type) in indexer.known_indices if index.startswith('benchmark_')}:
+            es.indices.delete(index=chrom)
+        es.delete(index=RESIDENT_REGIONSET_KEY, doc_type='default', id=FILE_UUID, ignore=404)
+    return counter['rows'], took, peak, stats
+
+
+def report(name, path, args):
+    print('%s (%.1f MB gzipped)' % (name, os.path.getsize(path) / 1e6))
+    for (label, add) in [('legacy', legacy_add), ('streaming', streaming_add)]:
+        rows, took, peak, stats = measure(add, path, args)
+        print('    %-10s %10d rows %12.0f rows/sec %10.1f MB peak %6d requests %8.1f MB largest' % (
+            label, rows, rows / took, peak / 1e6, stats['requests'], stats['largest'] / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', help='Local copy of ENCFF002COS.bed.gz (downloaded if not given)')
+    parser.add_argument('--rows', type=int, default=5000000, help='Rows in the synthetic bed')
+    parser.add_argument('--flush-size', type=int, default=REGIONS_FLUSH_SIZE, help='Positions per chrom doc')
+    parser.add_argument('--es', help='Elasticsearch to index into, requests are only serialized if not given')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = args.fixture
+        if fixture is None:
+            fixture = os.path.join(tmp, 'ENCFF002COS.bed.gz')
+            fetch_fixture(fixture)
+        report('ENCFF002COS', fixture, args)
+
+        synthetic = os.path.join(tmp, 'synthetic.bed.gz')
+        synthetic_bed(synthetic, args.rows)
+        report('synthetic %d rows' % args.rows, synthetic, args)
+
+
+if __name__ == '__main__':
+    main()
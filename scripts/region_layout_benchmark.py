@@ -0,0 +1,101 @@
+"""Compare region search query latency of the nested and binned regions layouts.
+
+Loads --files synthetic peak files of --peaks peaks each on chr1 into a local elasticsearch,
+once per layout, then times --queries random single-base (rsID style) and --width wide
+overlap queries with the same query builders /region-search/ uses.
+
+    bin/python scripts/region_layout_benchmark.py --es http://localhost:9200 --files 200
+"""
+import argparse
+import random
+import time
+import uuid
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+
+from encoded.region_indexer import (
+    REGIONS_LAYOUTS,
+    get_mapping,
+    index_settings,
+    region_docs,
+    region_index,
+)
+from encoded.region_search import (
+    get_binned_peak_query,
+    get_peak_query,
+)
+
+ASSEMBLY = 'GRCh38'
+CHROM = 'benchmark_chr1'
+CHROM_SIZE = 248956422
+
+
+def synthetic_files(files, peaks, seed=0):
+    rand = random.Random(seed)
+    for _ in range(files):
+        positions = []
+        for _ in range(peaks):
+            start = rand.randint(1, CHROM_SIZE - 2000)
+            positions.append({'start': start, 'end': start + rand.randint(150, 2000)})
+        yield (str(uuid.UUID(int=rand.getrandbits(128))), positions)
+
+
+def load(es, layout, args):
+    index = region_index(CHROM, layout)
+    if es.indices.exists(index):
+        es.indices.delete(index=index)
+    es.indices.create(index=index, body=index_settings())
+    es.indices.put_mapping(index=index, doc_type=ASSEMBLY, body=get_mapping(ASSEMBLY, layout))
+    begin = time.time()
+    for (file_uuid, positions) in synthetic_files(args.files, args.peaks):
+        for chunk, start in enumerate(range(0, len(positions), args.flush_size)):
+            bulk(es, region_docs(file_uuid, ASSEMBLY, CHROM, chunk, positions[start:start + args.flush_size], layout))
+    es.indices.refresh(index=index)
+    return time.time() - begin
+
+
+def query(es, layout, start, end):
+    if layout == 'binned':
+        body = get_binned_peak_query(start, end)
+    else:
+        body = get_peak_query(start, end)
+    begin = time.time()
+    es.search(body=body, index=region_index(CHROM, layout), doc_type=ASSEMBLY, size=99999)
+    return time.time() - begin
+
+
+def percentile(times, pct):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--es', default='http://localhost:9200', help='Elasticsearch to load into')
+    parser.add_argument('--files', type=int, default=100, help='Synthetic peak files')
+    parser.add_argument('--peaks', type=int, default=20000, help='Peaks per file')
+    parser.add_argument('--flush-size', type=int, default=50000, help='Positions per nested doc')
+    parser.add_argument('--queries', type=int, default=500, help='Queries per kind and layout')
+    parser.add_argument('--width', type=int, default=100000, help='Width of the range queries')
+    parser.add_argument('--keep', action='store_true', help='Leave the benchmark indices in place')
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es], timeout=120)
+    rand = random.Random(1)
+    points = [rand.randint(1, CHROM_SIZE) for _ in range(args.queries)]
+    ranges = [(start, start + args.width) for start in (rand.randint(1, CHROM_SIZE - args.width) for _ in range(args.queries))]
+
+    for layout in REGIONS_LAYOUTS:
+        took = load(es, layout, args)
+        print('%s: loaded %d files of %d peaks in %.1fs' % (layout, args.files, args.peaks, took))
+        for (kind, coordinates) in [('point', [(point, point) for point in points]), ('range', ranges)]:
+            times = [query(es, layout, start, end) for (start, end) in coordinates]
+            print('    %-6s p50 %7.1f ms  p99 %7.1f ms' % (
+                kind, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+        if not args.keep:
+            es.indices.delete(index=region_index(CHROM, layout))
+
+
+if __name__ == '__main__':
+    main()
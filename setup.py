@@ -25,8 +25,10 @@ requires = [
     'jsonschema_serialize_fork',
     'loremipsum',
     'netaddr',
+    'numpy',
     'passlib',
     'psutil',
+    'pyarrow',
     'pyramid',
     'pyramid_localroles',
     'pyramid_multiauth',
@@ -84,6 +86,7 @@ setup(
         es-index-listener = snovault.elasticsearch.es_index_listener:main
 
         add-date-created = encoded.commands.add_date_created:main
+        build-ontology-store = encoded.commands.build_ontology_store:main
         check-rendering = encoded.commands.check_rendering:main
         deploy = encoded.commands.deploy:main
         extract_test_data = encoded.commands.extract_test_data:main
@@ -28,6 +28,7 @@ from snovault.elasticsearch import (
 )
 from snovault.json_renderer import json_renderer
 from elasticsearch import Elasticsearch
+from .ontology_store import ontology_from_settings
 STATIC_MAX_AGE = 0
 
 
@@ -243,11 +244,13 @@ def main(global_config, **local_config):
             timeout=60,
             maxsize=50
         )
+    if 'snp_search.server' in config.registry.settings or 'regions_peak_store' in config.registry.settings:
+        config.include('.peak_store')
         config.include('.region_search')
         config.include('.region_indexer')
     config.include(static_resources)
     config.include(changelogs)
-    config.registry['ontology'] = json_from_path(settings.get('ontology_path'), {})
+    config.registry['ontology'] = ontology_from_settings(settings, {})
     aws_ip_ranges = json_from_path(settings.get('aws_ip_ranges_path'), {'prefixes': []})
     config.registry['aws_ipset'] = netaddr.IPSet(
         record['ip_prefix'] for record in aws_ip_ranges['prefixes'] if record['service'] == 'AMAZON')
@@ -144,9 +144,8 @@ def audit_experiment_chipseq_control_read_depth(value, system, files_structure):
         control_objects = {}
         for control_experiment in controls:
             control_objects[control_experiment.get('@id')] = control_experiment
-            controls_files_structures[control_experiment.get('@id')] = create_files_mapping(
-                control_experiment.get('original_files'),
-                files_structure.get('excluded_types'))
+            controls_files_structures[control_experiment.get('@id')] = get_control_files_structure(
+                control_experiment, files_structure)
         awards_to_be_checked = [
                         'ENCODE3',
                         'ENCODE4',
@@ -447,7 +446,8 @@ def audit_experiment_mixed_libraries(value, system, excluded_types):
 
 
 def audit_experiment_pipeline_assay_details(value, system, files_structure):
-    for pipeline in get_pipeline_objects(files_structure.get('original_files').values()):
+    for pipeline in get_pipeline_objects(files_structure.get('original_files').values(),
+                                         get_files_index(files_structure)):
         pipeline_assays = pipeline.get('assay_term_names')
         if not pipeline_assays or value.get('assay_term_name') not in pipeline_assays:
             detail = ('This experiment '
@@ -478,7 +478,8 @@ def audit_experiment_missing_unfiltered_bams(value, system, files_structure):
                         'Transcription factor ChIP-seq 2 (unreplicated)']                    
     for pipeline in pipeline_title:
         if pipeline in get_pipeline_titles(
-                get_pipeline_objects(files_structure.get('alignments').values())):
+                get_pipeline_objects(files_structure.get('alignments').values(),
+                                     get_files_index(files_structure))):
             for filtered_file in files_structure.get('alignments').values():
                 if has_only_raw_files_in_derived_from(filtered_file, files_structure) and \
                    filtered_file.get('lab') == '/labs/encode-processing-pipeline/' and \
@@ -683,12 +684,14 @@ def check_experiment_dnase_seq_standards(experiment,
     alignment_files = files_structure.get('alignments').values()
     signal_files = files_structure.get('signal_files').values()
     assay_term_name = experiment['assay_term_name']
+    files_index = get_files_index(files_structure)
 
     pipeline_title = scanFilesForPipelineTitle_not_chipseq(
         alignment_files,
         ['GRCh38', 'mm10'],
         ['DNase-HS pipeline single-end - Version 2',
-         'DNase-HS pipeline paired-end - Version 2'])
+         'DNase-HS pipeline paired-end - Version 2'],
+        files_index)
     if pipeline_title is False:
         return
     for f in fastq_files:
@@ -697,12 +700,13 @@ def check_experiment_dnase_seq_standards(experiment,
             pipeline_title,
             link_to_standards)
 
-    pipelines = get_pipeline_objects(alignment_files)
+    pipelines = get_pipeline_objects(alignment_files, files_index)
 
     if pipelines is not None and len(pipelines) > 0:
         samtools_flagstat_metrics = get_metrics(alignment_files,
                                                 'SamtoolsFlagstatsQualityMetric',
-                                                desired_assembly)
+                                                desired_assembly,
+                                                files_index=files_index)
 
         if samtools_flagstat_metrics is not None and \
                 len(samtools_flagstat_metrics) > 0:
@@ -777,7 +781,8 @@ def check_experiment_dnase_seq_standards(experiment,
 
         hotspot_quality_metrics = get_metrics(alignment_files,
                                               'HotspotQualityMetric',
-                                              desired_assembly)
+                                              desired_assembly,
+                                              files_index=files_index)
         if hotspot_quality_metrics is not None and \
            len(hotspot_quality_metrics) > 0:
             for metric in hotspot_quality_metrics:
@@ -821,7 +826,8 @@ def check_experiment_dnase_seq_standards(experiment,
 
         signal_quality_metrics = get_metrics(signal_files,
                                              'CorrelationQualityMetric',
-                                             desired_assembly)
+                                             desired_assembly,
+                                             files_index=files_index)
         if signal_quality_metrics is not None and \
            len(signal_quality_metrics) > 0:
             threshold = 0.9
@@ -876,6 +882,7 @@ def check_experiment_rna_seq_standards(value,
     transcript_quantifications = files_structure.get(
         'transcript_quantifications_files').values()
     assay_term_name = value['assay_term_name']
+    files_index = get_files_index(files_structure)
 
     pipeline_title = scanFilesForPipelineTitle_not_chipseq(
         merged_files_list,
@@ -886,7 +893,8 @@ def check_experiment_rna_seq_standards(value,
          'RAMPAGE (paired-end, stranded)',
          'microRNA-seq pipeline',
          'Long read RNA-seq pipeline',
-         'Bulk RNA-seq'])
+         'Bulk RNA-seq'],
+        files_index)
     if pipeline_title is False:
         return
 
@@ -914,7 +922,8 @@ def check_experiment_rna_seq_standards(value,
                           'Bulk RNA-seq']:
         star_metrics = get_metrics(alignment_files,
                                    'StarQualityMetric',
-                                   desired_assembly)
+                                   desired_assembly,
+                                   files_index=files_index)
 
         if len(star_metrics) < 1:
             detail = ('ENCODE experiment {} of {} assay'
@@ -1024,6 +1033,7 @@ def check_experiment_wgbs_encode3_standards(experiment,
     alignment_files = files_structure.get('alignments').values()
     fastq_files = files_structure.get('fastq_files').values()
     cpg_quantifications = files_structure.get('cpg_quantifications').values()
+    files_index = get_files_index(files_structure)
 
     if fastq_files == []:
         return
@@ -1036,7 +1046,8 @@ def check_experiment_wgbs_encode3_standards(experiment,
                                                            ['GRCh38', 'mm10'],
                                                            ['WGBS single-end pipeline - version 2',
                                                             'WGBS single-end pipeline',
-                                                            'WGBS paired-end pipeline'])
+                                                            'WGBS paired-end pipeline'],
+                                                           files_index)
 
     if pipeline_title is False:
         return
@@ -1045,20 +1056,23 @@ def check_experiment_wgbs_encode3_standards(experiment,
         return
 
     bismark_metrics = get_metrics(
-        cpg_quantifications, 'BismarkQualityMetric', desired_assembly)
+        cpg_quantifications, 'BismarkQualityMetric', desired_assembly,
+        files_index=files_index)
     cpg_metrics = get_metrics(
-        cpg_quantifications, 'CpgCorrelationQualityMetric', desired_assembly)
+        cpg_quantifications, 'CpgCorrelationQualityMetric', desired_assembly,
+        files_index=files_index)
 
     samtools_metrics = get_metrics(cpg_quantifications,
                                    'SamtoolsFlagstatsQualityMetric',
-                                   desired_assembly)
+                                   desired_assembly,
+                                   files_index=files_index)
 
     yield from check_wgbs_coverage(
         samtools_metrics,
         pipeline_title,
         min(read_lengths),
         organism_name,
-        get_pipeline_objects(alignment_files))
+        get_pipeline_objects(alignment_files, files_index))
 
     yield from check_wgbs_pearson(cpg_metrics, 0.8, pipeline_title)
 
@@ -1111,6 +1125,7 @@ def check_experiment_chip_seq_standards(
     unfiltered_alignment_files = files_structure.get('unfiltered_alignments').values()
     idr_peaks_files = files_structure.get('preferred_default_idr_peaks').values()
     assay_name = experiment.get('assay_term_name')
+    files_index = get_files_index(files_structure)
 
     upper_limit_read_length = 50
     medium_limit_read_length = 36
@@ -1129,7 +1144,8 @@ def check_experiment_chip_seq_standards(
         'Histone ChIP-seq 2 (unreplicated)',
         'Histone ChIP-seq 2',
         'Transcription factor ChIP-seq 2',
-        'Transcription factor ChIP-seq 2 (unreplicated)'])
+        'Transcription factor ChIP-seq 2 (unreplicated)'],
+        files_index)
     if pipeline_title is False:
         return
 
@@ -1177,7 +1193,8 @@ def check_experiment_chip_seq_standards(
         return
 
     ListofMetrics = []
-    ListofMetrics.extend([get_metrics(idr_peaks_files, 'IDRQualityMetric'), get_metrics(idr_peaks_files, 'ChipReplicationQualityMetric')]) 
+    ListofMetrics.extend([get_metrics(idr_peaks_files, 'IDRQualityMetric', files_index=files_index),
+                          get_metrics(idr_peaks_files, 'ChipReplicationQualityMetric', files_index=files_index)])
     if ListofMetrics:
         for idr_metrics in ListofMetrics:
             yield from check_idr(idr_metrics, 2, 2)
@@ -3385,7 +3402,7 @@ def audit_experiment_platforms_mismatches(value, system, files_structure):
             for control in value['possible_controls']:
                 if control.get('original_files'):
                     control_platforms = get_platforms_used_in_experiment(
-                        create_files_mapping(control.get('original_files'), files_structure.get('excluded_types')))
+                        get_control_files_structure(control, files_structure))
                     if len(control_platforms) > 1:
                         control_platforms_string = str(
                             list(control_platforms)).replace('\'', '')
@@ -4206,10 +4223,12 @@ def check_experiment_atac_encode4_qc_standards(experiment, files_structure):
     assay_term_name = experiment['assay_term_name']
     if assay_term_name != 'ATAC-seq':
         return
+    files_index = get_files_index(files_structure)
     pipeline_title = scanFilesForPipelineTitle_not_chipseq(
         alignment_files, ['GRCh38', 'mm10'],
         ['ATAC-seq (unreplicated)',
-         'ATAC-seq (replicated)'])
+         'ATAC-seq (replicated)'],
+        files_index)
     if pipeline_title is False:
         return
 
@@ -4222,11 +4241,11 @@ def check_experiment_atac_encode4_qc_standards(experiment, files_structure):
                     atac_peaks_files.append(file)
     else:
         atac_peaks_files = files_structure.get('stable_peaks_files').values()
-    alignment_metrics = get_metrics(alignment_files, 'AtacAlignmentQualityMetric')
-    align_enrich_metrics = get_metrics(alignment_files, 'AtacAlignmentEnrichmentQualityMetric')
-    library_metrics = get_metrics(alignment_files, 'AtacLibraryQualityMetric')
-    peak_enrich_metrics = get_metrics(atac_peaks_files, 'AtacPeakEnrichmentQualityMetric')
-    replication_metrics = get_metrics(atac_peaks_files, 'AtacReplicationQualityMetric')
+    alignment_metrics = get_metrics(alignment_files, 'AtacAlignmentQualityMetric', files_index=files_index)
+    align_enrich_metrics = get_metrics(alignment_files, 'AtacAlignmentEnrichmentQualityMetric', files_index=files_index)
+    library_metrics = get_metrics(alignment_files, 'AtacLibraryQualityMetric', files_index=files_index)
+    peak_enrich_metrics = get_metrics(atac_peaks_files, 'AtacPeakEnrichmentQualityMetric', files_index=files_index)
+    replication_metrics = get_metrics(atac_peaks_files, 'AtacReplicationQualityMetric', files_index=files_index)
 
     # Checks in AtacAlignmentQualityMetric
     if alignment_metrics is not None and len(alignment_metrics) > 0:
@@ -4579,16 +4598,14 @@ def get_organism_name(reps, excluded_types):
     return False
 
 
-def scanFilesForPipelineTitle_not_chipseq(files_to_scan, assemblies, pipeline_titles):
+def scanFilesForPipelineTitle_not_chipseq(files_to_scan, assemblies, pipeline_titles,
+                                          files_index=None):
     for f in files_to_scan:
         if 'file_format' in f and f['file_format'] == 'bam' and \
            f['status'] not in ['replaced', 'deleted'] and \
            'assembly' in f and f['assembly'] in assemblies and \
-           f['lab'] == '/labs/encode-processing-pipeline/' and \
-           'analysis_step_version' in f and \
-           'analysis_step' in f['analysis_step_version'] and \
-           'pipelines' in f['analysis_step_version']['analysis_step']:
-            pipelines = f['analysis_step_version']['analysis_step']['pipelines']
+           f['lab'] == '/labs/encode-processing-pipeline/':
+            pipelines = get_file_pipelines(f, files_index)
             for p in pipelines:
                 if p['title'] in pipeline_titles:
                     return p['title']
@@ -4602,21 +4619,11 @@ def get_pipeline_by_name(pipeline_objects, pipeline_title):
     return None
 
 
-def scanFilesForPipeline(files_to_scan, pipeline_title_list):
+def scanFilesForPipeline(files_to_scan, pipeline_title_list, files_index=None):
     for f in files_to_scan:
-        if 'analysis_step_version' not in f:
-            continue
-        else:
-            if 'analysis_step' not in f['analysis_step_version']:
-                continue
-            else:
-                if 'pipelines' not in f['analysis_step_version']['analysis_step']:
-                    continue
-                else:
-                    pipelines = f['analysis_step_version']['analysis_step']['pipelines']
-                    for p in pipelines:
-                        if p['title'] in pipeline_title_list:
-                            return True
+        for p in get_file_pipelines(f, files_index):
+            if p['title'] in pipeline_title_list:
+                return True
     return False
 
 
@@ -4720,18 +4727,17 @@ def get_read_lengths_wgbs(fastq_files):
     return list_of_lengths
 
 
-def get_metrics(files_list, metric_type, desired_assembly=None, desired_annotation=[]):
+def get_metrics(files_list, metric_type, desired_assembly=None, desired_annotation=[],
+                files_index=None):
     metrics_dict = {}
     for f in files_list:
         if (desired_assembly is None or ('assembly' in f and
                                          f['assembly'] == desired_assembly)) and \
             (desired_annotation == [] or ('genome_annotation' in f and
                                             f['genome_annotation'] in desired_annotation)):
-            if 'quality_metrics' in f and len(f['quality_metrics']) > 0:
-                for qm in f['quality_metrics']:
-                    if metric_type in qm['@type']:
-                        if qm['uuid'] not in metrics_dict:
-                            metrics_dict[qm['uuid']] = qm
+            for qm in get_file_metrics(f, metric_type, files_index):
+                if qm['uuid'] not in metrics_dict:
+                    metrics_dict[qm['uuid']] = qm
     metrics = []
     for k in metrics_dict:
         metrics.append(metrics_dict[k])
@@ -4875,15 +4881,120 @@ def get_contributing_files(files_list, excluded_types):
     return to_return
 
 
-def scanFilesForPipelineTitle_yes_chipseq(alignment_files, pipeline_titles):
+def create_files_index(files_structure):
+    '''
+    Lookups shared by the audits of one experiment, collected in a single
+    pass over its original and contributing files instead of being
+    rescanned by every check: resolved derived_from files, fastqs by
+    replicate number, pipelines per file, quality metrics per file by
+    @type and the files mappings of the possible controls.
+    '''
+    to_return = {'files': {},
+                 'derived_from': {},
+                 'fastqs_by_replicate': {'technical_replicates': {},
+                                         'biological_replicates': {}},
+                 'fastq_positions': {},
+                 'pipelines': {},
+                 'metrics': {},
+                 'controls': {}}
+    # original files take precedence over contributing ones, as in
+    # get_derived_from_files_set
+    to_return['files'].update(files_structure.get('contributing_files', {}))
+    to_return['files'].update(files_structure.get('original_files', {}))
+    for file_id, file_object in to_return['files'].items():
+        derived_from_objects = []
+        for derived_id in file_object.get('derived_from', []):
+            derived_object = to_return['files'].get(derived_id)
+            if derived_object:
+                derived_from_objects.append(derived_object)
+        to_return['derived_from'][file_id] = derived_from_objects
+        to_return['pipelines'][file_id] = get_file_pipelines(file_object)
+        metrics_by_type = {}
+        for qm in file_object.get('quality_metrics', []):
+            for metric_type in qm.get('@type', []):
+                metrics_by_type.setdefault(metric_type, []).append(qm)
+        to_return['metrics'][file_id] = metrics_by_type
+
+    for position, (file_id, fastq) in enumerate(
+            files_structure.get('fastq_files', {}).items()):
+        to_return['fastq_positions'][file_id] = position
+        for replicate_type, by_replicate in to_return['fastqs_by_replicate'].items():
+            for replicate in set(fastq.get(replicate_type, [])):
+                by_replicate.setdefault(replicate, []).append(fastq)
+    return to_return
+
+
+def get_files_index(files_structure):
+    # built lazily for files structures that were not created by
+    # audit_experiment, e.g. the ones of control experiments
+    if 'files_index' not in files_structure:
+        files_structure['files_index'] = create_files_index(files_structure)
+    return files_structure['files_index']
+
+
+def is_indexed_file(file_object, files_index):
+    return files_index is not None and \
+        files_index['files'].get(file_object.get('@id')) is file_object
+
+
+def get_file_pipelines(file_object, files_index=None):
+    if is_indexed_file(file_object, files_index):
+        return files_index['pipelines'][file_object['@id']]
+    if has_pipelines(file_object):
+        return file_object['analysis_step_version']['analysis_step']['pipelines']
+    return []
+
+
+def get_file_metrics(file_object, metric_type, files_index=None):
+    if is_indexed_file(file_object, files_index):
+        return files_index['metrics'][file_object['@id']].get(metric_type, [])
+    return [qm for qm in file_object.get('quality_metrics', [])
+            if metric_type in qm['@type']]
+
+
+def get_derived_from_objects(file_object, files_structure):
+    files_index = files_structure.get('files_index')
+    if is_indexed_file(file_object, files_index):
+        return files_index['derived_from'][file_object['@id']]
+    derived_from_objects = []
+    for derived_id in file_object.get('derived_from', []):
+        derived_object = files_structure.get(
+            'original_files').get(derived_id)
+        if not derived_object:
+            derived_object = files_structure.get(
+                'contributing_files').get(derived_id)
+        if derived_object:
+            derived_from_objects.append(derived_object)
+    return derived_from_objects
+
+
+def get_replicate_fastqs(files_structure, replicate_type, replicates):
+    files_index = get_files_index(files_structure)
+    by_replicate = files_index['fastqs_by_replicate'][replicate_type]
+    fastqs = {}
+    for replicate in set(replicates):
+        for fastq in by_replicate.get(replicate, []):
+            fastqs[fastq['@id']] = fastq
+    # keep the order of fastq_files
+    return sorted(fastqs.values(),
+                  key=lambda f: files_index['fastq_positions'][f['@id']])
+
+
+def get_control_files_structure(control, files_structure):
+    controls = get_files_index(files_structure)['controls']
+    if control.get('@id') not in controls:
+        controls[control.get('@id')] = create_files_mapping(
+            control.get('original_files'),
+            files_structure.get('excluded_types'))
+    return controls[control.get('@id')]
+
+
+def scanFilesForPipelineTitle_yes_chipseq(alignment_files, pipeline_titles, files_index=None):
 
     if alignment_files:
         for f in alignment_files:
-            if f.get('lab') in ['/labs/encode-processing-pipeline/', '/labs/kevin-white/'] and \
-                'analysis_step_version' in f and \
-                'analysis_step' in f['analysis_step_version'] and \
-                    'pipelines' in f['analysis_step_version']['analysis_step']:
-                pipelines = f['analysis_step_version']['analysis_step']['pipelines']
+            if f.get('lab') in ['/labs/encode-processing-pipeline/', '/labs/kevin-white/']:
+                pipelines = get_file_pipelines(f, files_index)
                 for p in pipelines:
                     if p['title'] in pipeline_titles:
                         return p['title']
@@ -4895,14 +5006,8 @@ def get_derived_from_files_set(list_of_files, files_structure, file_format, obje
     derived_from_objects_list = []
     for file_object in list_of_files:
         if 'derived_from' in file_object:
-            for derived_id in file_object['derived_from']:
-                derived_object = files_structure.get(
-                    'original_files').get(derived_id)
-                if not derived_object:
-                    derived_object = files_structure.get(
-                        'contributing_files').get(derived_id)
-                if derived_object and \
-                   derived_object.get('file_format') == file_format and \
+            for derived_object in get_derived_from_objects(file_object, files_structure):
+                if derived_object.get('file_format') == file_format and \
                    derived_object.get('accession') not in derived_from_set:
                     derived_from_set.add(derived_object.get('accession'))
                     if object_flag:
@@ -4951,15 +5056,7 @@ def is_outdated_bams_replicate(bam_file, files_structure, assay_name):
         return True
 
 
-    rep_type_fastqs = [
-        f for f in files_structure.get('fastq_files').values()
-        if replicate_type in f
-    ]
-    rep_set = set(rep)
-    rep_fastqs = [
-        f for f in rep_type_fastqs
-        if any(e in rep_set for e in set(f[replicate_type]))
-    ]
+    rep_fastqs = get_replicate_fastqs(files_structure, replicate_type, rep)
 
     replicate_fastq_accessions = get_file_accessions(rep_fastqs)
     for file_object in rep_fastqs:
@@ -5039,17 +5136,14 @@ def get_pipeline_titles(pipeline_objects):
     return list(to_return)
 
 
-def get_pipeline_objects(files):
-    added_pipelines = []
+def get_pipeline_objects(files, files_index=None):
+    added_pipelines = set()
     pipelines_to_return = []
     for inspected_file in files:
-        if 'analysis_step_version' in inspected_file and \
-           'analysis_step' in inspected_file['analysis_step_version'] and \
-           'pipelines' in inspected_file['analysis_step_version']['analysis_step']:
-            for p in inspected_file['analysis_step_version']['analysis_step']['pipelines']:
-                if p['title'] not in added_pipelines:
-                    added_pipelines.append(p['title'])
-                    pipelines_to_return.append(p)
+        for p in get_file_pipelines(inspected_file, files_index):
+            if p['title'] not in added_pipelines:
+                added_pipelines.add(p['title'])
+                pipelines_to_return.append(p)
     return pipelines_to_return
 
 
@@ -5184,6 +5278,7 @@ def audit_experiment(value, system):
         value.get('original_files'), excluded_files)
     files_structure['contributing_files'] = get_contributing_files(
         value.get('contributing_files'), excluded_files)
+    files_structure['files_index'] = create_files_index(files_structure)
 
     for function_name in function_dispatcher_with_files.keys():
         yield from function_dispatcher_with_files[function_name](value, system, files_structure)
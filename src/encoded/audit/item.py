@@ -5,8 +5,14 @@ from snovault import (
 from snovault import (
     UPGRADER,
 )
-from snovault.schema_utils import validate
+from snovault.schema_utils import (
+    IgnoreUnchanged,
+    NoRemoteResolver,
+    SchemaValidator,
+    format_checker,
+)
 from snovault.util import simple_path_ids
+import threading
 from .formatter import (
     audit_link,
     path_to_text,
@@ -14,6 +20,50 @@ from .formatter import (
 )
 
 
+# SchemaValidator and its resolver keep state while validating, so compiled
+# validators are cached per thread, keyed by type name and schema version.
+_schema_validators = threading.local()
+
+
+def schema_validator(type_info, schema):
+    cache = getattr(_schema_validators, 'cache', None)
+    if cache is None:
+        cache = _schema_validators.cache = {}
+    key = (type_info.name, type_info.schema_version)
+    cached = cache.get(key)
+    if cached is None or cached[0] is not schema:
+        resolver = NoRemoteResolver.from_schema(schema)
+        validator = SchemaValidator(
+            schema, resolver=resolver, serialize=True, format_checker=format_checker)
+        cached = cache[key] = (schema, validator)
+    return cached[1]
+
+
+def validate(validator, data, current=None):
+    '''
+    Same as snovault.schema_utils.validate but with an already compiled validator.
+    '''
+    validated, errors = validator.serialize(data)
+    filtered_errors = []
+    for error in errors:
+        # Possibly ignore validation if it results in no change to data
+        if current is not None and isinstance(error, IgnoreUnchanged):
+            current_value = current
+            try:
+                for key in error.path:
+                    current_value = current_value[key]
+            except Exception:
+                pass
+            else:
+                validated_value = validated
+                for key in error.path:
+                    validated_value = validated_value[key]
+                if validated_value == current_value:
+                    continue
+        filtered_errors.append(error)
+    return validated, filtered_errors
+
+
 @audit_checker('Item', frame='object')
 def audit_item_schema(value, system):
     context = system['context']
@@ -24,6 +74,7 @@ def audit_item_schema(value, system):
     properties = context.properties.copy()
     current_version = properties.get('schema_version', '')
     target_version = context.type_info.schema_version
+    # only items stored with an older schema_version go through the upgrader
     if target_version is not None and current_version != target_version:
         upgrader = registry[UPGRADER]
         try:
@@ -41,7 +92,8 @@ def audit_item_schema(value, system):
         properties['schema_version'] = target_version
 
     properties['uuid'] = str(context.uuid)
-    validated, errors = validate(context.schema, properties, properties)
+    validated, errors = validate(
+        schema_validator(context.type_info, context.schema), properties, properties)
     for error in errors:
         category = 'validation error'
         path = list(error.path)
@@ -11,7 +11,12 @@ from urllib.parse import (
     urlencode,
     quote,
 )
-from encoded.search_views import search_generator
+from encoded.reports.metadata import BatchedSearchGenerator
+from encoded.reports.serializers import get_output_format
+from encoded.reports.serializers import gzip_chunks
+from encoded.reports.serializers import parquet_chunks
+from encoded.search_views import paged_search_generator
+from .region_indexer import region_doc_uuid
 from .vis_defines import is_file_visualizable
 import csv
 import io
@@ -150,6 +155,47 @@ def _batch_download_publicationdata(request):
     )
 
 
+def peak_files_metadata(request, results):
+    '''
+    Returns [(peak row, metadata of its file)] for the peaks of files in the region search results.
+    Each distinct file and experiment is embedded once, however many peak docs a file has, and
+    all of them are embedded here, inside the view's transaction, rather than in the app_iter.
+    '''
+    uuids_in_results = set(get_file_uuids(results))
+    files = {}
+    experiments = {}
+    rows = []
+    for row in results['peaks']:
+        file_uuid = region_doc_uuid(row['_id'])
+        if file_uuid not in uuids_in_results:
+            continue
+        if file_uuid not in files:
+            file_json = request.embed(file_uuid)
+            if file_json['dataset'] not in experiments:
+                experiments[file_json['dataset']] = request.embed(file_json['dataset'])
+            experiment_json = experiments[file_json['dataset']]
+            files[file_uuid] = {
+                'assay_term_name': experiment_json['assay_term_name'],
+                'target.label': experiment_json.get('target', {}).get('label'),  # not all experiments have targets
+                'biosample.accession': get_biosample_accessions(file_json, experiment_json),
+                'file.accession': file_json['accession'],
+                'experiment.accession': experiment_json['accession'],
+            }
+        rows.append((row, files[file_uuid]))
+    return rows
+
+
+def peak_coordinates(row):
+    for hit in row['inner_hits']['positions']['hits']['hits']:
+        yield '{}:{}-{}'.format(row['_index'], hit['_source']['start'], hit['_source']['end'])
+
+
+def format_tsv_row(row):
+    fout = io.StringIO()
+    csv.writer(fout, delimiter='\t').writerow(row)
+    return fout.getvalue().encode('utf-8')
+
+
 @view_config(route_name='peak_metadata', request_method='GET')
 def peak_metadata(context, request):
     param_list = parse_qs(request.matchdict['search_params'])
@@ -158,48 +204,55 @@ def peak_metadata(context, request):
     param_list['limit'] = ['all']
     path = '/region-search/?{}&{}'.format(quote(urlencode(param_list, True)),'referrer=peak_metadata')
     results = request.embed(path, as_user=True)
-    uuids_in_results = get_file_uuids(results)
-    rows = []
-    json_doc = {}
-    for row in results['peaks']:
-        if row['_id'] in uuids_in_results:
-            file_json = request.embed(row['_id'])
-            experiment_json = request.embed(file_json['dataset'])
-            for hit in row['inner_hits']['positions']['hits']['hits']:
-                data_row = []
-                coordinates = '{}:{}-{}'.format(row['_index'], hit['_source']['start'], hit['_source']['end'])
-                file_accession = file_json['accession']
-                experiment_accession = experiment_json['accession']
-                assay_name = experiment_json['assay_term_name']
-                target_name = experiment_json.get('target', {}).get('label') # not all experiments have targets
-                biosample_accession = get_biosample_accessions(file_json, experiment_json)
-                data_row.extend([assay_name, coordinates, target_name, biosample_accession, file_accession, experiment_accession])
-                rows.append(data_row)
-                if assay_name not in json_doc:
-                    json_doc[assay_name] = []
-                else:
-                    json_doc[assay_name].append({
+    # The app_iter runs after the transaction ends, so it only formats the embedded metadata.
+    peak_rows = peak_files_metadata(request, results)
+
+    def generate_tsv():
+        yield format_tsv_row(header)
+        for (row, metadata) in peak_rows:
+            for coordinates in peak_coordinates(row):
+                yield format_tsv_row([
+                    metadata['assay_term_name'],
+                    coordinates,
+                    metadata['target.label'],
+                    metadata['biosample.accession'],
+                    metadata['file.accession'],
+                    metadata['experiment.accession']
+                ])
+
+    def generate_json():
+        # Peaks are grouped by assay, so only the (file level) peak rows are gathered before streaming
+        rows_by_assay = OrderedDict()
+        for (row, metadata) in peak_rows:
+            rows_by_assay.setdefault(metadata['assay_term_name'], []).append((row, metadata))
+        yield b'{'
+        for (i, (assay_name, rows)) in enumerate(rows_by_assay.items()):
+            yield '{}{}: ['.format(', ' if i else '', json.dumps(assay_name)).encode('utf-8')
+            separator = ''
+            for (row, metadata) in rows:
+                biosample_accessions = list(metadata['biosample.accession'].split(', '))
+                for coordinates in peak_coordinates(row):
+                    yield (separator + json.dumps({
                         'coordinates': coordinates,
-                        'target.name': target_name,
-                        'biosample.accession': list(biosample_accession.split(', ')),
-                        'file.accession': file_accession,
-                        'experiment.accession': experiment_accession
-                    })
+                        'target.name': metadata['target.label'],
+                        'biosample.accession': biosample_accessions,
+                        'file.accession': metadata['file.accession'],
+                        'experiment.accession': metadata['experiment.accession']
+                    })).encode('utf-8')
+                    separator = ', '
+            yield b']'
+        yield b'}'
+
+    # Stream response using chunked encoding.
     if 'peak_metadata.json' in request.url:
-        return Response(
-            content_type='text/plain',
-            body=json.dumps(json_doc),
-            content_disposition='attachment;filename="%s"' % 'peak_metadata.json'
-        )
-    fout = io.StringIO()
-    writer = csv.writer(fout, delimiter='\t')
-    writer.writerow(header)
-    writer.writerows(rows)
-    return Response(
-        content_type='text/tsv',
-        body=fout.getvalue(),
-        content_disposition='attachment;filename="%s"' % 'peak_metadata.tsv'
-    )
+        request.response.content_type = 'text/plain'
+        request.response.content_disposition = 'attachment;filename="%s"' % 'peak_metadata.json'
+        request.response.app_iter = generate_json()
+        return request.response
+    request.response.content_type = 'text/tsv'
+    request.response.content_disposition = 'attachment;filename="%s"' % 'peak_metadata.tsv'
+    request.response.app_iter = generate_tsv()
+    return request.response
 
 
 @view_config(route_name='batch_download', request_method=('GET', 'POST'))
@@ -248,7 +301,6 @@ def batch_download(context, request):
     qs.extend(
         default_params + file_fields
     )
-    experiments = []
     if request.method == 'POST':
         metadata_link = ''
         cart_uuid = qs.get_one_value(
@@ -280,18 +332,21 @@ def batch_download(context, request):
             )
 
         # Because of potential number of datasets in the cart, break search
-        # into multiple searches of ELEMENT_CHUNK_SIZE datasets each.
-        for i in range(0, len(elements), ELEMENT_CHUNK_SIZE):
+        # into multiple searches of ELEMENT_CHUNK_SIZE datasets each, run
+        # concurrently and returned in order.
+        experiments = []
+        if elements:
             qs.drop('@id')
             qs.extend(
                 [
                     ('@id', e)
-                    for e in elements[i:i + ELEMENT_CHUNK_SIZE]
+                    for e in elements
                 ]
             )
-            path = '/search/?{}'.format(str(qs))
-            results = request.embed(quote(path), as_user=True)
-            experiments.extend(results['@graph'])
+            cart_request = qs.get_request_with_new_query_string()
+            cart_request.registry = request.registry
+            bsg = BatchedSearchGenerator(cart_request, batch_size=ELEMENT_CHUNK_SIZE)
+            experiments = bsg.results()
     else:
         # Make sure regular batch download doesn't include a cart parameter; error if it does.
         if cart_uuids:
@@ -302,9 +357,7 @@ def batch_download(context, request):
             host_url=request.host_url,
             search_params=qs._get_original_query_string()
         )
-        path = '/search/?{}'.format(str(qs))
-        results = request.embed(quote(path), as_user=True)
-        experiments = results['@graph']
+        experiments = _batch_download_search(request, qs)
 
     exp_files = (
             exp_file
@@ -312,32 +365,50 @@ def batch_download(context, request):
             for exp_file in exp.get('files', [])
     )
 
-    files = [metadata_link]
     param_list = qs.group_values_by_key()
-    for exp_file in exp_files:
-        if not files_prop_param_list(exp_file, param_list):
-            continue
-        elif visualizable_only and not is_file_visualizable(exp_file):
-            continue
-        elif raw_only and exp_file.get('assembly'):
-            # "raw" option only allows files w/o assembly.
-            continue
-        elif restricted_files_present(exp_file):
-            continue
-        files.append(
-            '{host_url}{href}'.format(
-                host_url=request.host_url,
-                href=exp_file['href'],
+
+    def generate_lines():
+        yield bytes_(metadata_link, 'utf-8')
+        for exp_file in exp_files:
+            if not files_prop_param_list(exp_file, param_list):
+                continue
+            elif visualizable_only and not is_file_visualizable(exp_file):
+                continue
+            elif raw_only and exp_file.get('assembly'):
+                # "raw" option only allows files w/o assembly.
+                continue
+            elif restricted_files_present(exp_file):
+                continue
+            yield bytes_(
+                '\n{host_url}{href}'.format(
+                    host_url=request.host_url,
+                    href=exp_file['href'],
+                ),
+                'utf-8'
             )
-        )
 
+    # Stream response using chunked encoding.
     return Response(
         content_type='text/plain',
-        body='\n'.join(files),
+        app_iter=generate_lines(),
         content_disposition='attachment; filename="%s"' % 'files.txt'
     )
 
 
+def _batch_download_search(request, qs):
+    """
+    Generate the experiments of a batch_download search one at a time,
+    instead of embedding the whole search result.
+
+        :param request: Pyramid request
+        :param qs: QueryString of the experiment search
+    """
+    search_request = qs.get_request_with_new_query_string()
+    search_request.path_info = '/search/'
+    search_request.registry = request.registry
+    return paged_search_generator(search_request)['@graph']
+
+
 def files_prop_param_list(exp_file, param_list):
     """Does a file in experiment search results match query-string parms?
 
@@ -412,6 +483,8 @@ def report_download(context, request):
         msg = 'Report view requires specifying a single type.'
         raise HTTPBadRequest(explanation=msg)
 
+    output_format = get_output_format(request)
+
     # Make sure we get all results
     request.GET['limit'] = 'all'
     type_str = types[0]
@@ -430,17 +503,17 @@ def report_download(context, request):
 
     header = [column.get('title') or field for field, column in columns.items()]
 
+    def generate_values():
+        for item in paged_search_generator(request)['@graph']:
+            yield [lookup_column_value(item, path) for path in columns]
+
     def generate_rows():
         yield format_header(header)
         yield format_row(header)
-        for item in search_generator(request)['@graph']:
-            values = [lookup_column_value(item, path) for path in columns]
+        for values in generate_values():
             yield format_row(values)
 
-    
-    # Stream response using chunked encoding.
-    request.response.content_type = 'text/tsv'
-    request.response.content_disposition = 'attachment;filename="{}_report_{}_{}_{}_{}h_{}m.tsv"'.format(
+    filename = '{}_report_{}_{}_{}_{}h_{}m'.format(
         snake_type,
         downloadtime.year,
         downloadtime.month,
@@ -448,6 +521,23 @@ def report_download(context, request):
         downloadtime.hour,
         downloadtime.minute
     )
+    # Stream response using chunked encoding.
+    if output_format == 'parquet':
+        request.response.content_type = 'application/octet-stream'
+        request.response.content_disposition = 'attachment;filename="{}.parquet"'.format(filename)
+        request.response.app_iter = parquet_chunks(
+            header,
+            generate_values(),
+            metadata={'report': '{}/report/?{}'.format(request.host_url, request.query_string)}
+        )
+        return request.response
+    if output_format == 'tsv.gz':
+        request.response.content_type = 'application/gzip'
+        request.response.content_disposition = 'attachment;filename="{}.tsv.gz"'.format(filename)
+        request.response.app_iter = gzip_chunks(generate_rows())
+        return request.response
+    request.response.content_type = 'text/tsv'
+    request.response.content_disposition = 'attachment;filename="{}.tsv"'.format(filename)
     request.response.app_iter = generate_rows()
     return request.response
 
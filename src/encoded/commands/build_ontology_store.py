@@ -0,0 +1,37 @@
+'''
+Build the ontology store read by the application from ontology.json.
+
+    bin/build-ontology-store ontology.json ontology.sqlite
+
+Set ontology_store_path to the output file to use it instead of loading
+ontology.json in every process.
+'''
+from encoded.ontology_store import build_ontology_store
+import json
+import logging
+
+
+EPILOG = __doc__
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the ontology store from ontology.json", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('ontology', help="ontology.json generated by generate-ontology")
+    parser.add_argument('store', help="Ontology store file to write")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    with open(args.ontology) as ontology_file:
+        ontology = json.load(ontology_file)
+    count = build_ontology_store(ontology, args.store)
+    log.info('Wrote %d terms to %s', count, args.store)
+
+
+if __name__ == '__main__':
+    main()
@@ -79,6 +79,7 @@ def human_single_annotation(r):
         doc['payload'] = {'id': r['HGNC ID'],
                           'species': species_for_payload}
         doc['id'] = r['HGNC ID']
+        doc['ensembl_gene_id'] = r['Ensembl Gene ID']  # region search resolves Ensembl ids locally
 
         if r['Entrez Gene ID'].isdigit():
             r['Entrez Gene ID'] = int(r['Entrez Gene ID'])
@@ -7,6 +7,7 @@ from .ntr_terms import (
 )
 from .manual_slims import slim_shims
 import json
+import multiprocessing as mp
 
 EPILOG = __doc__
 
@@ -247,6 +248,17 @@ type_slims = {
     'OBI:0000435': 'genotyping assay'
 }
 
+slim_types = {
+    'developmental': developental_slims,
+    'organ': organ_slims,
+    'cell': cell_slims,
+    'system': system_slims,
+    'assay': assay_slims,
+    'category': category_slims,
+    'objective': objective_slims,
+    'type': type_slims
+}
+
 
 class Inspector(object):
 
@@ -497,54 +509,105 @@ def splitNameFromNamespace(aUri):
     return (name, ns)
 
 
-def iterativeChildren(nodes, terms, closure):
-    if closure == 'data':
-        data = 'data'
-    else:
-        data = 'data_with_develops_from'
-    results = []
-    while 1:
-        newNodes = []
-        if len(nodes) == 0:
-            break
-        for node in nodes:
-            results.append(node)
-            if terms[node][data]:
-                for child in terms[node][data]:
-                    if child not in results:
-                        newNodes.append(child)
-        nodes = list(set(newNodes))
-    return list(set(results))
-
-
-def getSlims(goid, terms, slimType):
+def getClosures(terms, data, slimIndex):
+    '''
+    Map each term to a bitset of the slim terms in its closure, following
+    the ids in terms[term][data]. Terms are numbered and the strongly
+    connected components of the graph are completed children first, so
+    every closure is the union of the closures of its children and each
+    edge is followed once. Ids not in terms are leaves.
+    '''
+    ids = {}
+    for term in terms:
+        ids[term] = len(ids)
+    for term in terms:
+        for child in terms[term][data]:
+            if child not in ids:
+                ids[child] = len(ids)
+    children = [[] for i in range(len(ids))]
+    for term in terms:
+        children[ids[term]] = [ids[child] for child in terms[term][data]]
+    bits = [0] * len(ids)
+    for term, i in ids.items():
+        if term in slimIndex:
+            bits[i] = 1 << slimIndex[term]
+
+    closures = [0] * len(ids)
+    order = [-1] * len(ids)
+    low = [0] * len(ids)
+    onStack = [False] * len(ids)
+    stack = []
+    counter = 0
+    # Iterative Tarjan, ontologies are deeper than the recursion limit
+    for root in range(len(ids)):
+        if order[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, i = work.pop()
+            if i == 0:
+                order[node] = low[node] = counter
+                counter += 1
+                stack.append(node)
+                onStack[node] = True
+            edges = children[node]
+            while i < len(edges):
+                child = edges[i]
+                i += 1
+                if order[child] == -1:
+                    work.append((node, i))
+                    work.append((child, 0))
+                    break
+                if onStack[child]:
+                    low[node] = min(low[node], order[child])
+            else:
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    closure = 0
+                    for member in component:
+                        closure |= bits[member]
+                        for child in children[member]:
+                            closure |= closures[child]
+                    for member in component:
+                        closures[member] = closure
+    return {term: closures[ids[term]] for term in terms}
+
+
+def getSlimIndex():
+    ''' Bit of every slim term in the closures '''
+    slimIndex = {}
+    for slimTerms in slim_types.values():
+        for slimTerm in slimTerms:
+            if slimTerm not in slimIndex:
+                slimIndex[slimTerm] = len(slimIndex)
+    return slimIndex
+
+
+def getSlimBits(slimIndex):
+    ''' Bits and names of the slims of each type, in slim order '''
+    return {
+        slimType: [(1 << slimIndex[slimTerm], slimTerms[slimTerm]) for slimTerm in slimTerms]
+        for slimType, slimTerms in slim_types.items()
+    }
+
+
+def getSlims(goid, terms, slimType, slimBits):
     ''' Get Slims '''
 
-    slims = []
-    slimTerms = {}
     if slimType == 'developmental':
-        slimTerms = developental_slims
-    elif slimType == 'organ':
-        slimTerms = organ_slims
-    elif slimType == 'cell':
-        slimTerms = cell_slims
-    elif slimType == 'system':
-        slimTerms = system_slims
-    elif slimType == 'assay':
-        slimTerms = assay_slims
-    elif slimType == 'category':
-        slimTerms = category_slims
-    elif slimType == 'objective':
-        slimTerms = objective_slims
-    elif slimType == 'type':
-        slimTerms = type_slims
-    for slimTerm in slimTerms:
-        if slimType == 'developmental':
-            if slimTerm in terms[goid]['closure_with_develops_from']:
-                slims.append(slimTerms[slimTerm])
-        else:
-            if slimTerm in terms[goid]['closure']:
-                slims.append(slimTerms[slimTerm])
+        closure = terms[goid]['closure_with_develops_from']
+    else:
+        closure = terms[goid]['closure']
+    slims = [name for bit, name in slimBits[slimType] if closure & bit]
 
     if slim_shims.get(slimType, {}):
         # Overrides all Ontology based-slims
@@ -582,6 +645,128 @@ def getTermStructure():
     }
 
 
+def getTerms(url):
+    ''' Terms of the ontology at url, run in the parsing pool '''
+    terms = {}
+    data = Inspector(url)
+    for c in data.allclasses:
+        if isBlankNode(c):
+            for o in data.rdfGraph.objects(c, RDFS.subClassOf):
+                if isBlankNode(o):
+                    pass
+                else:
+                    for o1 in data.rdfGraph.objects(c, IntersectionOf):
+                        collection = Collection(data.rdfGraph, o1)
+                        col_list = []
+                        for col in data.rdfGraph.objects(collection[1]):
+                            col_list.append(col.__str__())
+                        if HUMAN_TAXON in col_list:
+                            if PART_OF in col_list:
+                                for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
+                                    term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
+                                    if term_id not in terms:
+                                        terms[term_id] = getTermStructure()
+                                    terms[term_id]['part_of'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
+                            elif DEVELOPS_FROM in col_list:
+                                for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
+                                    term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
+                                    if term_id not in terms:
+                                        terms[term_id] = getTermStructure()
+                                    terms[term_id]['develops_from'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
+        else:
+            term_id = splitNameFromNamespace(c)[0].replace('_', ':')
+            if term_id not in terms:
+                terms[term_id] = getTermStructure()
+            terms[term_id]['id'] = term_id
+            
+            try:
+                terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
+            except:
+                terms[term_id]['name'] = ''
+
+            terms[term_id]['preferred_name'] = preferred_name.get(term_id, '')
+            # Get all parents
+            for parent in data.get_classDirectSupers(c, excludeBnodes=False):
+                if isBlankNode(parent):
+                    for s, v, o in data.rdfGraph.triples((parent, OnProperty, None)):
+                        if o.__str__() == PART_OF:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['part_of'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == DEVELOPS_FROM:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['develops_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == HAS_PART:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['has_part'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == DERIVES_FROM:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                                else:
+                                    for o2 in data.rdfGraph.objects(o1, IntersectionOf):
+                                        for o3 in data.rdfGraph.objects(o2, RDF.first):
+                                            if not isBlankNode(o3):
+                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o3)[0].replace('_', ':'))
+                                        for o3 in data.rdfGraph.objects(o2, RDF.rest):
+                                            for o4 in data.rdfGraph.objects(o3, RDF.first):
+                                                for o5 in data.rdfGraph.objects(o4, SomeValuesFrom):
+                                                    for o6 in data.rdfGraph.objects(o5, IntersectionOf):
+                                                        for o7 in data.rdfGraph.objects(o6, RDF.first):
+                                                            if not isBlankNode(o7):
+                                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o7)[0].replace('_', ':'))
+                                                                for o8 in data.rdfGraph.objects(o6, RDF.rest):
+                                                                    for o9 in data.rdfGraph.objects(o8, RDF.first):
+                                                                        if not isBlankNode(o9):
+                                                                            terms[term_id]['derives_from'].append(splitNameFromNamespace(o9)[0].replace('_', ':'))
+                        elif o.__str__() == ACHIEVES_PLANNED_OBJECTIVE:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['achieves_planned_objective'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                else:
+                    terms[term_id]['parents'].append(splitNameFromNamespace(parent)[0].replace('_', ':'))
+            
+            for syn in data.entitySynonyms(c):
+                try:
+                    terms[term_id]['synonyms'].append(syn.__str__())
+                except:
+                    pass
+    return terms
+
+
+def getCLOTerms(url):
+    ''' Get only CLO terms from the CLO owl file '''
+    terms = {}
+    data = Inspector(url)
+    for c in data.allclasses:
+        if c.startswith('http://purl.obolibrary.org/obo/CLO'):
+            term_id = splitNameFromNamespace(c)[0].replace('_', ':')
+            if term_id not in terms:
+                terms[term_id] = getTermStructure()
+                terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
+            for syn in data.entitySynonyms(c):
+                try:
+                    terms[term_id]['synonyms'].append(syn.__str__())
+                except:
+                    pass
+    return terms
+
+
+def mergeTerms(terms, url_terms):
+    ''' Add the terms of one ontology as if they had been parsed into terms '''
+    for term_id, term in url_terms.items():
+        if term_id not in terms:
+            terms[term_id] = term
+            continue
+        if term['id']:
+            for key in ('id', 'name', 'preferred_name'):
+                terms[term_id][key] = term[key]
+        for key in ('parents', 'part_of', 'has_part', 'derives_from', 'develops_from', 'achieves_planned_objective', 'synonyms'):
+            terms[term_id][key].extend(term[key])
+
+
 def main():
     ''' Downloads UBERON, EFO, OBI and CLO ontologies and create a JSON file '''
 
@@ -595,6 +780,7 @@ def main():
     parser.add_argument('--obi-url', help="OBI version URL")
     parser.add_argument('--clo-url', help="CLO version URL")
     parser.add_argument('--doid-url', help="DOID version URL")
+    parser.add_argument('--processes', type=int, default=5, help="Ontologies parsed at once, each holds its whole graph in memory")
     args = parser.parse_args()
 
     uberon_url = args.uberon_url
@@ -605,132 +791,38 @@ def main():
     whitelist = [uberon_url, efo_url, obi_url, doid_url]
 
     terms = {}
-    # Run on ontologies defined in whitelist
-    for url in whitelist:
-        data = Inspector(url)
-        for c in data.allclasses:
-            if isBlankNode(c):
-                for o in data.rdfGraph.objects(c, RDFS.subClassOf):
-                    if isBlankNode(o):
-                        pass
-                    else:
-                        for o1 in data.rdfGraph.objects(c, IntersectionOf):
-                            collection = Collection(data.rdfGraph, o1)
-                            col_list = []
-                            for col in data.rdfGraph.objects(collection[1]):
-                                col_list.append(col.__str__())
-                            if HUMAN_TAXON in col_list:
-                                if PART_OF in col_list:
-                                    for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
-                                        term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
-                                        if term_id not in terms:
-                                            terms[term_id] = getTermStructure()
-                                        terms[term_id]['part_of'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
-                                elif DEVELOPS_FROM in col_list:
-                                    for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
-                                        term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
-                                        if term_id not in terms:
-                                            terms[term_id] = getTermStructure()
-                                        terms[term_id]['develops_from'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
-            else:
-                term_id = splitNameFromNamespace(c)[0].replace('_', ':')
-                if term_id not in terms:
-                    terms[term_id] = getTermStructure()
-                terms[term_id]['id'] = term_id
-                
-                try:
-                    terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
-                except:
-                    terms[term_id]['name'] = ''
-
-                terms[term_id]['preferred_name'] = preferred_name.get(term_id, '')
-                # Get all parents
-                for parent in data.get_classDirectSupers(c, excludeBnodes=False):
-                    if isBlankNode(parent):
-                        for s, v, o in data.rdfGraph.triples((parent, OnProperty, None)):
-                            if o.__str__() == PART_OF:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['part_of'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == DEVELOPS_FROM:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['develops_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == HAS_PART:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['has_part'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == DERIVES_FROM:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['derives_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                                    else:
-                                        for o2 in data.rdfGraph.objects(o1, IntersectionOf):
-                                            for o3 in data.rdfGraph.objects(o2, RDF.first):
-                                                if not isBlankNode(o3):
-                                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o3)[0].replace('_', ':'))
-                                            for o3 in data.rdfGraph.objects(o2, RDF.rest):
-                                                for o4 in data.rdfGraph.objects(o3, RDF.first):
-                                                    for o5 in data.rdfGraph.objects(o4, SomeValuesFrom):
-                                                        for o6 in data.rdfGraph.objects(o5, IntersectionOf):
-                                                            for o7 in data.rdfGraph.objects(o6, RDF.first):
-                                                                if not isBlankNode(o7):
-                                                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o7)[0].replace('_', ':'))
-                                                                    for o8 in data.rdfGraph.objects(o6, RDF.rest):
-                                                                        for o9 in data.rdfGraph.objects(o8, RDF.first):
-                                                                            if not isBlankNode(o9):
-                                                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o9)[0].replace('_', ':'))
-                            elif o.__str__() == ACHIEVES_PLANNED_OBJECTIVE:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['achieves_planned_objective'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                    else:
-                        terms[term_id]['parents'].append(splitNameFromNamespace(parent)[0].replace('_', ':'))
-                
-                for syn in data.entitySynonyms(c):
-                    try:
-                        terms[term_id]['synonyms'].append(syn.__str__())
-                    except:
-                        pass
-
-    # Get only CLO terms from the CLO owl file
-    data = Inspector(clo_url)
-    for c in data.allclasses:
-        if c.startswith('http://purl.obolibrary.org/obo/CLO'):
-            term_id = splitNameFromNamespace(c)[0].replace('_', ':')
-            if term_id not in terms:
-                terms[term_id] = getTermStructure()
-                terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
-            for syn in data.entitySynonyms(c):
-                try:
-                    terms[term_id]['synonyms'].append(syn.__str__())
-                except:
-                    pass
+    # Parse the ontologies in parallel, the terms are merged in whitelist order
+    with mp.Pool(processes=args.processes) as pool:
+        clo_result = pool.apply_async(getCLOTerms, (clo_url,))
+        for url_terms in pool.map(getTerms, whitelist):
+            mergeTerms(terms, url_terms)
+        clo_terms = clo_result.get()
+    for term_id, term in clo_terms.items():
+        if term_id not in terms:
+            terms[term_id] = getTermStructure()
+            terms[term_id]['name'] = term['name']
+        terms[term_id]['synonyms'].extend(term['synonyms'])
 
     for term in terms:
         terms[term]['data'] = list(set(terms[term]['parents']) | set(terms[term]['part_of']) | set(terms[term]['derives_from']) | set(terms[term]['achieves_planned_objective']))
         terms[term]['data_with_develops_from'] = list(set(terms[term]['data']) | set(terms[term]['develops_from']))
 
+    slimIndex = getSlimIndex()
+    slimBits = getSlimBits(slimIndex)
+    closures = getClosures(terms, 'data', slimIndex)
+    closures_with_develops_from = getClosures(terms, 'data_with_develops_from', slimIndex)
     for term in terms:
-        words = iterativeChildren(terms[term]['data'], terms, 'data')
-        for word in words:
-            terms[term]['closure'].append(word)
-
-        d = iterativeChildren(terms[term]['data_with_develops_from'], terms, 'data_with_develops_from')
-        for dd in d:
-            terms[term]['closure_with_develops_from'].append(dd)
-       
-        terms[term]['closure'].append(term)
-        terms[term]['closure_with_develops_from'].append(term)
-
-        terms[term]['systems'] = getSlims(term, terms, 'system')
-        terms[term]['organs'] = getSlims(term, terms, 'organ')
-        terms[term]['cells'] = getSlims(term, terms, 'cell')
-        terms[term]['developmental'] = getSlims(term, terms, 'developmental')
-        terms[term]['assay'] = getSlims(term, terms, 'assay')
-        terms[term]['category'] = getSlims(term, terms, 'category')
-        terms[term]['objectives'] = getSlims(term, terms, 'objective')
-        terms[term]['types'] = getSlims(term, terms, 'type')
+        terms[term]['closure'] = closures[term]
+        terms[term]['closure_with_develops_from'] = closures_with_develops_from[term]
+
+        terms[term]['systems'] = getSlims(term, terms, 'system', slimBits)
+        terms[term]['organs'] = getSlims(term, terms, 'organ', slimBits)
+        terms[term]['cells'] = getSlims(term, terms, 'cell', slimBits)
+        terms[term]['developmental'] = getSlims(term, terms, 'developmental', slimBits)
+        terms[term]['assay'] = getSlims(term, terms, 'assay', slimBits)
+        terms[term]['category'] = getSlims(term, terms, 'category', slimBits)
+        terms[term]['objectives'] = getSlims(term, terms, 'objective', slimBits)
+        terms[term]['types'] = getSlims(term, terms, 'type', slimBits)
 
         del terms[term]['closure'], terms[term]['closure_with_develops_from']
     
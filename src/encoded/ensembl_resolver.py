@@ -0,0 +1,236 @@
+import collections
+import logging
+import re
+import sqlite3
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+log = logging.getLogger(__name__)
+
+
+# Resolves rsIDs and Ensembl gene ids to (chromosome, start, end) for region search.
+# 1) an in-memory LRU, backed by an optional sqlite file (ensembl_cache_path) shared by all workers
+# 2) for gene ids, the annotations index in the encoded es
+# 3) rest.ensembl.org (ensembl_url) through one pooled session with timeouts and 429/5xx retries
+# Only found coordinates are cached, so a failed or timed out lookup is tried again next time.
+
+ENSEMBL_RESOLVER = 'ensembl_resolver'
+_ENSEMBL_URL = 'http://rest.ensembl.org/'
+_ENSEMBL_TIMEOUT = 10  # seconds, for connecting and for each read
+_ENSEMBL_CACHE_SIZE = 10000
+
+_GENOME_TO_SPECIES = {
+    'GRCh37': 'homo_sapiens',
+    'GRCh38': 'homo_sapiens',
+    'GRCm37': 'mus_musculus',
+    'GRCm38': 'mus_musculus'
+}
+
+NOT_FOUND = ('', '', '')
+
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry[ENSEMBL_RESOLVER] = EnsemblResolver(
+        ensembl_url=settings.get('ensembl_url', _ENSEMBL_URL),
+        cache_path=settings.get('ensembl_cache_path'),
+        capacity=int(settings.get('ensembl_cache_size', _ENSEMBL_CACHE_SIZE)),
+        timeout=float(settings.get('ensembl_timeout', _ENSEMBL_TIMEOUT))
+    )
+
+
+class CoordinateCache(object):
+    # Bounded LRU of key -> (chromosome, start, end), in front of an optional sqlite file
+
+    def __init__(self, path=None, capacity=_ENSEMBL_CACHE_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            with self.db:
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS coordinates '
+                    '(key TEXT PRIMARY KEY, chromosome TEXT, start TEXT, end TEXT)'
+                )
+
+    def get(self, key):
+        with self.lock:
+            coordinates = self.entries.get(key)
+            if coordinates is not None:
+                self.entries.move_to_end(key)
+                return coordinates
+            if self.db is None:
+                return None
+            try:
+                row = self.db.execute(
+                    'SELECT chromosome, start, end FROM coordinates WHERE key = ?', (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                log.warn('Ensembl coordinate cache read failed', exc_info=True)
+                return None
+            if row is None:
+                return None
+            coordinates = tuple(row)
+            self._remember(key, coordinates)
+            return coordinates
+
+    def set(self, key, coordinates):
+        with self.lock:
+            self._remember(key, coordinates)
+            if self.db is None:
+                return
+            try:
+                with self.db:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?, ?)',
+                        (key,) + tuple(str(value) for value in coordinates)
+                    )
+            except sqlite3.Error:
+                log.warn('Ensembl coordinate cache write failed', exc_info=True)
+
+    def _remember(self, key, coordinates):
+        self.entries[key] = coordinates
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class EnsemblResolver(object):
+    # Cached rsID and Ensembl gene id to coordinates lookups
+
+    def __init__(self, ensembl_url=_ENSEMBL_URL, cache_path=None, capacity=_ENSEMBL_CACHE_SIZE,
+                 timeout=_ENSEMBL_TIMEOUT):
+        self.ensembl_url = ensembl_url
+        self.timeout = timeout
+        self.cache = CoordinateCache(cache_path, capacity)
+        self.session = requests.Session()
+        retries = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+        self.session.mount(ensembl_url, HTTPAdapter(pool_maxsize=10, max_retries=retries))
+
+    def get_json(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        return response.json()
+
+    def cached(self, kind, id, assembly, resolve):
+        key = '%s:%s:%s' % (kind, id, assembly)
+        coordinates = self.cache.get(key)
+        if coordinates is not None:
+            return coordinates
+        coordinates = resolve()
+        if coordinates[0]:
+            self.cache.set(key, coordinates)
+        return coordinates
+
+    def rsid_coordinates(self, id, assembly):
+        return self.cached('rsid', id, assembly, lambda: self.remote_rsid_coordinates(id, assembly))
+
+    def ensemblid_coordinates(self, id, assembly, es=None):
+        id = id.upper()  # region search lower cases the region
+
+        def resolve():
+            coordinates = NOT_FOUND
+            if es is not None:
+                coordinates = self.annotation_coordinates(es, id, assembly)
+            if not coordinates[0]:
+                coordinates = self.remote_ensemblid_coordinates(id, assembly)
+            return coordinates
+        return self.cached('ensemblid', id, assembly, resolve)
+
+    def annotation_coordinates(self, es, id, assembly):
+        ''' Gets coordinates of an Ensembl gene id from the annotations index, if it is there '''
+        # Mouse annotations are keyed by Ensembl id, human ones carry it in ensembl_gene_id
+        query = {
+            'query': {
+                'bool': {
+                    'should': [
+                        {'ids': {'values': [id]}},
+                        {'match': {'ensembl_gene_id': id}}
+                    ]
+                }
+            },
+            'size': 1
+        }
+        try:
+            hits = es.search(index='annotations', doc_type='default', body=query)['hits']['hits']
+        except:
+            return NOT_FOUND
+        for hit in hits:
+            for annotation in hit['_source'].get('annotations', []):
+                if annotation['assembly_name'] == assembly and annotation['chromosome']:
+                    return ('chr' + annotation['chromosome'], annotation['start'], annotation['end'])
+        return NOT_FOUND
+
+    def assembly_mapper(self, location, species, input_assembly, output_assembly):
+        # All others
+        new_url = self.ensembl_url + 'map/' + species + '/' \
+            + input_assembly + '/' + location + '/' + output_assembly \
+            + '/?content-type=application/json'
+        try:
+            new_response = self.get_json(new_url)
+        except:
+            return NOT_FOUND
+        else:
+            if 'mappings' not in new_response or len(new_response['mappings']) < 1:
+                return NOT_FOUND
+            data = new_response['mappings'][0]['mapped']
+            chromosome = 'chr' + data['seq_region_name']
+            start = data['start']
+            end = data['end']
+            return(chromosome, start, end)
+
+    def remote_rsid_coordinates(self, id, assembly):
+        species = _GENOME_TO_SPECIES[assembly]
+        url = '{ensembl}variation/{species}/{id}?content-type=application/json'.format(
+            ensembl=self.ensembl_url,
+            species=species,
+            id=id
+        )
+        try:
+            response = self.get_json(url)
+        except:
+            return NOT_FOUND
+        else:
+            if 'mappings' not in response:
+                return NOT_FOUND
+            for mapping in response['mappings']:
+                if 'PATCH' not in mapping['location']:
+                    location = mapping['location']
+                    if mapping['assembly_name'] == assembly:
+                        chromosome, start, end = re.split(':|-', mapping['location'])
+                        return('chr' + chromosome, start, end)
+                    elif assembly == 'GRCh37':
+                        return self.assembly_mapper(location, species, 'GRCh38', assembly)
+                    elif assembly == 'GRCm37':
+                        return self.assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
+            return NOT_FOUND
+
+    def remote_ensemblid_coordinates(self, id, assembly):
+        species = _GENOME_TO_SPECIES[assembly]
+        url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
+            ensembl=self.ensembl_url,
+            id=id
+        )
+        try:
+            response = self.get_json(url)
+            location = '{chr}:{start}-{end}'.format(
+                chr=response['seq_region_name'],
+                start=response['start'],
+                end=response['end']
+            )
+        except:
+            return NOT_FOUND
+        if response['assembly_name'] == assembly:
+            chromosome, start, end = re.split(':|-', location)
+            return('chr' + chromosome, start, end)
+        elif assembly == 'GRCh37':
+            return self.assembly_mapper(location, species, 'GRCh38', assembly)
+        elif assembly == 'GRCm37':
+            return self.assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
+        else:
+            return NOT_FOUND
@@ -0,0 +1,113 @@
+'''
+Read-only store for registry['ontology'] kept in an SQLite file.
+
+The ontology is only ever looked up by term id, so instead of keeping the
+whole of ontology.json in every process the terms are stored one compact
+JSON document per row and decoded on demand. Build the file from
+ontology.json with the build-ontology-store command.
+'''
+from collections.abc import Mapping
+from functools import lru_cache
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Set with ontology_store_cache_size
+ONTOLOGY_STORE_CACHE_SIZE = 10000
+
+
+class OntologyStore(Mapping):
+    '''
+    Dict-like, read-only view of the terms in an ontology store file.
+    Decoded terms are kept in an LRU cache, misses included, so the usual
+    `term_id in ontology` followed by `ontology[term_id]` costs one query.
+    '''
+
+    def __init__(self, path, cache_size=ONTOLOGY_STORE_CACHE_SIZE):
+        self.path = path
+        self._local = threading.local()
+        self._term = lru_cache(maxsize=cache_size)(self._load_term)
+
+    def _connection(self):
+        # sqlite connections can not be shared between threads or forked
+        # processes, each one opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                'file:{}?mode=ro'.format(self.path), uri=True)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _load_term(self, term_id):
+        row = self._connection().execute(
+            'SELECT value FROM terms WHERE term_id = ?', (term_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def __getitem__(self, term_id):
+        term = self._term(term_id)
+        if term is None:
+            raise KeyError(term_id)
+        return term
+
+    def __contains__(self, term_id):
+        return self._term(term_id) is not None
+
+    def __iter__(self):
+        for term_id, in self._connection().execute('SELECT term_id FROM terms'):
+            yield term_id
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM terms').fetchone()[0]
+
+
+def build_ontology_store(ontology, path):
+    '''
+    Write the ontology dict to a new store at path. The file is written
+    next to path and renamed over it, so running processes keep reading
+    the previous file.
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute(
+            'CREATE TABLE terms (term_id TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+        connection.executemany(
+            'INSERT INTO terms VALUES (?, ?)',
+            (
+                (term_id, json.dumps(term, separators=(',', ':'), sort_keys=True))
+                for term_id, term in ontology.items()
+            )
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    return len(ontology)
+
+
+def ontology_from_settings(settings, default=None):
+    '''
+    The ontology store when ontology_store_path points to a built store,
+    otherwise the ontology.json at ontology_path loaded in memory.
+    '''
+    store_path = settings.get('ontology_store_path')
+    if store_path and os.path.exists(store_path):
+        cache_size = int(settings.get('ontology_store_cache_size', ONTOLOGY_STORE_CACHE_SIZE))
+        return OntologyStore(store_path, cache_size=cache_size)
+    ontology_path = settings.get('ontology_path')
+    if ontology_path is None:
+        return default
+    if store_path:
+        log.warn('Ontology store %s not found, loading %s', store_path, ontology_path)
+    with open(ontology_path) as ontology_file:
+        return json.load(ontology_file)
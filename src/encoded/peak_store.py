@@ -0,0 +1,307 @@
+import bisect
+import collections
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+
+log = logging.getLogger(__name__)
+
+
+# Local peak store: an alternative to the regions es for region search (regions_layout = local)
+# What it is:
+# 1) <regions_peak_store>/residents.json
+#    {'residents': {file uuid: residency doc}, 'next_file_id': n, 'next_segment': n,
+#     'chroms': {assembly: {chrom: {'segments': [{'name', 'rows', 'max_length'}], 'dead': n}}}}
+#    Residency docs are like resident_regionsets in regions es, plus the integer 'file_id' of the file's peaks
+#    and the 'rows' it has on each chrom. File ids are never reused, so peaks of a dropped file can't be
+#    mistaken for a later one.
+# 2) <regions_peak_store>/<assembly>/<chrom>.<n>.peaks  segments of raw PEAK_DTYPE records sorted by start
+# The region indexer is the only writer: peaks are buffered and written as a new segment of each chrom at flush().
+# Segments of a similar size are then merged, a block at a time, so a chrom has few segments and each peak is
+# rewritten a few times rather than at every flush. Peaks of dropped files ('dead') are left out by the merges.
+# Web workers memory-map the segments listed in residents.json and reload it whenever the indexer rewrites it.
+
+PEAK_STORE = 'peak_store'
+PEAK_DTYPE = numpy.dtype([('start', '<i8'), ('end', '<i8'), ('file', '<i4')])
+PEAK_STORE_FLUSH_ROWS = 5000000  # buffered peaks (20 bytes each) before writing new segments
+PEAK_STORE_MERGE_ROWS = 1000000  # peaks read from each segment at a time while merging
+RESIDENTS_FILE = 'residents.json'
+
+
+def includeme(config):
+    registry = config.registry
+    if registry.settings.get('regions_layout') != 'local':
+        return
+    path = registry.settings.get('regions_peak_store')
+    if not path:
+        raise ValueError('regions_layout = local requires a regions_peak_store directory')
+    registry[PEAK_STORE] = PeakStore(path)
+
+
+def replace_file(path, write):
+    '''Writes a file next to path and moves it into place, so readers never see a partial file.'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as tmp:
+        write(tmp)
+    os.replace(tmp_path, path)
+
+
+def start_index(peaks, start, side='left'):
+    '''numpy.searchsorted on the start column, without copying the column out of a memory map.'''
+    if side == 'left':
+        return bisect.bisect_left(peaks['start'], start)
+    return bisect.bisect_right(peaks['start'], start)
+
+
+def merge_peaks(inputs, live, out, block_rows=PEAK_STORE_MERGE_ROWS):
+    '''Writes the peaks of live file ids from the sorted inputs to out, sorted by start, about block_rows
+       of each input at a time. Returns (rows, longest peak).'''
+    positions = [0] * len(inputs)
+    (rows, max_length) = (0, 0)
+    while True:
+        # All peaks up to the first end of the inputs' next blocks can be written in order
+        bound = None
+        for (peaks, position) in zip(inputs, positions):
+            if position < len(peaks):
+                block_end = int(peaks['start'][min(position + block_rows, len(peaks)) - 1])
+                bound = block_end if bound is None else min(bound, block_end)
+        if bound is None:
+            return (rows, max_length)
+        blocks = []
+        for (i, peaks) in enumerate(inputs):
+            stop = start_index(peaks, bound, side='right')
+            blocks.append(peaks[positions[i]:stop])
+            positions[i] = stop
+        block = numpy.concatenate(blocks)
+        block = block[numpy.argsort(block['start'], kind='mergesort')]
+        block = block[numpy.isin(block['file'], live)]
+        if len(block):
+            out.write(block.tobytes())
+            rows += len(block)
+            max_length = max(max_length, int((block['end'] - block['start']).max()))
+
+
+class PeakStore(object):
+    # Stores and searches peaks in per assembly, per chrom sorted segments
+
+    def __init__(self, path, flush_rows=PEAK_STORE_FLUSH_ROWS):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.lock = threading.Lock()  # region indexer workers add concurrently
+        self.pending = {}             # (assembly, chrom): [arrays of peaks not yet in a segment]
+        self.pending_rows = 0
+        self.removed = {}             # (assembly, chrom): peaks of files dropped since last flush
+        self.dirty = False            # residents changed since last flush
+        self._residents = None
+        self._residents_mtime = None
+        self._next_file_id = 0
+        self._next_segment = 0
+        self._chrom_segments = {}     # assembly: {chrom: {'segments': [...], 'dead': n}}
+        self._file_uuids = {}
+        self._segments = {}           # (assembly, segment name): memory-mapped peaks
+
+    def segment_path(self, assembly, name):
+        return os.path.join(self.path, assembly, name)
+
+    def residents(self):
+        '''Returns {file uuid: residency doc}, reloaded when another process has rewritten it.'''
+        if self.dirty:
+            return self._residents  # Unflushed changes of this (the indexer) process win
+        path = os.path.join(self.path, RESIDENTS_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._residents is None or mtime != self._residents_mtime:
+            saved = {'residents': {}, 'next_file_id': 0, 'next_segment': 0, 'chroms': {}}
+            if mtime is not None:
+                with open(path) as residents_file:
+                    saved = json.load(residents_file)
+            residents = saved['residents']
+            self._residents = residents
+            self._next_file_id = saved['next_file_id']
+            self._next_segment = saved['next_segment']
+            self._chrom_segments = saved['chroms']
+            self._residents_mtime = mtime
+            self._file_uuids = {doc['file_id']: uuid for uuid, doc in residents.items()}
+            # Let go of the memory maps of merged away segments
+            current = set(
+                (assembly, segment['name'])
+                for (assembly, chroms) in self._chrom_segments.items()
+                for chrom in chroms.values()
+                for segment in chrom['segments']
+            )
+            self._segments = {key: peaks for (key, peaks) in self._segments.items() if key in current}
+        return self._residents
+
+    def resident_docs(self, ids):
+        '''returns {id: residency doc} for those of ids that are in the store'''
+        residents = self.residents()
+        return {str(id): residents[str(id)] for id in ids if str(id) in residents}
+
+    def count(self):
+        return len(self.residents())
+
+    def add(self, id, assembly, assay_term_name, columns, source='encoded'):
+        '''Buffers a file's (chrom, starts, ends) columns and marks it resident. Returns True if any peaks were added.'''
+        with self.lock:
+            residents = self.residents()
+            file_id = self._next_file_id
+            rows = collections.OrderedDict()  # chrom: peaks
+            for (chrom, starts, ends) in columns:
+                if not len(starts):
+                    continue
+                peaks = numpy.empty(len(starts), dtype=PEAK_DTYPE)
+                peaks['start'] = starts
+                peaks['end'] = ends
+                peaks['file'] = file_id
+                self.pending.setdefault((assembly, chrom), []).append(peaks)
+                self.pending_rows += len(peaks)
+                rows[chrom] = rows.get(chrom, 0) + len(peaks)
+            if not rows:
+                return False
+            self.dirty = True
+            self._next_file_id += 1
+            residents[str(id)] = {
+                'uuid': str(id),
+                'source': source,
+                'assay_term_name': assay_term_name,
+                'assembly': assembly,
+                'chroms': list(rows.keys()),
+                'rows': dict(rows),
+                'file_id': file_id
+            }
+            self._file_uuids[file_id] = str(id)
+            if self.pending_rows >= self.flush_rows:
+                self._flush()
+        return True
+
+    def remove(self, id):
+        '''Drops a file from the store. Its peaks are no longer found and go when their segments are merged.
+           Returns False if it was not resident.'''
+        with self.lock:
+            residents = self.residents()
+            doc = residents.pop(str(id), None)
+            if doc is None:
+                return False
+            self.dirty = True
+            self._file_uuids.pop(doc['file_id'], None)
+            for chrom in doc['chroms']:
+                key = (doc['assembly'], chrom)
+                self.removed[key] = self.removed.get(key, 0) + doc['rows'].get(chrom, 0)
+            return True
+
+    def flush(self):
+        '''Writes buffered peaks as new segments, merges segments and saves the residents.'''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        live = numpy.array(sorted(self._file_uuids), dtype=PEAK_DTYPE['file'])
+        merged = []  # segments replaced, only deleted once the residents no longer list them
+        for key in set(self.pending) | set(self.removed):
+            (assembly, chrom) = key
+            chrom_segments = self._chrom_segments.setdefault(assembly, {}).setdefault(
+                chrom, {'segments': [], 'dead': 0})
+            chrom_segments['dead'] += self.removed.pop(key, 0)
+            arrays = [peaks for peaks in self.pending.pop(key, []) if int(peaks['file'][0]) in self._file_uuids]
+            if arrays:
+                peaks = numpy.concatenate(arrays)
+                segment = self.write_segment(assembly, chrom, [peaks[numpy.argsort(peaks['start'], kind='mergesort')]], live)
+                chrom_segments['segments'].append(segment)
+            merged.extend(self.merge_segments(assembly, chrom, chrom_segments, live))
+            if not chrom_segments['segments']:
+                del self._chrom_segments[assembly][chrom]
+        self.pending_rows = 0
+
+        if self.dirty:
+            os.makedirs(self.path, exist_ok=True)
+            residents = json.dumps({
+                'residents': self._residents,
+                'next_file_id': self._next_file_id,
+                'next_segment': self._next_segment,
+                'chroms': self._chrom_segments
+            }).encode('utf-8')
+            replace_file(os.path.join(self.path, RESIDENTS_FILE), lambda out: out.write(residents))
+            self.dirty = False
+        for (assembly, name) in merged:
+            self._segments.pop((assembly, name), None)
+            os.remove(self.segment_path(assembly, name))  # Readers still mapping it keep their copy
+
+    def write_segment(self, assembly, chrom, inputs, live):
+        '''Merges the sorted inputs into a new segment. Returns its entry, or None if no live peaks were left.'''
+        name = '%s.%d.peaks' % (chrom, self._next_segment)
+        self._next_segment += 1
+        path = self.segment_path(assembly, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = []
+        replace_file(path, lambda out: written.append(merge_peaks(inputs, live, out)))
+        (rows, max_length) = written[0]
+        if not rows:
+            os.remove(path)
+            return None
+        return {'name': name, 'rows': rows, 'max_length': max_length}
+
+    def merge_segments(self, assembly, chrom, chrom_segments, live):
+        '''Merges the newest segments of a chrom while they are of a similar size, so a chrom has O(log peaks)
+           segments and each peak is rewritten O(log peaks) times. All are merged once dead peaks are half of them.
+           Returns the (assembly, name) of the segments merged away.'''
+        segments = chrom_segments['segments']
+        total = sum(segment['rows'] for segment in segments)
+        if segments and chrom_segments['dead'] * 2 >= total:
+            count = len(segments)
+        else:
+            count = 1
+            while count < len(segments) and \
+                    segments[-count - 1]['rows'] <= 2 * sum(segment['rows'] for segment in segments[-count:]):
+                count += 1
+            if count < 2:
+                return []
+        merging = segments[len(segments) - count:]
+        inputs = [self.segment_peaks(assembly, segment['name']) for segment in merging]
+        segment = self.write_segment(assembly, chrom, inputs, live)
+        dropped = sum(merged['rows'] for merged in merging) - (segment['rows'] if segment else 0)
+        chrom_segments['segments'] = segments[:len(segments) - count] + ([segment] if segment else [])
+        chrom_segments['dead'] = 0 if count == len(segments) else max(0, chrom_segments['dead'] - dropped)
+        return [(assembly, merged['name']) for merged in merging]
+
+    def segment_peaks(self, assembly, name):
+        peaks = self._segments.get((assembly, name))
+        if peaks is None:
+            peaks = numpy.memmap(self.segment_path(assembly, name), dtype=PEAK_DTYPE, mode='r')
+            self._segments[(assembly, name)] = peaks
+        return peaks
+
+    def chrom_peaks(self, assembly, chrom):
+        '''Returns [(memory-mapped sorted peaks, longest peak)] of the segments of a chrom.'''
+        for attempt in range(2):
+            self.residents()
+            segments = self._chrom_segments.get(assembly, {}).get(chrom, {}).get('segments', [])
+            try:
+                return [(self.segment_peaks(assembly, segment['name']), segment['max_length']) for segment in segments]
+            except FileNotFoundError:
+                self._residents_mtime = None  # Merged away since the residents were read
+        return []
+
+    def search(self, assembly, chrom, start, end):
+        '''Returns the peaks overlapping [start, end] as hits shaped like binned layout hits.'''
+        hits = []
+        for (peaks, max_length) in self.chrom_peaks(assembly, chrom):
+            # Only peaks starting within the longest peak length before start can reach it
+            lo = start_index(peaks, start - max_length, side='left')
+            hi = start_index(peaks, end, side='right')
+            candidates = peaks[lo:hi]
+            found = candidates[candidates['end'] >= start]
+            for (peak_start, peak_end, file_id) in found.tolist():
+                uuid = self._file_uuids.get(file_id)
+                if uuid is None:
+                    continue  # dropped since the segment was written
+                hits.append({
+                    '_type': assembly,
+                    '_source': {'uuid': uuid, 'start': peak_start, 'end': peak_end}
+                })
+        return hits
@@ -1,19 +1,25 @@
 import urllib3
 import io
+import array
 import gzip
 import csv
 import logging
 import collections
+import threading
 import certifi
 import json
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pyramid.view import view_config
 from sqlalchemy.sql import text
 from elasticsearch.exceptions import (
     NotFoundError
 )
-from elasticsearch.helpers import scan
+from elasticsearch.helpers import (
+    scan,
+    streaming_bulk
+)
 from snovault import DBSESSION, COLLECTIONS
 #from snovault.storage import (
 #    TransactionRecord,
@@ -32,6 +38,7 @@ from snovault.elasticsearch.interfaces import (
     SNP_SEARCH_ES,
     INDEXER,
 )
+from .peak_store import PEAK_STORE
 
 log = logging.getLogger(__name__)
 
@@ -53,6 +60,8 @@ SUPPORTED_ASSEMBLIES = ['hg19', 'mm10', 'mm9', 'GRCh38']
 ENCODED_ALLOWED_FILE_FORMATS = ['bed']
 ENCODED_ALLOWED_STATUSES = ['released']
 RESIDENT_REGIONSET_KEY = 'resident_regionsets'  # in regions_es, keeps track of what datsets are resident in one place
+REGIONS_FLUSH_SIZE = 50000  # positions per chrom doc. Larger chroms are split into several docs of the same file
+REGIONS_POSITION_BYTES = 40  # about the json size of one position, bulk requests are cut at flush_size of them
 
 ENCODED_REGION_REQUIREMENTS = {
     'ChIP-seq': {
@@ -69,6 +78,13 @@ ENCODED_REGION_REQUIREMENTS = {
     }
 }
 
+REGIONS_LAYOUTS = ['nested', 'binned', 'local']  # Set with regions_layout. Switching needs a forced reindex
+REGIONS_WORKERS = 1  # concurrent file fetch/parse/index pipelines. Set with regionindexer_workers
+
+# One candidate file of a dataset: add=True to (re)index it, False to drop it from regions es.
+# resident is the file's residency doc if it is already in regions es, else None.
+FileJob = collections.namedtuple('FileJob', ['accession', 'assay_term_name', 'afile', 'add', 'resident'])
+
 # On local instance, these are the only files that can be downloaded and regionalizable.  Currently only one is!
 TESTABLE_FILES = ['ENCFF002COS']  # '/static/test/peak_indexer/ENCFF002COS.bed.gz']
                                   # '/static/test/peak_indexer/ENCFF296FFD.tsv',     # tsv's some day?
@@ -89,10 +105,146 @@ def tsvreader(file):
     for row in reader:
         yield row
 
+
+def bed_regions(bed_file, flush_size=REGIONS_FLUSH_SIZE):
+    '''Parses a bed text stream into (chrom, starts, ends) columns, without holding the whole file.
+       A chrom is yielded each time it reaches flush_size rows and its remainder once the stream ends.'''
+    columns = collections.OrderedDict()
+    for line in bed_file:
+        row = line.split('\t', 3)
+        if len(row) < 3 or line.startswith(('#', 'track', 'browser')):
+            continue
+        try:
+            start, end = int(row[1]) + 1, int(row[2]) + 1
+        except ValueError:
+            log.warn('positions are not integers, skipping row: %s' % line.rstrip())
+            continue
+        chrom = row[0].lower()
+        if chrom not in columns:
+            columns[chrom] = (array.array('l'), array.array('l'))
+        (starts, ends) = columns[chrom]
+        starts.append(start)
+        ends.append(end)
+        if len(starts) >= flush_size:
+            yield (chrom, starts, ends)
+            columns[chrom] = (array.array('l'), array.array('l'))
+
+    for chrom, (starts, ends) in columns.items():
+        if starts:
+            yield (chrom, starts, ends)
+
+
+def bed_positions(columns):
+    '''Converts (chrom, starts, ends) columns into the (chrom, positions) form stored in regions es.'''
+    for (chrom, starts, ends) in columns:
+        yield (chrom, [{'start': start, 'end': end} for start, end in zip(starts, ends)])
+
+
+def region_doc_id(uuid, chunk=0):
+    '''Returns the regions es id of a chrom doc. Chroms split over several docs number the extra ones.'''
+    if chunk == 0:
+        return str(uuid)
+    return '%s:%d' % (uuid, chunk)
+
+
+def region_doc_uuid(doc_id):
+    '''Returns the file uuid of a regions es chrom doc id.'''
+    return doc_id.split(':')[0]
+
+
+def region_docs(id, assembly, chrom, chunk, positions, layout='nested'):
+    '''Generates bulk index actions for one chunk of a file's positions on a chrom.
+       The nested layout makes a single doc, the binned layout one doc per position.'''
+    if layout == 'binned':
+        for position in positions:
+            yield {
+                '_index': region_index(chrom, layout),
+                '_type': assembly,
+                '_source': {
+                    'uuid': str(id),
+                    'start': position['start'],
+                    'end': position['end'],
+                    'bin': bin_from_range(position['start'], position['end'])
+                }
+            }
+        return
+    yield {
+        '_index': chrom,
+        '_type': assembly,
+        '_id': region_doc_id(id, chunk),
+        '_source': {
+            'uuid': str(id),
+            'positions': positions
+        }
+    }
+
+# UCSC hierarchical bins: 128kb at the finest level, each level 8 times coarser, up to 512Mb
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+
+def bin_from_range(start, end):
+    '''Returns the smallest UCSC bin holding all of [start, end).'''
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return 0  # Beyond 512Mb, which no supported assembly has
+
+
+def overlapping_bins(start, end):
+    '''Returns every UCSC bin that may hold a range overlapping [start, end).'''
+    bins = []
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return bins
+
+
+def region_index(chrom, layout='nested'):
+    '''Returns the regions es index holding a chrom in the given layout.'''
+    if layout == 'nested':
+        return chrom
+    return chrom + '_' + layout
+
+
 # Mapping should be generated dynamically for each assembly type
 
 
-def get_mapping(assembly_name='hg19'):
+def get_mapping(assembly_name='hg19', layout='nested'):
+    if layout == 'binned':
+        # One flat doc per peak
+        return {
+            assembly_name: {
+                '_all': {
+                    'enabled': False
+                },
+                '_source': {
+                    'enabled': True
+                },
+                'properties': {
+                    'uuid': {
+                        'type': 'keyword'
+                    },
+                    'start': {
+                        'type': 'long'
+                    },
+                    'end': {
+                        'type': 'long'
+                    },
+                    'bin': {
+                        'type': 'integer'
+                    }
+                }
+            }
+        }
     return {
         assembly_name: {
             '_all': {
@@ -166,7 +318,7 @@ class RegionIndexerState(IndexerState):
         self.list_extend(self.files_added_set, [uuid])
 
     def file_dropped(self, uuid):
-        self.list_extend(self.files_added_set, [uuid])
+        self.list_extend(self.files_dropped_set, [uuid])
 
     def all_indexable_uuids(self, request):
         '''returns list of uuids pertinant to this indexer.'''
@@ -290,7 +442,8 @@ class RegionIndexerState(IndexerState):
 def regionindexer_state_show(request):
     encoded_es = request.registry[ELASTIC_SEARCH]
     encoded_INDEX = request.registry.settings['snovault.elasticsearch.index']
-    regions_es    = request.registry[SNP_SEARCH_ES]
+    regions_es    = request.registry.get(SNP_SEARCH_ES)
+    peak_store    = request.registry.get(PEAK_STORE)
     state = RegionIndexerState(encoded_es,encoded_INDEX)  # Consider putting this in regions es instead of encoded es
     if not state.get():
         return "%s is not in service." % (state.state_id)
@@ -312,7 +465,10 @@ def regionindexer_state_show(request):
     display = state.display(uuids=request.params.get("uuids"))
 
     try:
-        count = regions_es.count(index=RESIDENT_REGIONSET_KEY, doc_type='default').get('count',0)
+        if peak_store is not None:
+            count = peak_store.count()
+        else:
+            count = regions_es.count(index=RESIDENT_REGIONSET_KEY, doc_type='default').get('count',0)
         if count:
             display['files_in_index'] = count
     except:
@@ -382,10 +538,16 @@ class RegionIndexer(Indexer):
         super(RegionIndexer, self).__init__(registry)
         self.encoded_es    = registry[ELASTIC_SEARCH]    # yes this is self.es but we want clarity
         self.encoded_INDEX = registry.settings['snovault.elasticsearch.index']  # yes this is self.index, but clarity
-        self.regions_es    = registry[SNP_SEARCH_ES]
+        self.regions_es    = registry.get(SNP_SEARCH_ES)  # Not needed by the local layout
         self.residents_index = RESIDENT_REGIONSET_KEY
-        self.state = RegionIndexerState(self.encoded_es,self.encoded_INDEX)  # WARNING, race condition is avoided because there is only one worker
+        self.state = RegionIndexerState(self.encoded_es,self.encoded_INDEX)  # WARNING, only written from the thread running update_objects
         self.test_instance = registry.settings.get('testing',False)
+        self.known_indices = set()   # (index, doc_type) pairs known to exist in regions_es this cycle
+        self.flush_size = int(registry.settings.get('regionindexer_flush_size', REGIONS_FLUSH_SIZE))
+        self.workers = int(registry.settings.get('regionindexer_workers', REGIONS_WORKERS))
+        self.layout = registry.settings.get('regions_layout', REGIONS_LAYOUTS[0])
+        self.peak_store = registry.get(PEAK_STORE)  # Only with the local layout
+        self.known_indices_lock = threading.Lock()
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
@@ -395,15 +557,50 @@ class RegionIndexer(Indexer):
         # pylint: disable=too-many-arguments, unused-argument
         '''Run indexing process on uuids'''
         errors = []
-        for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, force)
-            if error is not None:
-                errors.append(error)
-            if (i + 1) % 1000 == 0:
-                log.info('Indexing %d', i + 1)
+        self.known_indices.clear()  # Indices may have been deleted by hand between cycles
+        if self.workers > 1:
+            errors = self.update_objects_pooled(request, uuids, force)
+        else:
+            for i, uuid in enumerate(uuids):
+                error = self.update_object(request, uuid, force)
+                if error is not None:
+                    errors.append(error)
+                if (i + 1) % 1000 == 0:
+                    log.info('Indexing %d', i + 1)
+        if self.peak_store is not None:
+            self.peak_store.flush()
+        return errors
+
+    def update_objects_pooled(self, request, uuids, force):
+        '''Run indexing process on uuids with self.workers files fetched, parsed and indexed at once.
+           Datasets are still embedded one at a time here and all state accounting stays in this thread.'''
+        errors = []
+        pending = collections.deque()  # (job, future) in submission order
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for i, uuid in enumerate(uuids):
+                for job in self.file_jobs(request, uuid):
+                    pending.append((job, pool.submit(self.run_file_job, request, job, force)))
+                # Don't let embedding run too far ahead of the workers
+                while pending and (len(pending) > 2 * self.workers or pending[0][1].done()):
+                    error = self.finish_file_job(*pending.popleft(), force=force)
+                    if error is not None:
+                        errors.append(error)
+                if (i + 1) % 1000 == 0:
+                    log.info('Indexing %d', i + 1)
+            while pending:
+                error = self.finish_file_job(*pending.popleft(), force=force)
+                if error is not None:
+                    errors.append(error)
         return errors
 
     def update_object(self, request, dataset_uuid, force):
+        for job in self.file_jobs(request, dataset_uuid):
+            self.file_job_done(job, self.run_file_job(request, job, force), force)
+
+        # TODO: gather and return errors
+
+    def file_jobs(self, request, dataset_uuid):
+        '''Yields a FileJob for every file of a dataset that may need to be added to or dropped from regions es.'''
         request.datastore = 'elasticsearch'  # Let's be explicit
 
         try:
@@ -424,35 +621,51 @@ class RegionIndexer(Indexer):
             return
 
         files = dataset.get('files',[])
+        files = [afile for afile in files if afile.get('file_format') in ENCODED_ALLOWED_FILE_FORMATS]
+        # Note: if file_format changed to not allowed but file already in regions es, it doesn't get removed.
+        residents = self.resident_docs([afile['uuid'] for afile in files])  # one lookup for the whole dataset
         for afile in files:
-            if afile.get('file_format') not in ENCODED_ALLOWED_FILE_FORMATS:
-                continue  # Note: if file_format changed to not allowed but file already in regions es, it doesn't get removed.
-
-            file_uuid = afile['uuid']
-
-            if self.encoded_candidate_file(afile, assay_term_name):
-
-                using = ""
-                if force:
-                    using = "with FORCE"
-                    #log.debug("file is a candidate: %s %s", afile['accession'], using)
-                    self.remove_from_regions_es(file_uuid)  # remove all regions first
-                else:
-                    #log.debug("file is a candidate: %s", afile['accession'])
-                    if self.in_regions_es(file_uuid):
-                        continue
+            add = self.encoded_candidate_file(afile, assay_term_name)
+            yield FileJob(dataset['accession'], assay_term_name, afile, add, residents.get(str(afile['uuid'])))
+
+    def run_file_job(self, request, job, force):
+        '''Adds or drops one file in regions es. Returns True if regions es changed. Safe to run in a worker thread.'''
+        file_uuid = job.afile['uuid']
+        if not job.add:
+            if job.resident is None:
+                return False
+            return self.remove_from_regions_es(file_uuid, job.resident)
 
-                if self.add_encoded_file_to_regions_es(request, assay_term_name, afile):
-                    log.info("added file: %s %s %s", dataset['accession'], afile['href'], using)
-                    self.state.file_added(file_uuid)
+        if job.resident is not None:
+            if not force:
+                #log.debug("file is a candidate: %s", afile['accession'])
+                return False
+            #log.debug("file is a candidate: %s %s", afile['accession'], using)
+            self.remove_from_regions_es(file_uuid, job.resident)  # remove all regions first
 
-            else:
-                if self.remove_from_regions_es(file_uuid):
-                    log.info("dropped file: %s %s %s", dataset['accession'], afile['@id'], using)
-                    self.state.file_dropped(file_uuid)
+        return self.add_encoded_file_to_regions_es(request, job.assay_term_name, job.afile)
 
-        # TODO: gather and return errors
+    def file_job_done(self, job, changed, force):
+        '''Logs and accounts for one finished FileJob.'''
+        if not changed:
+            return
+        using = "with FORCE" if force else ""
+        if job.add:
+            log.info("added file: %s %s %s", job.accession, job.afile['href'], using)
+            self.state.file_added(job.afile['uuid'])
+        else:
+            log.info("dropped file: %s %s %s", job.accession, job.afile['@id'], using)
+            self.state.file_dropped(job.afile['uuid'])
 
+    def finish_file_job(self, job, future, force):
+        '''Waits for a pooled FileJob and accounts for it. Returns an error if it failed.'''
+        try:
+            changed = future.result()
+        except Exception as e:
+            log.error("Region indexer failed on file %s of %s", job.afile['uuid'], job.accession, exc_info=True)
+            return {'error_message': repr(e), 'uuid': str(job.afile['uuid'])}
+        self.file_job_done(job, changed, force)
+        return None
 
     def encoded_candidate_file(self, afile, assay_term_name):
         '''returns True if an encoded file should be in regions es'''
@@ -511,26 +724,43 @@ class RegionIndexer(Indexer):
 
         return False
 
-
-    def remove_from_regions_es(self, id):
-        '''Removes all traces of an id (usually uuid) from region search elasticsearch index.'''
-        #return True # DEBUG
+    def resident_docs(self, ids):
+        '''returns {id: residency doc} for those of ids that are in regions es, using a single mget'''
+        if not ids:
+            return {}
+        if self.peak_store is not None:
+            return self.peak_store.resident_docs(ids)
         try:
-            doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
-            if not doc:
-                return False
+            res = self.regions_es.mget(index=self.residents_index, doc_type='default',
+                                       body={'ids': [str(id) for id in ids]})
+        except NotFoundError:
+            return {}  # No residents index yet
         except:
-            return False  # Not an error: remove may be called without looking first
+            log.error("Region indexer failed to look up %d ids in %s" % (len(ids), self.residents_index))
+            return {}
+        return {doc['_id']: doc['_source'] for doc in res.get('docs', []) if doc.get('found')}
 
-        for chrom in doc['chroms']:
+    def remove_from_regions_es(self, id, doc=None):
+        '''Removes all traces of an id (usually uuid) from region search elasticsearch index.
+           doc is the id's residency doc when already looked up.'''
+        #return True # DEBUG
+        if self.peak_store is not None:
+            return self.peak_store.remove(id)
+        if doc is None:
             try:
-                self.regions_es.delete(index=chrom, doc_type=doc['assembly'], id=str(uuid))
+                doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
+                if not doc:
+                    return False
             except:
-                #log.error("Region indexer failed to remove %s regions of %s" % (chrom,id))
-                return False # Will try next full cycle
+                return False  # Not an error: remove may be called without looking first
+
+        # Residency docs written before chrom docs were split have no chunks
+        chunks = {chrom: doc.get('chunks', {}).get(chrom, 1) for chrom in doc['chroms']}
+        if not self.remove_region_docs(id, doc['assembly'], chunks, doc.get('layout', 'nested')):
+            return False # Will try next full cycle
 
         try:
-            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(uuid))
+            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(id))
         except:
             log.error("Region indexer failed to remove %s from %s" % (id, self.residents_index))
             return False # Will try next full cycle
@@ -538,40 +768,105 @@ class RegionIndexer(Indexer):
         return True
 
 
-    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
-        '''Given regions from some source (most likely encoded file) loads the data into region search es'''
-        #return True # DEBUG
-        for key in regions:
-            doc = {
-                'uuid': str(id),
-                'positions': regions[key]
-            }
-            # Could be a chrom never seen before!
-            if not self.regions_es.indices.exists(key):
-                self.regions_es.indices.create(index=key, body=index_settings())
-
-            if not self.regions_es.indices.exists_type(index=key, doc_type=assembly):
-                self.regions_es.indices.put_mapping(index=key, doc_type=assembly, body=get_mapping(assembly))
-
-            self.regions_es.index(index=key, doc_type=assembly, body=doc, id=str(id))
+    def ensure_index(self, index, doc_type, mapping):
+        '''Creates index and mapping in regions es unless already known to exist this cycle.'''
+        if (index, doc_type) in self.known_indices:
+            return
+        with self.known_indices_lock:  # workers may meet the same new chrom at once
+            if (index, doc_type) in self.known_indices:
+                return
+            if not self.regions_es.indices.exists(index):
+                self.regions_es.indices.create(index=index, body=index_settings())
+
+            if not self.regions_es.indices.exists_type(index=index, doc_type=doc_type):
+                self.regions_es.indices.put_mapping(index=index, doc_type=doc_type, body=mapping)
+            self.known_indices.add((index, doc_type))
+
+    def remove_region_docs(self, id, assembly, chunks, layout):
+        '''Removes the chrom docs of an id, chunks being {chrom: number of docs}. Docs already gone are skipped.
+           Returns False if any could not be removed.'''
+        for (chrom, count) in chunks.items():
+            if layout == 'binned':
+                try:
+                    self.regions_es.delete_by_query(index=region_index(chrom, layout), doc_type=assembly,
+                                                    body={'query': {'term': {'uuid': str(id)}}})
+                except:
+                    return False
+                continue
+            for chunk in range(count):
+                try:
+                    self.regions_es.delete(index=chrom, doc_type=assembly, id=region_doc_id(id, chunk), ignore=404)
+                except:
+                    #log.error("Region indexer failed to remove %s regions of %s" % (chrom,id))
+                    return False
+        return True
 
-        # Now add dataset to residency list
-        doc = {
+    def region_actions(self, id, assembly, regions, chunks):
+        '''Generates bulk index actions for all chrom docs of one file, counting the docs of each chrom in chunks.
+           regions is an iterable of (chrom, positions) which may repeat a chrom that was split.'''
+        for (chrom, positions) in regions:
+            # Could be a chrom never seen before!
+            self.ensure_index(region_index(chrom, self.layout), assembly, get_mapping(assembly, self.layout))
+            chunk = chunks.get(chrom, 0)
+            chunks[chrom] = chunk + 1
+            for action in region_docs(id, assembly, chrom, chunk, positions, self.layout):
+                yield action
+
+    def residency_doc(self, id, assembly, assay_term_name, chunks, source='encoded'):
+        '''Returns the residency doc of a file whose chrom docs, chunks being {chrom: number of docs}, are all indexed.'''
+        return {
             'uuid': str(id),
             'source': source,
             'assay_term_name': assay_term_name,
             'assembly': assembly,
-            'chroms': list(regions.keys())
+            'chroms': list(chunks.keys()),
+            'chunks': dict(chunks),
+            'layout': self.layout
         }
-        # Make sure there is an index set up to handle whether uuids are resident
-        if not self.regions_es.indices.exists(self.residents_index):
-            self.regions_es.indices.create(index=self.residents_index, body=index_settings())
 
-        if not self.regions_es.indices.exists_type(index=self.residents_index, doc_type='default'):
-            mapping = {'default': {"enabled": False}}
-            self.regions_es.indices.put_mapping(index=self.residents_index, doc_type='default', body=mapping)
+    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
+        '''Given regions from some source (most likely encoded file) loads the data into region search es.
+           regions is either a {chrom: positions} dict or an iterable of (chrom, positions).'''
+        #return True # DEBUG
+        if isinstance(regions, dict):
+            regions = regions.items()
+        if self.peak_store is not None:
+            columns = ((chrom, [position['start'] for position in positions], [position['end'] for position in positions])
+                       for (chrom, positions) in regions)
+            return self.peak_store.add(id, assembly, assay_term_name, columns, source)
+        # Chrom docs first. The file is only marked resident once all of them are indexed,
+        # otherwise the ones that made it are removed again and the file is retried next cycle.
+        # Requests are cut at about flush_size positions, so only that much of the file is held at once.
+        chunks = collections.OrderedDict()  # chrom: number of docs
+        actions = self.region_actions(id, assembly, regions, chunks)
+        (failed, error) = (0, None)
+        try:
+            for (ok, item) in streaming_bulk(self.regions_es, actions, chunk_size=self.flush_size,
+                                             max_chunk_bytes=self.flush_size * REGIONS_POSITION_BYTES,
+                                             raise_on_error=False):
+                if not ok:
+                    failed += 1
+                    error = error or item
+        except:
+            # Fetching, parsing or sending failed partway
+            self.remove_region_docs(id, assembly, chunks, self.layout)
+            raise
+        if failed:
+            log.error("Region indexer failed to add %d docs for %s: %s" % (failed, id, error))
+            self.remove_region_docs(id, assembly, chunks, self.layout)
+            return False
+        if not chunks:
+            return False  # Nothing indexed so nothing is resident
 
-        self.regions_es.index(index=self.residents_index, doc_type='default', body=doc, id=str(id))
+        # Now add dataset to residency list
+        # Make sure there is an index set up to handle whether uuids are resident
+        try:
+            self.ensure_index(self.residents_index, 'default', {'default': {"enabled": False}})
+            self.regions_es.index(index=self.residents_index, doc_type='default', id=str(id),
+                                  body=self.residency_doc(id, assembly, assay_term_name, chunks, source))
+        except:
+            self.remove_region_docs(id, assembly, chunks, self.layout)
+            raise
         return True
 
     def add_encoded_file_to_regions_es(self, request, assay_term_name, afile):
@@ -620,45 +915,30 @@ class RegionIndexer(Indexer):
         ##else:  Other file types?
 
         ### Works with http://www.encodeproject.org
-        # Note: this reads the file into an in-memory byte stream.  If files get too large,
-        # We could replace this with writing a temp file, then reading it via gzip and tsvreader.
+        # Note: the body is decompressed and parsed as it streams in, and each chrom is sent to regions es
+        # in docs and bulk requests of at most about self.flush_size positions, so memory does not grow with file size.
         urllib3.disable_warnings()
         http = urllib3.PoolManager(
             cert_reqs='CERT_REQUIRED',
             ca_certs=certifi.where()
         )
-        r = http.request('GET', href)
-        if r.status != 200:
-            log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
-            return False
-        file_in_mem = io.BytesIO()
-        file_in_mem.write(r.data)
-        file_in_mem.seek(0)
-        r.release_conn()
+        r = http.request('GET', href, preload_content=False)
+        try:
+            if r.status != 200:
+                log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
+                return False
 
-        file_data = {}
-        if afile['file_format'] == 'bed':
-            # NOTE: requests doesn't require gzip but http.request does.
-            with gzip.open(file_in_mem, mode='rt') as file:  # localhost:8000 would not require localhost
-                for row in tsvreader(file):
-                    chrom, start, end = row[0].lower(), int(row[1]), int(row[2])
-                    if isinstance(start, int) and isinstance(end, int):
-                        if chrom in file_data:
-                            file_data[chrom].append({
-                                'start': start + 1,
-                                'end': end + 1
-                            })
-                        else:
-                            file_data[chrom] = [{'start': start + 1, 'end': end + 1}]
-                    else:
-                        log.warn('positions are not integers, will not index file')
-        #else:  Other file types?
-
-        if file_data:
-            if self.test_instance:
-                chr1 = file_data['chr1']
-                file_data.clear()
-                file_data['chr1'] = chr1
-            return self.add_to_regions_es(afile['uuid'], assembly, assay_term_name, file_data, 'encoded')
+            if afile['file_format'] != 'bed':
+                return False  # Other file types?
 
-        return False
+            # NOTE: requests doesn't require gzip but http.request does.
+            with io.TextIOWrapper(gzip.GzipFile(fileobj=r, mode='rb')) as file:
+                columns = bed_regions(file, self.flush_size)
+                if self.test_instance:
+                    columns = (column for column in columns if column[0] == 'chr1')
+                if self.peak_store is not None:
+                    return self.peak_store.add(afile['uuid'], assembly, assay_term_name, columns, 'encoded')
+                regions = bed_positions(columns)
+                return self.add_to_regions_es(afile['uuid'], assembly, assay_term_name, regions, 'encoded')
+        finally:
+            r.release_conn()
@@ -4,8 +4,18 @@ from snovault import TYPES
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
 from snovault.elasticsearch.indexer import MAX_CLAUSES_FOR_ES
 from .batch_download import get_peak_metadata_links
+from .ensembl_resolver import (
+    ENSEMBL_RESOLVER,
+    _GENOME_TO_SPECIES,
+)
+from .peak_store import PEAK_STORE
+from .region_indexer import (
+    overlapping_bins,
+    region_doc_uuid,
+    region_index,
+)
 from collections import OrderedDict
-import requests
+from elasticsearch.helpers import scan
 from urllib.parse import urlencode
 
 import logging
@@ -15,8 +25,6 @@ import re
 log = logging.getLogger(__name__)
 
 
-_ENSEMBL_URL = 'http://rest.ensembl.org/'
-
 _REGION_FIELDS = [
     'embedded.files.uuid',
     'embedded.files.accession',
@@ -40,13 +48,6 @@ _FACETS = [
     ('files.file_type', {'title': 'Available data'})
 ]
 
-_GENOME_TO_SPECIES = {
-    'GRCh37': 'homo_sapiens',
-    'GRCh38': 'homo_sapiens',
-    'GRCm37': 'mus_musculus',
-    'GRCm38': 'mus_musculus'
-}
-
 _GENOME_TO_ALIAS = {
     'GRCh37': 'hg19',
     'GRCh38': 'GRCh38',
@@ -54,10 +55,14 @@ _GENOME_TO_ALIAS = {
     'GRCm38': 'mm10'
 }
 
+# Most files a binned layout region search aggregates peaks for
+BINNED_FILES_SIZE = 99999
+
 
 def includeme(config):
     config.add_route('region-search', '/region-search{slash:/?}')
     config.add_route('suggest', '/suggest{slash:/?}')
+    config.include('.ensembl_resolver')
     config.scan(__name__)
 
 
@@ -132,6 +137,74 @@ def get_peak_query(start, end, with_inner_hits=False, within_peaks=False):
     return query
 
 
+def get_binned_peak_query(start, end):
+    """
+    return peak query for the binned regions layout
+    """
+    start = int(start)
+    end = int(end)
+    # Widened by a base each side so peaks only touching the range still share a bin with it
+    return {
+        'query': {
+            'bool': {
+                'filter': [
+                    {'terms': {'bin': overlapping_bins(max(start - 1, 0), end + 1)}},
+                    {'range': {'start': {'lte': end}}},
+                    {'range': {'end': {'gte': start}}}
+                ]
+            }
+        },
+        '_source': ['uuid', 'start', 'end'],
+    }
+
+
+def get_binned_files_query(start, end):
+    """
+    return a query aggregating the uuids of the files with peaks in range for the binned regions layout
+    """
+    query = get_binned_peak_query(start, end)
+    del query['_source']
+    query['aggs'] = {'files': {'terms': {'field': 'uuid', 'size': BINNED_FILES_SIZE}}}
+    return query
+
+
+def binned_file_hits(results, chromosome, assembly):
+    """
+    Per file hits shaped like the nested layout's from the files aggregation of a binned layout search
+    """
+    files = results['aggregations']['files']
+    if files.get('sum_other_doc_count'):
+        log.error("REGION_SEARCH WARNING: region with more than %d files on %s is being restricted to %d" %
+                  (BINNED_FILES_SIZE, chromosome, BINNED_FILES_SIZE))
+    return [
+        {'_index': chromosome, '_type': assembly, '_id': bucket['key']}
+        for bucket in files['buckets']
+    ]
+
+
+def group_binned_peaks(hits, chromosome, with_inner_hits=False):
+    """
+    Group the per peak hits of the binned and local layouts into per file hits shaped like the nested layout's
+    """
+    peaks = OrderedDict()
+    for hit in hits:
+        source = hit['_source']
+        peak = peaks.get(source['uuid'])
+        if peak is None:
+            peak = peaks[source['uuid']] = {
+                '_index': chromosome,
+                '_type': hit['_type'],
+                '_id': source['uuid'],
+            }
+            if with_inner_hits:
+                peak['inner_hits'] = {'positions': {'hits': {'hits': []}}}
+        if with_inner_hits:
+            peak['inner_hits']['positions']['hits']['hits'].append({
+                '_source': {'start': source['start'], 'end': source['end']}
+            })
+    return list(peaks.values())
+
+
 def sanitize_coordinates(term):
     ''' Sanitize the input string and return coordinates '''
 
@@ -170,78 +243,6 @@ def get_annotation_coordinates(es, id, assembly):
         else:
             return (chromosome, start, end)
 
-def assembly_mapper(location, species, input_assembly, output_assembly):
-    # All others
-    new_url = _ENSEMBL_URL + 'map/' + species + '/' \
-        + input_assembly + '/' + location + '/' + output_assembly \
-        + '/?content-type=application/json'
-    try:
-        new_response = requests.get(new_url).json()
-    except:
-        return('', '', '')
-    else:
-        if 'mappings' not in new_response or len(new_response['mappings']) < 1:
-            return('', '', '')
-        data = new_response['mappings'][0]['mapped']
-        chromosome = 'chr' + data['seq_region_name']
-        start = data['start']
-        end = data['end']
-        return(chromosome, start, end)
-
-
-def get_rsid_coordinates(id, assembly):
-    species = _GENOME_TO_SPECIES[assembly]
-    url = '{ensembl}variation/{species}/{id}?content-type=application/json'.format(
-        ensembl=_ENSEMBL_URL,
-        species=species,
-        id=id
-    )
-    try:
-        response = requests.get(url).json()
-    except:
-        return('', '', '')
-    else:
-        if 'mappings' not in response:
-            return('', '', '')
-        for mapping in response['mappings']:
-            if 'PATCH' not in mapping['location']:
-                location = mapping['location']
-                if mapping['assembly_name'] == assembly:
-                    chromosome, start, end = re.split(':|-', mapping['location'])
-                    return('chr' + chromosome, start, end)
-                elif assembly == 'GRCh37':
-                    return assembly_mapper(location, species, 'GRCh38', assembly)
-                elif assembly == 'GRCm37':
-                    return assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
-        return ('', '', '',)
-
-
-def get_ensemblid_coordinates(id, assembly):
-    species = _GENOME_TO_SPECIES[assembly]
-    url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
-        ensembl=_ENSEMBL_URL,
-        id=id
-    )
-    try:
-        response = requests.get(url).json()
-    except:
-        return('', '', '')
-    else:
-        location = '{chr}:{start}-{end}'.format(
-            chr=response['seq_region_name'],
-            start=response['start'],
-            end=response['end']
-        )
-        if response['assembly_name'] == assembly:
-            chromosome, start, end = re.split(':|-', location)
-            return('chr' + chromosome, start, end)
-        elif assembly == 'GRCh37':
-            return assembly_mapper(location, species, 'GRCh38', assembly)
-        elif assembly == 'GRCm37':
-            return assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
-        else:
-            return ('', '', '')
-
 def format_position(position, resolution):
     chromosome, start, end = re.split(':|-', position)
     start = int(start) - resolution
@@ -266,7 +267,8 @@ def region_search(context, request):
     }
     principals = request.effective_principals
     es = request.registry[ELASTIC_SEARCH]
-    snp_es = request.registry['snp_search']
+    snp_es = request.registry.get('snp_search')
+    resolver = request.registry[ENSEMBL_RESOLVER]
     region = request.params.get('region', '*')
     region_inside_peak_status = False
 
@@ -290,17 +292,17 @@ def region_search(context, request):
 
     if annotation != '*':
         if annotation.lower().startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(annotation, assembly)
+            chromosome, start, end = resolver.ensemblid_coordinates(annotation, assembly, es)
         else:
             chromosome, start, end = get_annotation_coordinates(es, annotation, assembly)
     elif region != '*':
         region = region.lower()
         if region.startswith('rs'):
             sanitized_region = sanitize_rsid(region)
-            chromosome, start, end = get_rsid_coordinates(sanitized_region, assembly)
+            chromosome, start, end = resolver.rsid_coordinates(sanitized_region, assembly)
             region_inside_peak_status = True
         elif region.startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(region, assembly)
+            chromosome, start, end = resolver.ensemblid_coordinates(region, assembly, es)
         elif region.startswith('chr'):
             chromosome, start, end = sanitize_coordinates(region)
     else:
@@ -315,24 +317,49 @@ def region_search(context, request):
         )
 
     # Search for peaks for the coordinates we got
+    layout = request.registry.settings.get('regions_layout', 'nested')
     try:
         # including inner hits is very slow
         # figure out how to distinguish browser requests from .embed method requests
-        if 'peak_metadata' in request.query_string:
-            peak_query = get_peak_query(start, end, with_inner_hits=True, within_peaks=region_inside_peak_status)
+        with_inner_hits = 'peak_metadata' in request.query_string
+        if layout == 'local':
+            peak_hits = request.registry[PEAK_STORE].search(
+                _GENOME_TO_ALIAS[assembly], chromosome.lower(), int(start), int(end)
+            )
+            peak_results = {'hits': {'hits': peak_hits}}
         else:
-            peak_query = get_peak_query(start, end, within_peaks=region_inside_peak_status)
-        peak_results = snp_es.search(body=peak_query,
-                                     index=chromosome.lower(),
-                                     doc_type=_GENOME_TO_ALIAS[assembly],
-                                     size=99999)
+            index = region_index(chromosome.lower(), layout)
+            if layout == 'binned' and with_inner_hits:
+                # One doc per peak, so scroll through all of them rather than stop at a page size
+                peak_hits = list(scan(snp_es, query=get_binned_peak_query(start, end),
+                                      index=index, doc_type=_GENOME_TO_ALIAS[assembly]))
+                peak_results = {'hits': {'hits': peak_hits}}
+            elif layout == 'binned':
+                peak_results = snp_es.search(body=get_binned_files_query(start, end),
+                                             index=index,
+                                             doc_type=_GENOME_TO_ALIAS[assembly],
+                                             size=0)
+                peak_results['hits']['hits'] = binned_file_hits(
+                    peak_results, chromosome.lower(), _GENOME_TO_ALIAS[assembly]
+                )
+            else:
+                peak_query = get_peak_query(start, end, with_inner_hits=with_inner_hits, within_peaks=region_inside_peak_status)
+                peak_results = snp_es.search(body=peak_query,
+                                             index=index,
+                                             doc_type=_GENOME_TO_ALIAS[assembly],
+                                             size=99999)
+        if layout == 'local' or (layout == 'binned' and with_inner_hits):
+            peak_results['hits']['hits'] = group_binned_peaks(
+                peak_results['hits']['hits'], chromosome.lower(), with_inner_hits=with_inner_hits
+            )
     except Exception:
         result['notification'] = 'Error during search'
         return result
     file_uuids = []
     for hit in peak_results['hits']['hits']:
-        if hit['_id'] not in file_uuids:
-            file_uuids.append(hit['_id'])
+        file_uuid = region_doc_uuid(hit['_id'])  # large chroms of one file span several docs
+        if file_uuid not in file_uuids:
+            file_uuids.append(file_uuid)
     file_uuids = list(set(file_uuids))
     result['notification'] = 'No results found'
 
@@ -1,22 +1,41 @@
 import csv
+import logging
 
 from collections import defaultdict
+from collections import deque
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from queue import Full
+from queue import Queue
+from threading import Event
 from encoded.reports.constants import ANNOTATION_METADATA_COLUMN_TO_FIELDS_MAPPING
 from encoded.reports.constants import METADATA_ALLOWED_TYPES
 from encoded.reports.constants import METADATA_COLUMN_TO_FIELDS_MAPPING
 from encoded.reports.constants import METADATA_AUDIT_TO_AUDIT_COLUMN_MAPPING
 from encoded.reports.constants import PUBLICATION_DATA_METADATA_COLUMN_TO_FIELDS_MAPPING
-from encoded.search_views import search_generator
+from encoded.reports.serializers import get_output_format
+from encoded.reports.serializers import gzip_chunks
+from encoded.reports.serializers import parquet_chunks
+from encoded.search_views import PAGED_SEARCH_PAGE_SIZE
+from encoded.search_views import paged_search_generator
 from encoded.vis_defines import is_file_visualizable
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.response import Response
+from pyramid.threadlocal import manager
 from pyramid.view import view_config
+from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
 from snovault.elasticsearch.searches.parsers import QueryString
 from snovault.util import simple_path_ids
 
 
+log = logging.getLogger(__name__)
+
+# Elasticsearch default for indices.query.bool.max_clause_count.
+DEFAULT_MAX_CLAUSE_COUNT = 1024
+MAX_CLAUSE_COUNT = 'max_clause_count'
+
+
 def includeme(config):
     config.add_route('metadata', '/metadata{slash:/?}')
     config.scan(__name__)
@@ -81,6 +100,65 @@ def make_file_cell(paths, file_):
     return ', '.join(sorted(set(last)))
 
 
+def path_values(obj, names):
+    # Same values in the same order as simple_path_ids(obj, '.'.join(names)).
+    values = [obj]
+    for name in names:
+        next_values = []
+        for value in values:
+            value = value.get(name)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                next_values.extend(value)
+            else:
+                next_values.append(value)
+        values = next_values
+        if not values:
+            break
+    return values
+
+
+def join_path_values(obj, split_paths):
+    # Values of the first path, each followed by the first value of every later path.
+    last = []
+    for names in split_paths:
+        cell_value = path_values(obj, names)
+        if last and cell_value:
+            first = ' ' + str(cell_value[0])
+            last = [
+                v + first
+                for v in last
+            ]
+        else:
+            last = [str(v) for v in cell_value]
+    return last
+
+
+def compile_experiment_cell(paths):
+    """Returns a function of an experiment equivalent to make_experiment_cell(paths, experiment)."""
+    split_paths = [path.split('.') for path in paths]
+    if len(split_paths) == 1:
+        names = split_paths[0]
+        return lambda experiment: ', '.join(set(map(str, path_values(experiment, names))))
+    return lambda experiment: ', '.join(set(join_path_values(experiment, split_paths)))
+
+
+def compile_file_cell(paths):
+    """Returns a function of a file equivalent to make_file_cell(paths, file_)."""
+    if len(paths) == 1 and '.' not in paths[0]:
+        name = paths[0]
+
+        def file_cell(file_):
+            value = file_.get(name, '')
+            if isinstance(value, list):
+                return ', '.join([str(v) for v in value])
+            return value
+        return file_cell
+    split_paths = [path.split('.') for path in paths]
+    return lambda file_: ', '.join(sorted(set(join_path_values(file_, split_paths))))
+
+
 def file_matches_file_params(file_, positive_file_param_list):
     # Expects file_param_list where 'files.' has been
     # stripped off of key (files.file_type -> file_type)
@@ -134,6 +212,8 @@ class MetadataReport:
         self.header = []
         self.experiment_column_to_fields_mapping = OrderedDict()
         self.file_column_to_fields_mapping = OrderedDict()
+        self.experiment_column_to_cell = OrderedDict()
+        self.file_column_to_cell = OrderedDict()
         self.visualizable_only = self.query_string.is_param('option', 'visualizable')
         self.raw_only = self.query_string.is_param('option', 'raw')
         self.csv = CSVGenerator()
@@ -158,6 +238,16 @@ class MetadataReport:
             else:
                 self.experiment_column_to_fields_mapping[column] = fields
 
+    def _compile_column_to_cell_mappings(self):
+        self.experiment_column_to_cell = OrderedDict(
+            (column, compile_experiment_cell(fields))
+            for column, fields in self.experiment_column_to_fields_mapping.items()
+        )
+        self.file_column_to_cell = OrderedDict(
+            (column, compile_file_cell(fields))
+            for column, fields in self.file_column_to_fields_mapping.items()
+        )
+
     def _set_positive_file_param_list(self):
         self.positive_file_param_list = {
             k.replace('files.', ''): v
@@ -212,6 +302,7 @@ class MetadataReport:
     def _build_query_string(self):
         self.query_string.drop('limit')
         self.query_string.drop('option')
+        self.query_string.drop('format')
         self.query_string.extend(
             self._get_default_params()
             + self._get_field_params()
@@ -230,6 +321,7 @@ class MetadataReport:
     def _initialize_report(self):
         self._build_header()
         self._split_column_and_fields_by_experiment_and_file()
+        self._compile_column_to_cell_mappings()
         self._set_positive_file_param_list()
 
     def _build_params(self):
@@ -246,7 +338,7 @@ class MetadataReport:
         return request
 
     def _get_search_results_generator(self):
-        return search_generator(
+        return paged_search_generator(
             self._build_new_request()
         )
 
@@ -262,15 +354,15 @@ class MetadataReport:
 
     def _get_experiment_data(self, experiment):
         return {
-            column: make_experiment_cell(fields, experiment)
-            for column, fields in self.experiment_column_to_fields_mapping.items()
+            column: cell(experiment)
+            for column, cell in self.experiment_column_to_cell.items()
         }
 
     def _get_file_data(self, file_):
         file_['href'] = self.request.host_url + file_['href']
         return {
-            column: make_file_cell(fields, file_)
-            for column, fields in self.file_column_to_fields_mapping.items()
+            column: cell(file_)
+            for column, cell in self.file_column_to_cell.items()
         }
 
     def _get_audit_data(self, grouped_audits_for_file, grouped_other_audits):
@@ -296,6 +388,10 @@ class MetadataReport:
 
     def _generate_rows(self):
         yield self.csv.writerow(self.header)
+        for row in self._generate_row_values():
+            yield self.csv.writerow(row)
+
+    def _generate_row_values(self):
         for experiment in self._get_search_results_generator()['@graph']:
             if not experiment.get('files', []):
                 continue
@@ -312,14 +408,25 @@ class MetadataReport:
                     grouped_other_audits
                 )
                 file_data.update(audit_data)
-                yield self.csv.writerow(
-                    self._output_sorted_row(experiment_data, file_data)
-                )
+                yield self._output_sorted_row(experiment_data, file_data)
 
     def generate(self):
         self._validate_request()
+        output_format = get_output_format(self.request)
         self._initialize_report()
         self._build_params()
+        if output_format == 'parquet':
+            return Response(
+                content_type='application/octet-stream',
+                app_iter=parquet_chunks(self.header, self._generate_row_values()),
+                content_disposition='attachment;filename=metadata.parquet'
+            )
+        if output_format == 'tsv.gz':
+            return Response(
+                content_type='application/gzip',
+                app_iter=gzip_chunks(self._generate_rows()),
+                content_disposition='attachment;filename=metadata.tsv.gz'
+            )
         return Response(
              content_type='text/tsv',
              app_iter=self._generate_rows(),
@@ -444,8 +551,7 @@ class PublicationDataMetadataReport(MetadataReport):
         return bsg.results()
 
     # Overrides parent.
-    def _generate_rows(self):
-        yield self.csv.writerow(self.header)
+    def _generate_row_values(self):
         for experiment in self._get_search_results_generator()['@graph']:
             self.file_at_ids = experiment.get('files', [])
             if not self.file_at_ids:
@@ -455,9 +561,7 @@ class PublicationDataMetadataReport(MetadataReport):
                 if self._should_not_report_file(file_):
                     continue
                 file_data = self._get_file_data(file_)
-                yield self.csv.writerow(
-                    self._output_sorted_row(experiment_data, file_data)
-                )
+                yield self._output_sorted_row(experiment_data, file_data)
 
 
 class CSVGenerator:
@@ -484,18 +588,25 @@ class BatchedSearchGenerator:
         ('limit', 'all')
     ]
 
-    def __init__(self, request, batch_field='@id', batch_size=5000):
+    def __init__(self, request, batch_field='@id', batch_size=5000, max_workers=4):
         self.request = request
         self.batch_field = batch_field
         self.batch_size = batch_size
+        self.max_workers = max_workers
         self.query_string = QueryString(request)
         self.param_list = self.query_string.group_values_by_key()
         self.batch_param_values = self.param_list.get(batch_field, []).copy()
 
+    def _get_batch_size(self):
+        # Batches over the cluster's clause limit get rejected once
+        # Elasticsearch expands the batch values into boolean clauses.
+        return min(self.batch_size, get_max_clause_count(self.request.registry))
+
     def _make_batched_values_from_batch_param_values(self):
         end = len(self.batch_param_values)
-        for start in range(0, end, self.batch_size):
-            yield self.batch_param_values[start:min(start + self.batch_size, end)]
+        batch_size = self._get_batch_size()
+        for start in range(0, end, batch_size):
+            yield self.batch_param_values[start:min(start + batch_size, end)]
 
     def _make_batched_params_from_batched_values(self, batched_values):
         return [
@@ -514,13 +625,94 @@ class BatchedSearchGenerator:
         request.registry = self.request.registry
         return request
 
-    def results(self):
-        if not self.batch_param_values:
-            yield from search_generator(self._build_new_request([]))['@graph']
+    def _put_page(self, pages, page, stop):
+        # Waits for the consumer to take the previous page, unless it went away.
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _search_batch(self, request, pages, stop):
+        # Runs in a worker thread, which has none of the request's threadlocals.
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            page = []
+            for item in paged_search_generator(request)['@graph']:
+                page.append(item)
+                if len(page) >= PAGED_SEARCH_PAGE_SIZE:
+                    if not self._put_page(pages, page, stop):
+                        return
+                    page = []
+            if page:
+                self._put_page(pages, page, stop)
+        finally:
+            manager.pop()
+            # Ends the batch for the consumer, which raises any error from the future.
+            self._put_page(pages, None, stop)
+
+    def _batch_results(self, future, pages):
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            yield from page
+        future.result()
+
+    def _get_batch_requests(self):
         for batched_values in self._make_batched_values_from_batch_param_values():
             batched_params = self._make_batched_params_from_batched_values(batched_values)
-            request = self._build_new_request(batched_params)
-            yield from search_generator(request)['@graph']
+            yield self._build_new_request(batched_params)
+
+    def results(self):
+        if not self.batch_param_values:
+            yield from paged_search_generator(self._build_new_request([]))['@graph']
+            return
+        requests = self._get_batch_requests()
+        # A single capped batch gains nothing from the worker threads.
+        if self.max_workers <= 1 or len(self.batch_param_values) <= self._get_batch_size():
+            for request in requests:
+                yield from paged_search_generator(request)['@graph']
+            return
+        # Searches run ahead of the consumer by at most max_workers batches, each
+        # handing over a page at a time and holding at most one page it has not
+        # taken, and batches are yielded in order so the output stays deterministic.
+        stop = Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            try:
+                for request in requests:
+                    pages = Queue(maxsize=1)
+                    pending.append((executor.submit(self._search_batch, request, pages, stop), pages))
+                    if len(pending) >= self.max_workers:
+                        yield from self._batch_results(*pending.popleft())
+                while pending:
+                    yield from self._batch_results(*pending.popleft())
+            finally:
+                stop.set()
+
+
+def get_max_clause_count(registry):
+    """
+    Returns the smallest indices.query.bool.max_clause_count of the
+    Elasticsearch nodes, looked up once per registry.
+    """
+    if MAX_CLAUSE_COUNT not in registry:
+        max_clause_count = DEFAULT_MAX_CLAUSE_COUNT
+        es = registry.get(ELASTIC_SEARCH)
+        if es is not None:
+            try:
+                nodes = es.nodes.info(metric='settings', flat_settings=True)['nodes']
+                max_clause_count = min(
+                    int(node['settings'].get('indices.query.bool.max_clause_count', DEFAULT_MAX_CLAUSE_COUNT))
+                    for node in nodes.values()
+                )
+            except Exception:
+                log.warning('Could not get max_clause_count from Elasticsearch', exc_info=True)
+        registry[MAX_CLAUSE_COUNT] = max_clause_count
+    return registry[MAX_CLAUSE_COUNT]
 
 
 def _get_metadata(context, request):
@@ -0,0 +1,115 @@
+import zlib
+
+import pyarrow
+import pyarrow.parquet
+
+from pyramid.httpexceptions import HTTPBadRequest
+
+
+# Output formats of the TSV reports, chosen with format=.
+OUTPUT_FORMATS = (
+    'tsv',
+    'tsv.gz',
+    'parquet',
+)
+# Uncompressed bytes gathered before compressing a gzip chunk.
+GZIP_CHUNK_SIZE = 64 * 1024
+# Rows in each parquet row group.
+PARQUET_BATCH_SIZE = 10000
+
+
+def get_output_format(request):
+    output_format = request.params.get('format', 'tsv').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPBadRequest(
+            explanation='"{}" not a valid format, use one of {}.'.format(
+                output_format,
+                ', '.join(OUTPUT_FORMATS)
+            )
+        )
+    return output_format
+
+
+def gzip_chunks(chunks, chunk_size=GZIP_CHUNK_SIZE, compresslevel=6):
+    """Gzip an iterable of byte strings, yielding compressed chunks as they fill."""
+    # wbits=31 writes the gzip header and trailer.
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= chunk_size:
+            compressed = compressor.compress(b''.join(pending))
+            pending = []
+            pending_size = 0
+            if compressed:
+                yield compressed
+    yield compressor.compress(b''.join(pending)) + compressor.flush()
+
+
+class ChunkSink:
+    """Write-only file that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(header, rows, batch_size=PARQUET_BATCH_SIZE, metadata=None):
+    """
+    Write rows as parquet with one string column per header column,
+    yielding the file in chunks as each batch of rows is written.
+    """
+    schema = pyarrow.schema(
+        [pyarrow.field(column, pyarrow.string()) for column in header],
+        metadata=metadata
+    )
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+
+    def write_batch(columns):
+        writer.write_table(
+            pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=pyarrow.string()) for column in columns],
+                schema=schema
+            )
+        )
+
+    columns = [[] for _ in header]
+    batch_rows = 0
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(None if value is None else str(value))
+        batch_rows += 1
+        if batch_rows >= batch_size:
+            write_batch(columns)
+            columns = [[] for _ in header]
+            batch_rows = 0
+            data = sink.drain()
+            if data:
+                yield data
+    if batch_rows:
+        write_batch(columns)
+    writer.close()
+    yield sink.drain()
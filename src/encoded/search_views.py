@@ -29,6 +29,7 @@ from snovault.elasticsearch.searches.fields import TitleResponseField
 from snovault.elasticsearch.searches.fields import TypeOnlyClearFiltersResponseField
 from snovault.elasticsearch.searches.fields import TypeResponseField
 from snovault.elasticsearch.searches.parsers import ParamsParser
+from snovault.elasticsearch.searches.parsers import QueryString
 from snovault.elasticsearch.searches.responses import FieldedGeneratorResponse
 from snovault.elasticsearch.searches.responses import FieldedResponse
 
@@ -50,6 +51,11 @@ def includeme(config):
     config.scan(__name__)
 
 
+# Hits per page of a paged_search_generator and the stable sort it pages on.
+PAGED_SEARCH_PAGE_SIZE = 1000
+PAGED_SEARCH_SORT_FIELD = 'embedded.uuid'
+
+
 DEFAULT_ITEM_TYPES = [
     'AntibodyLot',
     'Award',
@@ -150,6 +156,102 @@ def search_generator(request):
     return fgr.render()
 
 
+class PagedSearchResponseField(BasicSearchResponseField):
+    '''
+    Like BasicSearchResponseField but sorted on PAGED_SEARCH_SORT_FIELD and
+    starting after the search_after uuid, for one page of a paged search.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.search_after = kwargs.pop('search_after', None)
+        super().__init__(*args, **kwargs)
+
+    def _build_query(self):
+        super()._build_query()
+        self.query = self.query.sort(
+            {PAGED_SEARCH_SORT_FIELD: {'order': 'asc'}}
+        )
+        if self.search_after is not None:
+            self.query = self.query.extra(
+                search_after=[self.search_after]
+            )
+
+
+class PagedSearchGenerator:
+    '''
+    For internal use (no view). Like search_generator but pulls page_size hits
+    at a time in uuid order with search_after, so no scroll context stays open
+    for a whole export. cursor is the uuid of the last hit yielded; passing it
+    back in resumes right after that hit.
+    '''
+
+    def __init__(self, request, page_size=PAGED_SEARCH_PAGE_SIZE, cursor=None):
+        self.request = request
+        self.page_size = page_size
+        self.cursor = cursor
+        self.query_string = QueryString(request)
+        self.query_string.drop('limit')
+        self.query_string.extend(
+            [
+                ('limit', str(page_size))
+            ]
+        )
+        fields = self.query_string.group_values_by_key().get('field', [])
+        # Paging needs the uuid of every hit, even when fields leave it out.
+        self.drop_uuid = bool(fields) and 'uuid' not in fields
+        if self.drop_uuid:
+            self.query_string.extend(
+                [
+                    ('field', 'uuid')
+                ]
+            )
+
+    def _build_page_request(self):
+        request = self.query_string.get_request_with_new_query_string()
+        request.path_info = self.request.path_info
+        request.registry = self.request.registry
+        return request
+
+    def _get_page(self):
+        fgr = FieldedGeneratorResponse(
+            _meta={
+                'params_parser': ParamsParser(self._build_page_request())
+            },
+            response_fields=[
+                PagedSearchResponseField(
+                    default_item_types=DEFAULT_ITEM_TYPES,
+                    search_after=self.cursor
+                )
+            ]
+        )
+        return fgr.render()['@graph']
+
+    def results(self):
+        while True:
+            hits = 0
+            for item in self._get_page():
+                hits += 1
+                self.cursor = item['uuid']
+                if self.drop_uuid:
+                    del item['uuid']
+                yield item
+            if hits < self.page_size:
+                return
+
+    def render(self):
+        return {
+            '@graph': self.results()
+        }
+
+
+def paged_search_generator(request, page_size=PAGED_SEARCH_PAGE_SIZE, cursor=None):
+    '''
+    For internal use (no view). Drop-in for search_generator in bulk exports
+    that returns the hits of a PagedSearchGenerator in @graph field.
+    '''
+    return PagedSearchGenerator(request, page_size=page_size, cursor=cursor).render()
+
+
 @view_config(route_name='report', request_method='GET', permission='search')
 def report(context, request):
     fr = FieldedResponse(
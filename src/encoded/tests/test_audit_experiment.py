@@ -3848,3 +3848,58 @@ def test_audit_experiment_analysis_files(
         error['category'] == 'inconsistent analysis files'
         for error in collect_audit_errors(res)
     )
+
+
+def test_create_files_index():
+    from encoded.audit.experiment import (
+        create_files_mapping,
+        create_files_index,
+        get_metrics,
+        get_pipeline_objects,
+    )
+    pipeline = {'@id': '/pipelines/ENCPL001AAA/', 'title': 'DNase-HS pipeline'}
+    qm = {'uuid': 'qm-1', '@type': ['HotspotQualityMetric', 'QualityMetric']}
+    fastqs = [
+        {'@id': '/files/ENCFF00{}FQ/'.format(i), 'accession': 'ENCFF00{}FQ'.format(i),
+         'status': 'released', 'file_format': 'fastq', 'output_type': 'reads',
+         'output_category': 'raw data', 'technical_replicates': [rep]}
+        for i, rep in enumerate(['1_1', '2_1', '1_1'])
+    ]
+    bam = {'@id': '/files/ENCFF000BAM/', 'accession': 'ENCFF000BAM',
+           'status': 'released', 'file_format': 'bam', 'output_type': 'alignments',
+           'output_category': 'alignment', 'assembly': 'GRCh38',
+           'derived_from': [fastqs[0]['@id'], fastqs[2]['@id'], '/files/ENCFF404XXX/'],
+           'analysis_step_version': {'analysis_step': {'pipelines': [pipeline]}},
+           'quality_metrics': [qm]}
+    files_structure = create_files_mapping(fastqs + [bam], [])
+    files_index = create_files_index(files_structure)
+    assert files_index['derived_from'][bam['@id']] == [fastqs[0], fastqs[2]]
+    assert files_index['fastqs_by_replicate']['technical_replicates']['1_1'] == [fastqs[0], fastqs[2]]
+    assert files_index['pipelines'][bam['@id']] == [pipeline]
+    assert files_index['metrics'][bam['@id']]['HotspotQualityMetric'] == [qm]
+    assert get_metrics([bam], 'HotspotQualityMetric', 'GRCh38', files_index=files_index) == [qm]
+    assert get_metrics([bam], 'HotspotQualityMetric', 'mm10', files_index=files_index) == []
+    assert get_pipeline_objects([bam], files_index) == [pipeline]
+
+
+def test_is_outdated_bams_replicate_uses_files_index():
+    from encoded.audit.experiment import (
+        create_files_mapping,
+        is_outdated_bams_replicate,
+    )
+    fastqs = [
+        {'@id': '/files/ENCFF00{}FQ/'.format(i), 'accession': 'ENCFF00{}FQ'.format(i),
+         'status': 'released', 'file_format': 'fastq', 'output_type': 'reads',
+         'output_category': 'raw data', 'technical_replicates': ['1_1']}
+        for i in range(2)
+    ]
+    bam = {'@id': '/files/ENCFF000BAM/', 'accession': 'ENCFF000BAM',
+           'status': 'released', 'file_format': 'bam', 'output_type': 'alignments',
+           'output_category': 'alignment', 'technical_replicates': ['1_1'],
+           'derived_from': [fastqs[0]['@id']]}
+    files_structure = create_files_mapping(fastqs + [bam], [])
+    assert is_outdated_bams_replicate(bam, files_structure, 'DNase-seq') is True
+    assert 'files_index' in files_structure
+    bam['derived_from'].append(fastqs[1]['@id'])
+    files_structure = create_files_mapping(fastqs + [bam], [])
+    assert is_outdated_bams_replicate(bam, files_structure, 'DNase-seq') is False
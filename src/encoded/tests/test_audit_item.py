@@ -95,3 +95,23 @@ def test_audit_item_status_level_dict_contains_all_statuses_in_schema(testapp):
             # If this assertion fails update STATUS_LEVEL dict with new statuses in schema.
             assert not schema_dict_diff, '{} in {} schema but not in STATUS_LEVEL dict.'.format(
                 schema_dict_diff, title)
+
+
+def test_audit_item_schema_validator_cached(mocker):
+    from encoded.audit import item
+    mocker.patch.object(item, '_schema_validators', item.threading.local())
+    schema_validator_class = mocker.patch.object(item, 'SchemaValidator')
+    mocker.patch.object(item, 'NoRemoteResolver')
+    type_info = mocker.MagicMock()
+    type_info.name = 'Organism'
+    type_info.schema_version = '5'
+    schema = {'type': 'object'}
+    validator = item.schema_validator(type_info, schema)
+    assert item.schema_validator(type_info, schema) is validator
+    assert schema_validator_class.call_count == 1
+    # a reloaded schema or a new schema version gets a new validator
+    item.schema_validator(type_info, {'type': 'object'})
+    assert schema_validator_class.call_count == 2
+    type_info.schema_version = '6'
+    item.schema_validator(type_info, schema)
+    assert schema_validator_class.call_count == 3
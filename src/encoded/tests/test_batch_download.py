@@ -10,6 +10,9 @@ from encoded.batch_download import format_row
 from encoded.batch_download import _convert_camel_to_snake
 from encoded.batch_download import ELEMENT_CHUNK_SIZE
 from encoded.batch_download import get_biosample_accessions
+from encoded.batch_download import peak_files_metadata
+from encoded.batch_download import format_tsv_row
+from encoded.batch_download import peak_metadata
 
 
 param_list_1 = {'files.file_type': 'fastq'}
@@ -101,6 +104,69 @@ def test_get_biosample_accessions_finds_replicate_loop():
     assert expected == target
 
 
+def test_peak_files_metadata_embeds_each_file_and_experiment_once():
+    objects = {
+        'f1': {'uuid': 'f1', 'accession': 'ENCFF001', 'dataset': '/experiments/ENCSR001/'},
+        'f2': {'uuid': 'f2', 'accession': 'ENCFF002', 'dataset': '/experiments/ENCSR001/'},
+        '/experiments/ENCSR001/': {
+            'accession': 'ENCSR001',
+            'assay_term_name': 'ChIP-seq',
+            'target': {'label': 'CTCF'},
+            'files': [{'uuid': 'f1'}, {'uuid': 'f2'}],
+            'replicates': [{'library': {'biosample': {'accession': 'ENCBS001'}}}]
+        },
+    }
+    request = mock.Mock()
+    request.embed.side_effect = lambda path: objects[path]
+    hits = {'hits': {'hits': [{'_source': {'start': 10, 'end': 20}}]}}
+    results = {
+        '@graph': [{'files': [{'uuid': 'f1'}, {'uuid': 'f2'}]}],
+        'peaks': [
+            {'_id': 'f1', '_index': 'chr1', 'inner_hits': {'positions': hits}},
+            {'_id': 'f1:1', '_index': 'chr1', 'inner_hits': {'positions': hits}},
+            {'_id': 'f2', '_index': 'chr1', 'inner_hits': {'positions': hits}},
+            {'_id': 'f3', '_index': 'chr1', 'inner_hits': {'positions': hits}},
+        ]
+    }
+    metadata = [file_metadata for (row, file_metadata) in peak_files_metadata(request, results)]
+    assert [m['file.accession'] for m in metadata] == ['ENCFF001', 'ENCFF001', 'ENCFF002']
+    assert metadata[0]['biosample.accession'] == 'ENCBS001'
+    assert metadata[0]['target.label'] == 'CTCF'
+    assert [c[0][0] for c in request.embed.call_args_list] == ['f1', '/experiments/ENCSR001/', 'f2']
+
+
+def test_peak_metadata_embeds_before_returning():
+    objects = {
+        'f1': {'uuid': 'f1', 'accession': 'ENCFF001', 'dataset': '/experiments/ENCSR001/'},
+        '/experiments/ENCSR001/': {
+            'accession': 'ENCSR001',
+            'assay_term_name': 'ChIP-seq',
+            'files': [{'uuid': 'f1'}],
+            'replicates': [{'library': {'biosample': {'accession': 'ENCBS001'}}}]
+        },
+    }
+    hits = {'hits': {'hits': [{'_source': {'start': 10, 'end': 20}}]}}
+    results = {
+        '@graph': [{'files': [{'uuid': 'f1'}]}],
+        'peaks': [{'_id': 'f1', '_index': 'chr1', 'inner_hits': {'positions': hits}}]
+    }
+    request = mock.Mock()
+    request.matchdict = {'search_params': 'regions=chr1:1-100&genome=GRCh38'}
+    request.url = 'http://localhost/peak_metadata/regions=chr1:1-100/peak_metadata.tsv'
+    request.embed.side_effect = lambda path, as_user=None: results if path.startswith('/region-search/') else objects[path]
+    response = peak_metadata(None, request)
+    assert request.embed.call_count == 3
+    request.embed.side_effect = AssertionError('embed after the view returned')
+    assert b''.join(response.app_iter) == (
+        b'assay_term_name\tcoordinates\ttarget.label\tbiosample.accession\tfile.accession\texperiment.accession\r\n'
+        b'ChIP-seq\tchr1:10-20\t\tENCBS001\tENCFF001\tENCSR001\r\n'
+    )
+
+
+def test_format_tsv_row():
+    assert format_tsv_row(['ChIP-seq', 'chr1:10-20', None]) == b'ChIP-seq\tchr1:10-20\t\r\n'
+
+
 def test_format_row():
     columns = ['col1', 'col2', 'col3']
     expected = b'col1\tcol2\tcol3\r\n'
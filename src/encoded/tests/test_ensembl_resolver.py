@@ -0,0 +1,99 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+
+STUB_RESPONSES = {
+    '/variation/homo_sapiens/rs3768324': {
+        'mappings': [
+            {'location': 'CHR_HSCHR1_PATCH:100-100', 'assembly_name': 'GRCh38'},
+            {'location': '1:39492462-39492462', 'assembly_name': 'GRCh38'},
+        ]
+    },
+    '/lookup/id/ENSG00000170345': {
+        'seq_region_name': '14', 'start': 75278828, 'end': 75282230, 'assembly_name': 'GRCh38'
+    },
+}
+
+
+class StubEnsemblHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        response = STUB_RESPONSES.get(self.path.split('?')[0])
+        body = json.dumps(response if response is not None else {'error': 'not found'}).encode('utf-8')
+        self.send_response(200 if response is not None else 400)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.yield_fixture
+def stub_ensembl():
+    server = HTTPServer(('127.0.0.1', 0), StubEnsemblHandler)
+    server.paths = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_url(server):
+    return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def test_ensembl_resolver_rsid_cached(stub_ensembl):
+    from encoded.ensembl_resolver import EnsemblResolver
+    resolver = EnsemblResolver(ensembl_url=stub_url(stub_ensembl))
+    assert resolver.rsid_coordinates('rs3768324', 'GRCh38') == ('chr1', '39492462', '39492462')
+    assert resolver.rsid_coordinates('rs3768324', 'GRCh38') == ('chr1', '39492462', '39492462')
+    assert len(stub_ensembl.paths) == 1
+
+
+def test_ensembl_resolver_not_found_not_cached(stub_ensembl):
+    from encoded.ensembl_resolver import EnsemblResolver
+    resolver = EnsemblResolver(ensembl_url=stub_url(stub_ensembl))
+    assert resolver.rsid_coordinates('rs1', 'GRCh38') == ('', '', '')
+    assert resolver.rsid_coordinates('rs1', 'GRCh38') == ('', '', '')
+    assert len(stub_ensembl.paths) == 2
+
+
+def test_ensembl_resolver_disk_cache(stub_ensembl, tmpdir):
+    from encoded.ensembl_resolver import EnsemblResolver
+    cache_path = str(tmpdir.join('ensembl.sqlite'))
+    resolver = EnsemblResolver(ensembl_url=stub_url(stub_ensembl), cache_path=cache_path)
+    assert resolver.ensemblid_coordinates('ensg00000170345', 'GRCh38') == ('chr14', '75278828', '75282230')
+    # Another worker shares the on disk cache
+    other = EnsemblResolver(ensembl_url=stub_url(stub_ensembl), cache_path=cache_path)
+    assert other.ensemblid_coordinates('ENSG00000170345', 'GRCh38') == ('chr14', '75278828', '75282230')
+    assert len(stub_ensembl.paths) == 1
+
+
+def test_ensembl_resolver_annotations_first(stub_ensembl, mocker):
+    from encoded.ensembl_resolver import EnsemblResolver
+    resolver = EnsemblResolver(ensembl_url=stub_url(stub_ensembl))
+    es = mocker.MagicMock()
+    es.search.return_value = {'hits': {'hits': [{'_source': {'annotations': [
+        {'assembly_name': 'GRCh37', 'chromosome': '14', 'start': 1, 'end': 2},
+        {'assembly_name': 'GRCh38', 'chromosome': '14', 'start': 75278828, 'end': 75282230},
+    ]}}]}}
+    assert resolver.ensemblid_coordinates('ENSG00000170345', 'GRCh38', es) == ('chr14', 75278828, 75282230)
+    assert stub_ensembl.paths == []
+
+
+def test_ensembl_resolver_lru_bound():
+    from encoded.ensembl_resolver import CoordinateCache
+    cache = CoordinateCache(capacity=2)
+    cache.set('a', ('chr1', 1, 2))
+    cache.set('b', ('chr1', 3, 4))
+    assert cache.get('a') == ('chr1', 1, 2)
+    cache.set('c', ('chr1', 5, 6))
+    assert cache.get('b') is None
+    assert cache.get('a') == ('chr1', 1, 2)
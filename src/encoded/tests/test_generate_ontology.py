@@ -0,0 +1,47 @@
+def _terms(edges):
+    return {
+        term: {'data': children, 'data_with_develops_from': children}
+        for term, children in edges.items()
+    }
+
+
+def test_generate_ontology_closures_follow_cycles():
+    from encoded.commands.generate_ontology import getClosures
+    slim_index = {'UBERON:0000955': 0, 'UBERON:0000948': 1, 'CL:0000236': 2}
+    terms = _terms({
+        'A': ['B'],
+        'B': ['C', 'UBERON:0000955'],
+        'C': ['B'],
+        'D': ['UBERON:0000948'],
+        'UBERON:0000955': [],
+        'UBERON:0000948': ['E'],
+        'E': ['CL:0000236'],
+    })
+    closures = getClosures(terms, 'data', slim_index)
+    assert closures['A'] == closures['B'] == closures['C'] == 0b001
+    assert closures['D'] == closures['UBERON:0000948'] == 0b110
+    assert closures['E'] == 0b100
+    assert 'CL:0000236' not in closures
+
+
+def test_generate_ontology_get_slims():
+    from encoded.commands.generate_ontology import (
+        getClosures,
+        getSlimBits,
+        getSlimIndex,
+        getSlims,
+    )
+    slim_index = getSlimIndex()
+    terms = _terms({
+        'EFO:0000001': ['CL:0000236', 'EFO:0001640', 'UBERON:0000178'],
+        'CL:0000236': [],
+        'EFO:0001640': [],
+        'UBERON:0000178': [],
+    })
+    for term, closure in getClosures(terms, 'data', slim_index).items():
+        terms[term]['closure'] = closure
+        terms[term]['closure_with_develops_from'] = closure
+    slim_bits = getSlimBits(slim_index)
+    assert getSlims('EFO:0000001', terms, 'cell', slim_bits) == ['B cell', 'B cell']
+    assert getSlims('EFO:0000001', terms, 'organ', slim_bits) == ['blood']
+    assert getSlims('EFO:0000001', terms, 'developmental', slim_bits) == []
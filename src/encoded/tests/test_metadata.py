@@ -451,6 +451,28 @@ def test_metadata_make_file_cell():
     assert make_file_cell(['file_format', 'file_format_type'], file_()) == 'bed idr_ranked_peak'
 
 
+def test_metadata_compiled_cells_match_make_cell():
+    from encoded.reports.metadata import compile_experiment_cell
+    from encoded.reports.metadata import compile_file_cell
+    from encoded.reports.metadata import make_experiment_cell
+    from encoded.reports.metadata import make_file_cell
+    from encoded.reports.constants import ANNOTATION_METADATA_COLUMN_TO_FIELDS_MAPPING
+    from encoded.reports.constants import METADATA_COLUMN_TO_FIELDS_MAPPING
+    from encoded.reports.constants import PUBLICATION_DATA_METADATA_COLUMN_TO_FIELDS_MAPPING
+    for mapping in [
+            METADATA_COLUMN_TO_FIELDS_MAPPING,
+            ANNOTATION_METADATA_COLUMN_TO_FIELDS_MAPPING,
+            PUBLICATION_DATA_METADATA_COLUMN_TO_FIELDS_MAPPING]:
+        for column, fields in mapping.items():
+            if fields[0].startswith('files'):
+                fields = [field.replace('files.', '') for field in fields]
+                assert compile_file_cell(fields)(file_()) == make_file_cell(fields, file_()), column
+            else:
+                actual = compile_experiment_cell(fields)(embedded_experiment())
+                expected = make_experiment_cell(fields, embedded_experiment())
+                assert sorted(actual.split(', ')) == sorted(expected.split(', ')), column
+
+
 def test_metadata_file_matches_file_params():
     from encoded.reports.metadata import file_matches_file_params
     file_param_list = {'assembly': ['GRCh38']}
@@ -1721,6 +1743,96 @@ def test_metadata_batched_search_generator_results(index_workbook, dummy_request
         assert len(result.keys()) == 3
 
 
+def test_metadata_batched_search_generator_results_in_order(dummy_request, mocker):
+    from encoded.reports.metadata import BatchedSearchGenerator
+    at_ids = ['/experiments/ENCSR{:03d}AAA/'.format(i) for i in range(10)]
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment' + ''.join(
+        '&@id={}'.format(at_id) for at_id in at_ids
+    )
+    mocker.patch('encoded.reports.metadata.get_max_clause_count', return_value=1024)
+    search_generator = mocker.patch('encoded.reports.metadata.paged_search_generator')
+    search_generator.side_effect = lambda request: {
+        '@graph': ({'@id': at_id} for at_id in request.params.getall('@id'))
+    }
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=3, max_workers=2)
+    assert [result['@id'] for result in bsg.results()] == at_ids
+    assert search_generator.call_count == 4
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=3, max_workers=1)
+    assert [result['@id'] for result in bsg.results()] == at_ids
+
+
+def test_metadata_batched_search_generator_results_hand_over_pages(dummy_request, mocker):
+    import time
+    from encoded.reports.metadata import BatchedSearchGenerator
+    at_ids = ['/experiments/ENCSR{:03d}AAA/'.format(i) for i in range(20)]
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment' + ''.join(
+        '&@id={}'.format(at_id) for at_id in at_ids
+    )
+    mocker.patch('encoded.reports.metadata.get_max_clause_count', return_value=1024)
+    mocker.patch('encoded.reports.metadata.PAGED_SEARCH_PAGE_SIZE', 2)
+    searched = []
+
+    def search(request):
+        for at_id in request.params.getall('@id'):
+            searched.append(at_id)
+            yield {'@id': at_id}
+
+    search_generator = mocker.patch('encoded.reports.metadata.paged_search_generator')
+    search_generator.side_effect = lambda request: {'@graph': search(request)}
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=10, max_workers=2)
+    results = bsg.results()
+    assert next(results)['@id'] == at_ids[0]
+    time.sleep(0.5)
+    # Each batch holds at most the page not yet taken and the one being filled.
+    assert len([at_id for at_id in searched if at_id in at_ids[:10]]) <= 6
+    assert len([at_id for at_id in searched if at_id in at_ids[10:]]) <= 4
+    results.close()
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=10, max_workers=2)
+    assert [result['@id'] for result in bsg.results()] == at_ids
+
+
+def test_metadata_batched_search_generator_results_raise_batch_errors(dummy_request, mocker):
+    from encoded.reports.metadata import BatchedSearchGenerator
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment' + ''.join(
+        '&@id=/experiments/ENCSR{:03d}AAA/'.format(i) for i in range(10)
+    )
+    mocker.patch('encoded.reports.metadata.get_max_clause_count', return_value=1024)
+    search_generator = mocker.patch('encoded.reports.metadata.paged_search_generator')
+    search_generator.side_effect = ValueError
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=3, max_workers=2)
+    with pytest.raises(ValueError):
+        list(bsg.results())
+
+
+def test_metadata_batched_search_generator_batch_size_capped_by_max_clause_count(dummy_request, mocker):
+    from encoded.reports.metadata import BatchedSearchGenerator
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment' + ''.join(
+        '&@id=/experiments/ENCSR{:03d}AAA/'.format(i) for i in range(10)
+    )
+    mocker.patch('encoded.reports.metadata.get_max_clause_count', return_value=4)
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=5000)
+    assert [len(values) for values in bsg._make_batched_values_from_batch_param_values()] == [4, 4, 2]
+
+
+def test_metadata_get_max_clause_count(mocker):
+    from encoded.reports.metadata import get_max_clause_count
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    es = mocker.MagicMock()
+    es.nodes.info.return_value = {
+        'nodes': {
+            'a': {'settings': {'indices.query.bool.max_clause_count': '4096'}},
+            'b': {'settings': {'indices.query.bool.max_clause_count': '2048'}},
+        }
+    }
+    registry = {ELASTIC_SEARCH: es}
+    assert get_max_clause_count(registry) == 2048
+    assert get_max_clause_count(registry) == 2048
+    assert es.nodes.info.call_count == 1
+    es.nodes.info.side_effect = Exception
+    assert get_max_clause_count({ELASTIC_SEARCH: es}) == 1024
+    assert get_max_clause_count({}) == 1024
+
+
 def test_metadata_publication_data_metadata_report_init(dummy_request):
     from encoded.reports.metadata import PublicationDataMetadataReport
     dummy_request.environ['QUERY_STRING'] = (
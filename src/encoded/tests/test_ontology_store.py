@@ -0,0 +1,67 @@
+import json
+import pytest
+
+
+ONTOLOGY = {
+    'UBERON:0000948': {
+        'name': 'heart',
+        'synonyms': ['chambered heart'],
+        'organs': ['heart'],
+        'part_of': ['UBERON:0000948'],
+    },
+    'EFO:0002067': {
+        'name': 'K562',
+        'synonyms': [],
+        'organs': ['blood', 'bodily fluid'],
+        'part_of': [],
+    },
+}
+
+
+@pytest.fixture
+def ontology_store(tmpdir):
+    from encoded.ontology_store import (
+        OntologyStore,
+        build_ontology_store,
+    )
+    path = str(tmpdir.join('ontology.sqlite'))
+    assert build_ontology_store(ONTOLOGY, path) == 2
+    return OntologyStore(path)
+
+
+def test_ontology_store_lookup(ontology_store):
+    assert 'UBERON:0000948' in ontology_store
+    assert 'UBERON:9999999' not in ontology_store
+    assert ontology_store['EFO:0002067'] == ONTOLOGY['EFO:0002067']
+    assert ontology_store.get('UBERON:9999999') is None
+    with pytest.raises(KeyError):
+        ontology_store['UBERON:9999999']
+    assert len(ontology_store) == 2
+    assert sorted(ontology_store) == sorted(ONTOLOGY)
+    assert dict(ontology_store.items()) == ONTOLOGY
+
+
+def test_ontology_store_rebuild(tmpdir, ontology_store):
+    from encoded.ontology_store import (
+        OntologyStore,
+        build_ontology_store,
+    )
+    build_ontology_store({'EFO:0002067': ONTOLOGY['EFO:0002067']}, ontology_store.path)
+    assert 'UBERON:0000948' not in OntologyStore(ontology_store.path)
+
+
+def test_ontology_from_settings(tmpdir, ontology_store):
+    from encoded.ontology_store import (
+        OntologyStore,
+        ontology_from_settings,
+    )
+    ontology_path = tmpdir.join('ontology.json')
+    ontology_path.write(json.dumps(ONTOLOGY))
+    settings = {
+        'ontology_path': str(ontology_path),
+        'ontology_store_path': ontology_store.path,
+    }
+    assert isinstance(ontology_from_settings(settings), OntologyStore)
+    settings['ontology_store_path'] = str(tmpdir.join('missing.sqlite'))
+    assert ontology_from_settings(settings) == ONTOLOGY
+    assert ontology_from_settings({}, {}) == {}
@@ -0,0 +1,104 @@
+import pytest
+
+
+@pytest.fixture
+def peak_store(tmpdir):
+    from encoded.peak_store import PeakStore
+    return PeakStore(str(tmpdir))
+
+
+def search_peaks(store, start, end, chrom='chr1'):
+    return sorted(
+        (hit['_source']['uuid'], hit['_source']['start'], hit['_source']['end'])
+        for hit in store.search('GRCh38', chrom, start, end)
+    )
+
+
+def test_peak_store_add_flush_search(peak_store, tmpdir):
+    from encoded.peak_store import PeakStore
+    assert peak_store.add('abc', 'GRCh38', 'DNase-seq', [('chr1', [100, 5000, 900], [200, 5100, 3000])])
+    assert peak_store.add('def', 'GRCh38', 'DNase-seq', [('chr1', [150], [160]), ('chr2', [1], [50])])
+    assert not peak_store.add('ghi', 'GRCh38', 'DNase-seq', [])
+    assert search_peaks(peak_store, 155, 155) == []  # Nothing until flushed
+    peak_store.flush()
+    assert search_peaks(peak_store, 155, 155) == [('abc', 100, 200), ('def', 150, 160)]
+    assert search_peaks(peak_store, 2500, 2600) == [('abc', 900, 3000)]
+    assert search_peaks(peak_store, 200, 900) == [('abc', 100, 200), ('abc', 900, 3000)]
+    assert search_peaks(peak_store, 10, 20, chrom='chr2') == [('def', 1, 50)]
+    assert search_peaks(peak_store, 10, 20, chrom='chr3') == []
+    # Another process sees the same store
+    reader = PeakStore(str(tmpdir))
+    assert search_peaks(reader, 155, 155) == [('abc', 100, 200), ('def', 150, 160)]
+    assert reader.count() == 2
+    assert set(reader.resident_docs(['abc', 'xyz'])) == {'abc'}
+
+
+def test_peak_store_remove(peak_store, tmpdir):
+    from encoded.peak_store import PeakStore
+    peak_store.add('abc', 'GRCh38', 'DNase-seq', [('chr1', [100], [200])])
+    peak_store.add('def', 'GRCh38', 'DNase-seq', [('chr1', [150], [160])])
+    peak_store.flush()
+    reader = PeakStore(str(tmpdir))
+    assert len(search_peaks(reader, 155, 155)) == 2
+    assert peak_store.remove('def')
+    assert not peak_store.remove('def')
+    # Re-adding gets a new file id so the dropped peaks are not mistaken for it
+    peak_store.add('def', 'GRCh38', 'DNase-seq', [('chr1', [400], [500])])
+    peak_store.flush()
+    assert search_peaks(reader, 155, 155) == [('abc', 100, 200)]
+    assert search_peaks(reader, 450, 450) == [('def', 400, 500)]
+    # The dropped peaks are merged away
+    assert sum(len(peaks) for (peaks, max_length) in reader.chrom_peaks('GRCh38', 'chr1')) == 2
+
+
+def test_peak_store_segments(tmpdir):
+    import json
+    import random
+    from encoded.peak_store import PeakStore
+    store = PeakStore(str(tmpdir))
+    rand = random.Random(0)
+    expected = {}
+    for i in range(40):
+        starts = [rand.randint(0, 100000) for _ in range(rand.randint(1, 50))]
+        ends = [start + rand.randint(1, 3000) for start in starts]
+        store.add('f%d' % i, 'GRCh38', 'DNase-seq', [('chr1', starts, ends)])
+        expected['f%d' % i] = list(zip(starts, ends))
+        if i % 3 == 0:
+            store.remove('f%d' % (i // 2))
+            expected.pop('f%d' % (i // 2), None)
+        store.flush()
+    with open(str(tmpdir.join('residents.json'))) as residents_file:
+        chrom = json.load(residents_file)['chroms']['GRCh38']['chr1']
+    # Segments are merged as they pile up instead of rewriting the chrom at every flush
+    assert 1 <= len(chrom['segments']) <= 8
+    assert len(tmpdir.join('GRCh38').listdir()) == len(chrom['segments'])
+    for segment in chrom['segments']:
+        peaks = store.segment_peaks('GRCh38', segment['name'])
+        assert list(peaks['start']) == sorted(peaks['start'])
+        assert segment['max_length'] == (peaks['end'] - peaks['start']).max()
+    reader = PeakStore(str(tmpdir))
+    for (start, end) in [(0, 100000), (5000, 5000), (99000, 99500)]:
+        assert search_peaks(reader, start, end) == sorted(
+            (uuid, peak_start, peak_end)
+            for (uuid, peaks) in expected.items()
+            for (peak_start, peak_end) in peaks
+            if peak_start <= end and peak_end >= start
+        )
+
+
+def test_peak_store_merge_peaks_in_blocks():
+    import io
+    import numpy
+    from encoded.peak_store import PEAK_DTYPE, merge_peaks
+
+    def peaks(starts, file_id):
+        array = numpy.empty(len(starts), dtype=PEAK_DTYPE)
+        array['start'] = starts
+        array['end'] = [start + 10 for start in starts]
+        array['file'] = file_id
+        return array
+    inputs = [peaks([1, 2, 2, 9, 30, 31], 0), peaks([2, 3, 4, 40], 1), peaks([5, 6], 2)]
+    out = io.BytesIO()
+    assert merge_peaks(inputs, numpy.array([0, 1]), out, block_rows=2) == (10, 10)
+    merged = numpy.frombuffer(out.getvalue(), dtype=PEAK_DTYPE)
+    assert list(merged['start']) == [1, 2, 2, 2, 3, 4, 9, 30, 31, 40]
@@ -0,0 +1,279 @@
+import pytest
+
+
+@pytest.fixture
+def region_indexer(mocker):
+    import threading
+    from encoded.region_indexer import RegionIndexer
+    from encoded.region_indexer import RESIDENT_REGIONSET_KEY
+    indexer = RegionIndexer.__new__(RegionIndexer)
+    indexer.regions_es = mocker.MagicMock()
+    indexer.state = mocker.MagicMock()
+    indexer.residents_index = RESIDENT_REGIONSET_KEY
+    indexer.test_instance = True
+    indexer.known_indices = set()
+    indexer.known_indices_lock = threading.Lock()
+    indexer.workers = 1
+    indexer.layout = 'nested'
+    indexer.flush_size = 50000
+    indexer.peak_store = None
+    return indexer
+
+
+def streaming_bulk(es, actions, **kw):
+    for action in actions:
+        yield (True, {'index': {'_id': action.get('_id'), 'status': 201}})
+
+
+def file_jobs(request, dataset_uuid):
+    from encoded.region_indexer import FileJob
+    for i in range(5):
+        afile = {
+            'uuid': '%s-%d' % (dataset_uuid, i),
+            'href': '/files/%s-%d/' % (dataset_uuid, i),
+            '@id': '/files/%s-%d/' % (dataset_uuid, i),
+        }
+        yield FileJob(dataset_uuid, 'DNase-seq', afile, i != 4, None)
+
+
+def run_file_job(request, job, force):
+    if job.afile['uuid'].endswith('-3'):
+        raise ValueError('bad bed')
+    return not job.afile['uuid'].startswith('skip')
+
+
+def test_region_indexer_add_to_regions_es_single_bulk(region_indexer, mocker):
+    bulk = mocker.patch('encoded.region_indexer.streaming_bulk', side_effect=streaming_bulk)
+    regions = {
+        'chr1': [{'start': 1, 'end': 10}],
+        'chr2': [{'start': 5, 'end': 50}],
+    }
+    assert region_indexer.add_to_regions_es('abc', 'GRCh38', 'DNase-seq', regions)
+    assert bulk.call_count == 1
+    assert ('chr1', 'GRCh38') in region_indexer.known_indices
+    assert ('resident_regionsets', 'default') in region_indexer.known_indices
+    # Second file reuses cached index knowledge
+    exists_calls = region_indexer.regions_es.indices.exists.call_count
+    assert region_indexer.add_to_regions_es('def', 'GRCh38', 'DNase-seq', regions)
+    assert region_indexer.regions_es.indices.exists.call_count == exists_calls
+    assert region_indexer.regions_es.index.call_count == 2
+    residency = region_indexer.regions_es.index.call_args[1]
+    assert residency['index'] == 'resident_regionsets'
+    assert residency['id'] == 'def'
+    assert residency['body']['chroms'] == ['chr1', 'chr2']
+
+
+def test_region_indexer_add_to_regions_es_failed_docs_not_resident(region_indexer, mocker):
+    def bulk(es, actions, **kw):
+        actions = list(actions)
+        for action in actions[:-1]:
+            yield (True, {'index': {'_id': action['_id'], 'status': 201}})
+        yield (False, {'index': {'_id': actions[-1]['_id'], 'status': 429}})
+    mocker.patch('encoded.region_indexer.streaming_bulk', side_effect=bulk)
+    regions = [
+        ('chr1', [{'start': 1, 'end': 10}]),
+        ('chr1', [{'start': 20, 'end': 30}]),
+        ('chr2', [{'start': 5, 'end': 50}]),
+    ]
+    assert not region_indexer.add_to_regions_es('abc', 'GRCh38', 'DNase-seq', regions)
+    assert region_indexer.regions_es.index.call_count == 0
+    deleted = [call[1]['id'] for call in region_indexer.regions_es.delete.call_args_list]
+    assert deleted == ['abc', 'abc:1', 'abc']
+
+
+def test_region_indexer_region_actions(region_indexer):
+    regions = {
+        'chr1': [{'start': 1, 'end': 10}],
+        'chrx': [{'start': 5, 'end': 50}],
+    }
+    chunks = {}
+    actions = list(region_indexer.region_actions('abc', 'hg19', regions.items(), chunks))
+    assert [action['_index'] for action in actions] == ['chr1', 'chrx']
+    assert all(action['_id'] == 'abc' for action in actions)
+    assert chunks == {'chr1': 1, 'chrx': 1}
+
+
+def test_region_indexer_region_actions_split_chrom(region_indexer):
+    import collections
+    regions = [
+        ('chr1', [{'start': 1, 'end': 10}]),
+        ('chr2', [{'start': 5, 'end': 50}]),
+        ('chr1', [{'start': 20, 'end': 30}]),
+    ]
+    chunks = collections.OrderedDict()
+    actions = list(region_indexer.region_actions('abc', 'hg19', regions, chunks))
+    assert [action['_id'] for action in actions] == ['abc', 'abc', 'abc:1']
+    residency = region_indexer.residency_doc('abc', 'hg19', 'ChIP-seq', chunks)
+    assert residency['chroms'] == ['chr1', 'chr2']
+    assert residency['chunks'] == {'chr1': 2, 'chr2': 1}
+
+
+def test_region_indexer_add_to_regions_es_empty(region_indexer, mocker):
+    mocker.patch('encoded.region_indexer.streaming_bulk', side_effect=streaming_bulk)
+    assert not region_indexer.add_to_regions_es('abc', 'hg19', 'ChIP-seq', [])
+    assert region_indexer.regions_es.index.call_count == 0
+
+
+def test_region_indexer_add_to_regions_es_bounded_requests(region_indexer):
+    from elasticsearch.serializer import JSONSerializer
+
+    def es_bulk(body, **kw):
+        lines = body.splitlines()
+        return {'items': [{'index': {'status': 201}} for line in lines[::2]]}
+    region_indexer.regions_es.bulk.side_effect = es_bulk
+    region_indexer.regions_es.transport.serializer = JSONSerializer()
+    region_indexer.flush_size = 2
+    regions = [
+        ('chr1', [{'start': 1, 'end': 10}, {'start': 20, 'end': 30}]),
+        ('chr1', [{'start': 40, 'end': 50}, {'start': 60, 'end': 70}]),
+        ('chr2', [{'start': 5, 'end': 50}, {'start': 55, 'end': 90}]),
+    ]
+    assert region_indexer.add_to_regions_es('abc', 'GRCh38', 'DNase-seq', regions)
+    # One chrom doc of flush_size positions per request
+    assert region_indexer.regions_es.bulk.call_count == 3
+    assert region_indexer.regions_es.index.call_count == 1
+
+
+def test_region_indexer_add_to_regions_es_failed_stream_cleaned_up(region_indexer, mocker):
+    mocker.patch('encoded.region_indexer.streaming_bulk', side_effect=streaming_bulk)
+
+    def regions():
+        yield ('chr1', [{'start': 1, 'end': 10}])
+        yield ('chr2', [{'start': 5, 'end': 50}])
+        raise EOFError('truncated gzip')
+    with pytest.raises(EOFError):
+        region_indexer.add_to_regions_es('abc', 'GRCh38', 'DNase-seq', regions())
+    assert region_indexer.regions_es.index.call_count == 0
+    deleted = [(call[1]['index'], call[1]['id']) for call in region_indexer.regions_es.delete.call_args_list]
+    assert deleted == [('chr1', 'abc'), ('chr2', 'abc')]
+
+
+def test_region_indexer_bed_regions():
+    import io
+    from encoded.region_indexer import bed_regions
+    bed = io.StringIO(
+        'track name=peaks\n'
+        'chr1\t0\t10\tpeak1\n'
+        'chr2\t5\t50\tpeak2\n'
+        'chr1\t20\t30\tpeak3\n'
+        'chr1\t40\t45\tpeak4\n'
+        'chr1\tabc\t45\tpeak5\n'
+    )
+    regions = [(chrom, list(starts), list(ends)) for chrom, starts, ends in bed_regions(bed, flush_size=2)]
+    assert regions == [
+        ('chr1', [1, 21], [11, 31]),
+        ('chr1', [41], [46]),
+        ('chr2', [6], [51]),
+    ]
+
+
+def test_region_indexer_region_doc_uuid():
+    from encoded.region_indexer import region_doc_id
+    from encoded.region_indexer import region_doc_uuid
+    uuid = '3c1ba29b-bdb2-4ef4-a2a1-d1e1e7be9e8c'
+    assert region_doc_id(uuid) == uuid
+    assert region_doc_uuid(region_doc_id(uuid)) == uuid
+    assert region_doc_uuid(region_doc_id(uuid, 3)) == uuid
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_region_indexer_update_objects_accounting(region_indexer, mocker, workers):
+    region_indexer.workers = workers
+    mocker.patch.object(region_indexer, 'file_jobs', side_effect=file_jobs)
+    mocker.patch.object(region_indexer, 'run_file_job', side_effect=lambda request, job, force: True)
+    errors = region_indexer.update_objects(None, ['ds%d' % i for i in range(10)], False)
+    assert errors == []
+    added = sorted(call[0][0] for call in region_indexer.state.file_added.call_args_list)
+    dropped = sorted(call[0][0] for call in region_indexer.state.file_dropped.call_args_list)
+    assert added == sorted('ds%d-%d' % (i, j) for i in range(10) for j in range(4))
+    assert dropped == sorted('ds%d-4' % i for i in range(10))
+
+
+def test_region_indexer_update_objects_pooled_errors(region_indexer, mocker):
+    region_indexer.workers = 4
+    mocker.patch.object(region_indexer, 'file_jobs', side_effect=file_jobs)
+    mocker.patch.object(region_indexer, 'run_file_job', side_effect=run_file_job)
+    uuids = ['ds%d' % i for i in range(10)] + ['skip']
+    errors = region_indexer.update_objects(None, uuids, False)
+    assert sorted(error['uuid'] for error in errors) == sorted('%s-3' % uuid for uuid in uuids)
+    added = sorted(call[0][0] for call in region_indexer.state.file_added.call_args_list)
+    assert added == sorted('ds%d-%d' % (i, j) for i in range(10) for j in range(3))
+
+
+def test_region_indexer_resident_docs(region_indexer):
+    region_indexer.regions_es.mget.return_value = {
+        'docs': [
+            {'_id': 'abc', 'found': True, '_source': {'chroms': ['chr1']}},
+            {'_id': 'def', 'found': False},
+        ]
+    }
+    assert region_indexer.resident_docs(['abc', 'def']) == {'abc': {'chroms': ['chr1']}}
+    assert region_indexer.regions_es.mget.call_count == 1
+    assert region_indexer.resident_docs([]) == {}
+    assert region_indexer.regions_es.mget.call_count == 1
+
+
+def test_region_indexer_file_jobs_one_residency_lookup(region_indexer, mocker):
+    request = mocker.MagicMock()
+    request.embed.return_value = {
+        '@type': ['Experiment', 'Dataset', 'Item'],
+        'accession': 'ENCSR000AAA',
+        'assay_term_name': 'DNase-seq',
+        'files': [
+            {'uuid': 'abc', 'file_format': 'bed'},
+            {'uuid': 'def', 'file_format': 'bed'},
+            {'uuid': 'ghi', 'file_format': 'bam'},
+        ]
+    }
+    mocker.patch.object(region_indexer, 'encoded_candidate_file', return_value=True)
+    region_indexer.regions_es.mget.return_value = {
+        'docs': [
+            {'_id': 'abc', 'found': True, '_source': {'chroms': ['chr1']}},
+            {'_id': 'def', 'found': False},
+        ]
+    }
+    jobs = list(region_indexer.file_jobs(request, 'dataset'))
+    assert [(job.afile['uuid'], job.resident) for job in jobs] == [('abc', {'chroms': ['chr1']}), ('def', None)]
+    assert region_indexer.regions_es.mget.call_count == 1
+    assert region_indexer.regions_es.get.call_count == 0
+
+
+def test_region_indexer_run_file_job_uses_resident(region_indexer, mocker):
+    from encoded.region_indexer import FileJob
+    add_file = mocker.patch.object(region_indexer, 'add_encoded_file_to_regions_es', return_value=True)
+    remove = mocker.patch.object(region_indexer, 'remove_from_regions_es', return_value=True)
+    resident = {'chroms': ['chr1'], 'assembly': 'GRCh38'}
+    afile = {'uuid': 'abc'}
+    assert not region_indexer.run_file_job(None, FileJob('ENCSR000AAA', 'DNase-seq', afile, True, resident), False)
+    assert not region_indexer.run_file_job(None, FileJob('ENCSR000AAA', 'DNase-seq', afile, False, None), False)
+    assert add_file.call_count == 0 and remove.call_count == 0
+    assert region_indexer.run_file_job(None, FileJob('ENCSR000AAA', 'DNase-seq', afile, True, resident), True)
+    remove.assert_called_once_with('abc', resident)
+    assert add_file.call_count == 1
+
+
+def test_region_indexer_bins():
+    from encoded.region_indexer import bin_from_range
+    from encoded.region_indexer import overlapping_bins
+    assert bin_from_range(0, 1) == 585
+    assert bin_from_range(2 ** 17 - 10, 2 ** 17 + 10) == 73
+    assert bin_from_range(0, 2 ** 29) == 0
+    for (start, end) in [(1, 2), (1000000, 1000500), (131000, 132000), (5000000, 15000000)]:
+        peak_bin = bin_from_range(start, end)
+        assert peak_bin in overlapping_bins(start, end)
+        assert peak_bin in overlapping_bins(end - 1, end)
+        assert peak_bin in overlapping_bins(start, start + 1)
+    assert bin_from_range(1000000, 1000500) not in overlapping_bins(2000000, 2000001)
+
+
+def test_region_indexer_region_actions_binned(region_indexer):
+    from encoded.region_indexer import bin_from_range
+    region_indexer.layout = 'binned'
+    regions = [('chr1', [{'start': 1, 'end': 10}, {'start': 200000, 'end': 200500}])]
+    chunks = {}
+    actions = list(region_indexer.region_actions('abc', 'GRCh38', regions, chunks))
+    assert [action['_index'] for action in actions] == ['chr1_binned', 'chr1_binned']
+    assert actions[1]['_source'] == {'uuid': 'abc', 'start': 200000, 'end': 200500, 'bin': bin_from_range(200000, 200500)}
+    assert '_id' not in actions[0]
+    assert region_indexer.residency_doc('abc', 'GRCh38', 'ChIP-seq', chunks)['layout'] == 'binned'
+    assert ('chr1_binned', 'GRCh38') in region_indexer.known_indices
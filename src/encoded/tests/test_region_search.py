@@ -0,0 +1,53 @@
+def test_region_search_get_binned_peak_query():
+    from encoded.region_indexer import bin_from_range
+    from encoded.region_search import get_binned_peak_query
+    query = get_binned_peak_query('1000000', '1000000')
+    bins, start, end = query['query']['bool']['filter']
+    assert bin_from_range(999000, 1000000) in bins['terms']['bin']
+    assert bin_from_range(1000000, 1000050) in bins['terms']['bin']
+    assert start == {'range': {'start': {'lte': 1000000}}}
+    assert end == {'range': {'end': {'gte': 1000000}}}
+
+
+def test_region_search_group_binned_peaks():
+    from encoded.region_search import group_binned_peaks
+    hits = [
+        {'_index': 'chr1_binned', '_type': 'GRCh38', '_id': '1', '_source': {'uuid': 'abc', 'start': 1, 'end': 10}},
+        {'_index': 'chr1_binned', '_type': 'GRCh38', '_id': '2', '_source': {'uuid': 'def', 'start': 5, 'end': 9}},
+        {'_index': 'chr1_binned', '_type': 'GRCh38', '_id': '3', '_source': {'uuid': 'abc', 'start': 8, 'end': 20}},
+    ]
+    peaks = group_binned_peaks(hits, 'chr1')
+    assert [peak['_id'] for peak in peaks] == ['abc', 'def']
+    assert 'inner_hits' not in peaks[0]
+    peaks = group_binned_peaks(hits, 'chr1', with_inner_hits=True)
+    assert peaks[0]['_index'] == 'chr1'
+    assert peaks[0]['inner_hits']['positions']['hits']['hits'] == [
+        {'_source': {'start': 1, 'end': 10}},
+        {'_source': {'start': 8, 'end': 20}},
+    ]
+
+
+def test_region_search_get_binned_files_query():
+    from encoded.region_search import BINNED_FILES_SIZE, get_binned_files_query, get_binned_peak_query
+    query = get_binned_files_query('1000000', '1000000')
+    assert query['query'] == get_binned_peak_query('1000000', '1000000')['query']
+    assert '_source' not in query
+    assert query['aggs'] == {'files': {'terms': {'field': 'uuid', 'size': BINNED_FILES_SIZE}}}
+
+
+def test_region_search_binned_file_hits(mocker):
+    from encoded import region_search
+    error = mocker.patch.object(region_search.log, 'error')
+    results = {'aggregations': {'files': {'sum_other_doc_count': 0, 'buckets': [
+        {'key': 'abc', 'doc_count': 2},
+        {'key': 'def', 'doc_count': 1},
+    ]}}}
+    hits = region_search.binned_file_hits(results, 'chr1', 'GRCh38')
+    assert hits == [
+        {'_index': 'chr1', '_type': 'GRCh38', '_id': 'abc'},
+        {'_index': 'chr1', '_type': 'GRCh38', '_id': 'def'},
+    ]
+    assert not error.called
+    results['aggregations']['files']['sum_other_doc_count'] = 5
+    region_search.binned_file_hits(results, 'chr1', 'GRCh38')
+    assert error.called
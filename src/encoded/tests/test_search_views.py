@@ -679,3 +679,24 @@ def test_search_views_entex_matrix_response(index_workbook, testapp):
     assert len(
         r.json['matrix']['y']['biosample_ontology.classification']['buckets'][0]['biosample_ontology.term_name']['buckets']
     ) > 0
+
+
+def test_search_views_paged_search_generator(index_workbook, dummy_request):
+    from itertools import islice
+    from encoded.search_views import PagedSearchGenerator
+    from encoded.search_views import search_generator
+    dummy_request.environ['QUERY_STRING'] = (
+        'type=Experiment&field=@id&field=status&limit=all'
+    )
+    expected = sorted(item['@id'] for item in search_generator(dummy_request)['@graph'])
+    psg = PagedSearchGenerator(dummy_request, page_size=10)
+    results = list(psg.results())
+    assert sorted(item['@id'] for item in results) == expected
+    for result in results:
+        # (@type, @id, status) without the uuid paging adds
+        assert len(result.keys()) == 3
+    first = PagedSearchGenerator(dummy_request, page_size=10)
+    first_results = list(islice(first.results(), 15))
+    rest = PagedSearchGenerator(dummy_request, page_size=10, cursor=first.cursor)
+    resumed = [item['@id'] for item in first_results + list(rest.results())]
+    assert resumed == [item['@id'] for item in results]
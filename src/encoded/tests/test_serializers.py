@@ -0,0 +1,60 @@
+import gzip
+import io
+import pytest
+
+
+def test_serializers_get_output_format(dummy_request):
+    from encoded.reports.serializers import get_output_format
+    from pyramid.exceptions import HTTPBadRequest
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment'
+    assert get_output_format(dummy_request) == 'tsv'
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment&format=TSV.GZ'
+    assert get_output_format(dummy_request) == 'tsv.gz'
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment&format=parquet'
+    assert get_output_format(dummy_request) == 'parquet'
+    dummy_request.environ['QUERY_STRING'] = 'type=Experiment&format=xlsx'
+    with pytest.raises(HTTPBadRequest):
+        get_output_format(dummy_request)
+
+
+def test_serializers_gzip_chunks():
+    from encoded.reports.serializers import gzip_chunks
+    lines = [
+        'ENCFF{:06d}\tbigWig\tGRCh38\n'.format(i).encode('utf-8')
+        for i in range(20000)
+    ]
+    chunks = list(gzip_chunks(iter(lines), chunk_size=4096))
+    assert len(chunks) > 1
+    assert gzip.decompress(b''.join(chunks)) == b''.join(lines)
+    assert gzip.decompress(b''.join(gzip_chunks(iter([])))) == b''
+
+
+def test_serializers_parquet_chunks():
+    import pyarrow.parquet
+    from encoded.reports.serializers import parquet_chunks
+    header = ['File accession', 'File size', 'Biosample treatments']
+    rows = [
+        ['ENCFF{:06d}'.format(i), i, None]
+        for i in range(25)
+    ]
+    chunks = list(parquet_chunks(header, iter(rows), batch_size=10, metadata={'report': 'test'}))
+    assert len(chunks) == 3
+    parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(b''.join(chunks)))
+    assert parquet_file.num_row_groups == 3
+    table = parquet_file.read()
+    assert table.column_names == header
+    assert table.schema.metadata[b'report'] == b'test'
+    assert table.to_pydict() == {
+        'File accession': [row[0] for row in rows],
+        'File size': [str(row[1]) for row in rows],
+        'Biosample treatments': [None] * 25,
+    }
+
+
+def test_serializers_parquet_chunks_no_rows():
+    import pyarrow.parquet
+    from encoded.reports.serializers import parquet_chunks
+    data = b''.join(parquet_chunks(['ID'], iter([])))
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    assert table.num_rows == 0
+    assert table.column_names == ['ID']
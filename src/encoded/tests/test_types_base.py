@@ -0,0 +1,115 @@
+def test_paths_filtered_by_status_loads_each_item_once(mocker):
+    from encoded.types import base
+    mocker.patch.object(base, 'item_properties_cache', {})
+    statuses = {
+        '/files/ENCFF001AAA/': 'released',
+        '/files/ENCFF002AAA/': 'deleted',
+        '/files/ENCFF003AAA/': 'revoked',
+    }
+
+    def traverse(root, path):
+        context = mocker.MagicMock()
+        context.uuid = path
+        context.__json__ = lambda request: {'status': statuses[path]}
+        return {'context': context}
+
+    traverse = mocker.patch.object(base, 'traverse', side_effect=traverse)
+    request = mocker.MagicMock()
+    request._embedded_uuids = set()
+    paths = list(statuses)
+    assert base.paths_filtered_by_status(request, paths) == [
+        '/files/ENCFF001AAA/', '/files/ENCFF003AAA/']
+    assert base.paths_filtered_by_status(request, paths, include=('released',)) == [
+        '/files/ENCFF001AAA/']
+    assert base.paths_filtered_by_status(
+        request, paths, exclude=('revoked', 'deleted', 'replaced')) == ['/files/ENCFF001AAA/']
+    assert traverse.call_count == 3
+    assert request._embedded_uuids == set(paths)
+
+
+def test_item_properties_loads_uncached_items_in_one_query(mocker):
+    from encoded.types import base
+    from snovault import CONNECTION
+    mocker.patch.object(base, 'item_properties_cache', {})
+    rid = '6a1b57e8-8cd8-4e38-a3f6-0b7ffa35a4c1'
+    replicate = mocker.MagicMock(uuid=rid, item_type='replicate')
+    experiment = mocker.MagicMock(uuid='e6f1a7b7-4a47-4ae8-a1b1-4c9e7a8c58d2', item_type='experiment')
+    key = mocker.MagicMock()
+    key.name = 'accession'
+    key.value = 'ENCSR000AAA'
+    session = mocker.MagicMock()
+    session.query.return_value.outerjoin.return_value.filter.return_value = [
+        (replicate, None), (experiment, key)]
+    mocker.patch.object(base, 'database_session', return_value=session)
+    conn = mocker.MagicMock()
+    conn.item_cache = {}
+    conn.unique_key_cache = {}
+    conn.types.by_item_type = {
+        'replicate': mocker.MagicMock(),
+        'experiment': mocker.MagicMock(),
+    }
+    request = mocker.MagicMock()
+    request.registry = {CONNECTION: conn}
+    request.root.collections = {'experiments': mocker.MagicMock(unique_key='accession')}
+    request._embedded_uuids = set()
+
+    def traverse(root, path):
+        context = mocker.MagicMock()
+        context.uuid = path
+        context.__json__ = lambda request: {'status': 'released'}
+        return {'context': context}
+
+    mocker.patch.object(base, 'traverse', side_effect=traverse)
+    paths = ['/replicates/{}/'.format(rid), '/experiments/ENCSR000AAA/', '/experiments/ENCSR000AAA/']
+    assert list(base.item_properties(request, paths)) == paths[:2]
+    assert session.query.return_value.outerjoin.call_count == 1
+    assert set(conn.item_cache) == {rid, experiment.uuid}
+    assert conn.unique_key_cache == {('accession', 'ENCSR000AAA'): experiment.uuid}
+    base.item_properties(request, paths)
+    assert session.query.return_value.outerjoin.call_count == 1
+
+
+def test_item_properties_skips_batched_load_outside_database(mocker):
+    from encoded.types import base
+    mocker.patch.object(base, 'item_properties_cache', {})
+    session = mocker.patch.object(base, 'database_session', return_value=None)
+    traverse = mocker.patch.object(base, 'traverse')
+    traverse.return_value = {'context': mocker.MagicMock(uuid='a', __json__=lambda request: {})}
+    request = mocker.MagicMock()
+    request._embedded_uuids = set()
+    assert base.item_properties(request, ['/files/ENCFF001AAA/']) == {'/files/ENCFF001AAA/': {}}
+    assert session.call_count == 1
+
+
+def test_paths_filtered_by_status_loads_database_items(testapp, dummy_request, threadlocals, lab, award, experiment):
+    from encoded.types import base
+    from snovault import CONNECTION
+    files = []
+    for i, status in enumerate(['in progress', 'deleted', 'archived']):
+        item = {
+            'dataset': experiment['@id'],
+            'file_format': 'fasta',
+            'md5sum': '{:032x}'.format(i + 1),
+            'output_type': 'raw data',
+            'lab': lab['@id'],
+            'file_size': 34,
+            'award': award['@id'],
+            'status': status,
+        }
+        files.append(testapp.post_json('/file', item).json['@graph'][0])
+    # Start from empty request caches, as a new request would
+    for name in (
+        'snovault.connection.item_cache',
+        'snovault.connection.key_cache',
+        'encoded.types.item_properties_cache',
+    ):
+        threadlocals.pop(name, None)
+    paths = [files[0]['@id'], '/files/{}/'.format(files[1]['uuid']), files[2]['uuid']]
+    conn = dummy_request.registry[CONNECTION]
+    base.load_items(dummy_request, paths)
+    assert all(conn.item_cache.get(f['uuid']) is not None for f in files)
+    assert str(conn.unique_key_cache.get(('accession', files[0]['accession']))) == files[0]['uuid']
+    dummy_request._embedded_uuids = set()
+    assert base.paths_filtered_by_status(dummy_request, paths) == [paths[0], paths[2]]
+    assert base.paths_filtered_by_status(dummy_request, paths, include=('deleted',)) == [paths[1]]
+    assert dummy_request._embedded_uuids == {f['uuid'] for f in files}
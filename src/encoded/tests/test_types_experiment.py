@@ -245,3 +245,40 @@ def test_experiment_mint_chip_control(testapp, experiment_28):
     testapp.patch_json(experiment_28['@id'], {'assay_term_name': 'eCLIP', 'control_type': 'mock input'})
     res = testapp.get(experiment_28['@id'] + '@@index-data')
     assert res.json['object']['assay_title'] == 'Control eCLIP'
+
+
+def test_replicate_graph_embeds_each_object_once(mocker):
+    from encoded.types.shared_calculated_properties import replicate_graph
+    objects = {
+        '/replicates/1/': {'status': 'released', 'library': '/libraries/1/', 'libraries': ['/libraries/1/']},
+        '/replicates/2/': {'status': 'released', 'library': '/libraries/2/', 'libraries': ['/libraries/2/']},
+        '/libraries/1/': {'status': 'released', 'biosample': '/biosamples/1/'},
+        '/libraries/2/': {'status': 'released', 'biosample': '/biosamples/1/'},
+        '/biosamples/1/': {
+            'status': 'released',
+            'biosample_ontology': '/biosample-types/cell_line/',
+            'applied_modifications': ['/genetic-modifications/1/'],
+        },
+        '/biosample-types/cell_line/': {'classification': 'cell line'},
+        '/genetic-modifications/1/': {'method': 'CRISPR'},
+    }
+    load_items = mocker.patch('encoded.types.shared_calculated_properties.load_items')
+    request = mocker.MagicMock()
+    request._embedded_objects = {}
+    request.embed.side_effect = lambda path, view: objects[path]
+    graph = replicate_graph(request, ['/replicates/1/', '/replicates/2/'])
+    assert graph == objects
+    assert request.embed.call_count == len(objects)
+    assert [set(call[0][1]) for call in load_items.call_args_list] == [
+        {'/replicates/1/', '/replicates/2/'},
+        {'/libraries/1/', '/libraries/2/'},
+        {'/biosamples/1/'},
+        {'/biosample-types/cell_line/', '/genetic-modifications/1/'},
+    ]
+    views = {call[0][0]: call[0][1] for call in request.embed.call_args_list}
+    assert views['/replicates/1/'] == '@@object'
+    assert views['/libraries/1/'] == '@@object?skip_calculated=true'
+    assert views['/biosamples/1/'] == '@@object'
+    assert views['/genetic-modifications/1/'] == '@@object?skip_calculated=true'
+    assert replicate_graph(request, ['/replicates/1/'])['/biosamples/1/'] is objects['/biosamples/1/']
+    assert request.embed.call_count == len(objects)
@@ -360,3 +360,67 @@ def test_file_reset_file_upload_bucket_on_upload_credentials(testapp, root, dumm
     external = file_item._get_external_sheet()
     assert external.get('bucket') == 'test_file_bucket'
     assert res.json['@graph'][0]['upload_credentials']['upload_url'] == 's3://test_file_bucket/xyz.bed'
+
+
+def test_property_closure_uses_recursive_query(mocker):
+    from encoded.types.file import property_closure
+    request = mocker.MagicMock()
+    request.datastore = 'database'
+    request._embedded_uuids = set()
+    session = request.registry.get.return_value.return_value
+    session.get_bind.return_value.dialect.name = 'postgresql'
+    session.execute.return_value = [('a-uuid',), ('b-uuid',)]
+    assert property_closure(request, 'derived_from', 'a-uuid') == {'a-uuid', 'b-uuid'}
+    assert session.execute.call_args[0][1] == {'root_uuid': 'a-uuid', 'propname': 'derived_from'}
+    assert request._embedded_uuids == {'a-uuid', 'b-uuid'}
+
+
+def test_property_closure_walks_items_without_database(mocker):
+    from encoded.types.file import property_closure
+    derived_from = {'a-uuid': ['b-uuid'], 'b-uuid': ['a-uuid', 'c-uuid'], 'c-uuid': []}
+    request = mocker.MagicMock()
+    request.datastore = 'elasticsearch'
+
+    class Item:
+        def __init__(self, uuid):
+            self.uuid = uuid
+
+        def __json__(self, request):
+            return {'derived_from': derived_from[self.uuid]}
+
+    request.registry.__getitem__.return_value.get_by_uuid.side_effect = Item
+    assert property_closure(request, 'derived_from', 'a-uuid') == {'a-uuid', 'b-uuid', 'c-uuid'}
+    assert not request.registry.get.called
+
+
+def test_property_closure_query_matches_item_walk(testapp, dummy_request, lab, award, experiment, mocker):
+    from encoded.types import file as file_module
+    files = []
+    for i in range(4):
+        item = {
+            'dataset': experiment['@id'],
+            'file_format': 'fasta',
+            'md5sum': '{:032x}'.format(i + 1),
+            'output_type': 'raw data',
+            'lab': lab['@id'],
+            'file_size': 34,
+            'award': award['@id'],
+            'status': 'in progress',  # avoid s3 upload codepath
+        }
+        if files:
+            item['derived_from'] = [files[-1]['@id']]
+        files.append(testapp.post_json('/file', item).json['@graph'][0])
+    # files[3] -> files[2] -> files[1] -> files[0] -> files[2] is a cycle
+    testapp.patch_json(files[0]['@id'], {'derived_from': [files[2]['@id']]})
+    dummy_request._embedded_uuids = set()
+    assert file_module.database_session(dummy_request) is not None
+    closures = {
+        f['uuid']: file_module.property_closure(dummy_request, 'derived_from', f['uuid'])
+        for f in files
+    }
+    assert closures[files[3]['uuid']] == {f['uuid'] for f in files}
+    assert closures[files[0]['uuid']] == {f['uuid'] for f in files[:3]}
+    assert dummy_request._embedded_uuids == {f['uuid'] for f in files}
+    mocker.patch.object(file_module, 'database_session', return_value=None)
+    for f in files:
+        assert file_module.property_closure(dummy_request, 'derived_from', f['uuid']) == closures[f['uuid']]
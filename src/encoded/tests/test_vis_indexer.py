@@ -0,0 +1,177 @@
+import pytest
+
+
+@pytest.fixture
+def vis_cache(mocker):
+    from encoded.vis_defines import VisCache
+    request = mocker.MagicMock()
+    request.registry.get.return_value.indices.exists.return_value = True
+    return VisCache(request, bulk_size=2)
+
+
+def test_vis_cache_add_buffers_and_flushes_in_bulk(vis_cache, mocker):
+    bulk = mocker.patch('encoded.vis_defines.bulk', side_effect=lambda es, actions, **kw: (len(actions), []))
+    vis_cache.add('ENCSR000AAA_hg19', {'vis_id': 'ENCSR000AAA_hg19'})
+    assert not bulk.called
+    vis_cache.add('ENCSR000AAB_hg19', {'vis_id': 'ENCSR000AAB_hg19'})
+    vis_cache.add('ENCSR000AAC_hg19', {'vis_id': 'ENCSR000AAC_hg19'})
+    vis_cache.flush()
+    assert [
+        [action['_id'] for action in call[0][1]] for call in bulk.call_args_list
+    ] == [['ENCSR000AAA_hg19', 'ENCSR000AAB_hg19'], ['ENCSR000AAC_hg19']]
+    assert not vis_cache.es.index.called
+    # The index is only checked once
+    assert vis_cache.es.indices.exists.call_count == 1
+    vis_cache.flush()
+    assert bulk.call_count == 2
+
+
+def test_vis_cache_flush_returns_failed_datasets(vis_cache, mocker):
+    def bulk(es, actions, **kw):
+        errors = [
+            {'index': {'_type': action['_type'], '_id': action['_id'], 'status': 429}}
+            for action in actions if action['_id'] == 'ENCSR000AAB_hg19'
+        ]
+        return (len(actions) - len(errors), errors)
+    mocker.patch('encoded.vis_defines.bulk', side_effect=bulk)
+    vis_cache.bulk_size = 10
+    vis_cache.add('ENCSR000AAA_hg19', {})
+    vis_cache.add_fingerprint('a', 'fa')
+    vis_cache.add('ENCSR000AAB_hg19', {})
+    vis_cache.add('ENCSR000AAB_mm10', {})
+    vis_cache.add_fingerprint('b', 'fb')
+    assert vis_cache.flush() == {'b'}
+    vis_cache.add('ENCSR000AAC_hg19', {})
+    vis_cache.add_fingerprint('c', 'fc')
+    assert vis_cache.flush() == {'b'}
+
+
+def test_vis_cache_fingerprints_written_after_vis_blobs(vis_cache, mocker):
+    def bulk(es, actions, **kw):
+        errors = [
+            {'index': {'_type': action['_type'], '_id': action['_id'], 'status': 429}}
+            for action in actions if action['_id'] == 'ENCSR000AAB_hg19'
+        ]
+        return (len(actions) - len(errors), errors)
+    bulk = mocker.patch('encoded.vis_defines.bulk', side_effect=bulk)
+    vis_cache.add('ENCSR000AAA_hg19', {})
+    vis_cache.add_fingerprint('a', 'fa')
+    # The second vis_blob fills the buffer, its dataset's fingerprint comes after the flush
+    vis_cache.add('ENCSR000AAB_hg19', {})
+    vis_cache.add_fingerprint('b', 'fb')
+    vis_cache.add('ENCSR000AAC_hg19', {})
+    vis_cache.add_fingerprint('c', 'fc')
+    assert vis_cache.flush() == {'b'}
+    assert [
+        [(action['_type'], action['_id']) for action in call[0][1]] for call in bulk.call_args_list
+    ] == [
+        [('default', 'ENCSR000AAA_hg19'), ('default', 'ENCSR000AAB_hg19')],
+        [('fingerprint', 'a')],
+        [('default', 'ENCSR000AAC_hg19')],
+        [('fingerprint', 'c')],
+    ]
+
+
+def test_vis_cache_search_mget(vis_cache):
+    vis_cache.es.mget.return_value = {'docs': [
+        {'_id': 'ENCSR000AAA_hg19', 'found': True, '_source': {'vis_id': 'ENCSR000AAA_hg19'}},
+        {'_id': 'ENCSR000AAB_hg19', 'found': False},
+    ]}
+    assert vis_cache.search(['ENCSR000AAA', 'ENCSR000AAB'], 'hg19') == {
+        'ENCSR000AAA_hg19': {'vis_id': 'ENCSR000AAA_hg19'}
+    }
+    vis_cache.es.mget.assert_called_once_with(
+        index='vis_cache', doc_type='default', body={'ids': ['ENCSR000AAA_hg19', 'ENCSR000AAB_hg19']}
+    )
+    assert vis_cache.search([], 'hg19') == {}
+    assert vis_cache.es.mget.call_count == 1
+
+
+@pytest.fixture
+def vis_indexer(mocker):
+    from encoded.vis_indexer import VisIndexer
+    indexer = VisIndexer.__new__(VisIndexer)
+    indexer.state = mocker.MagicMock()
+    indexer.esstorage = mocker.MagicMock()
+    indexer.bulk_size = 3
+    indexer.processes = 1
+    indexer.pool = None
+    return indexer
+
+
+def test_vis_indexer_update_objects_serial(vis_indexer, mocker):
+    vis_cache = mocker.patch('encoded.vis_indexer.VisCache').return_value
+    vis_cache.fingerprints.return_value = {'d': 'unchanged'}
+    mocker.patch('encoded.vis_indexer.vis_fingerprint', return_value='unchanged')
+    mocker.patch(
+        'encoded.vis_indexer.vis_cache_add',
+        side_effect=lambda request, dataset, **kw: [dataset] if dataset.get('accession') else []
+    )
+    vis_indexer.esstorage.get_by_uuid.side_effect = lambda uuid: mocker.MagicMock(
+        source={'embedded': {'accession': 'ENCSR000AAA'} if uuid != 'b' else {}}
+    )
+    assert vis_indexer.update_objects(mocker.MagicMock(), ['a', 'b', 'c', 'd'], 1) == []
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['a', 'c'])
+    vis_indexer.state.skipped_uuids.assert_called_once_with(['d'])
+    # Fingerprints are fetched a bulk_size at a time and written for every rebuilt dataset
+    assert [call[0][0] for call in vis_cache.fingerprints.call_args_list] == [['a', 'b', 'c'], ['d']]
+    assert [call[0][0] for call in vis_cache.add_fingerprint.call_args_list] == ['a', 'b', 'c']
+
+
+def test_vis_indexer_update_objects_failed_writes(vis_indexer, mocker):
+    vis_cache = mocker.patch('encoded.vis_indexer.VisCache').return_value
+    vis_cache.fingerprints.return_value = {}
+    vis_cache.flush.return_value = {'b'}
+    mocker.patch('encoded.vis_indexer.vis_fingerprint', return_value='changed')
+    mocker.patch('encoded.vis_indexer.vis_cache_add', return_value=[{}])
+    vis_indexer.esstorage.get_by_uuid.return_value = mocker.MagicMock(source={'embedded': {}})
+    errors = vis_indexer.update_objects(mocker.MagicMock(), ['a', 'b'], 1)
+    assert [error['uuid'] for error in errors] == ['b']
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['a'])
+
+
+def test_vis_indexer_update_objects_forced(vis_indexer, mocker):
+    vis_cache = mocker.patch('encoded.vis_indexer.VisCache').return_value
+    mocker.patch('encoded.vis_indexer.vis_fingerprint', return_value='unchanged')
+    mocker.patch('encoded.vis_indexer.vis_cache_add', return_value=[{}])
+    vis_indexer.esstorage.get_by_uuid.return_value = mocker.MagicMock(source={'embedded': {}})
+    assert vis_indexer.update_objects(mocker.MagicMock(), ['a'], 1, force=True) == []
+    assert not vis_cache.fingerprints.called
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['a'])
+
+
+def test_vis_indexer_update_objects_pool(vis_indexer, mocker):
+    vis_indexer.processes = 2
+    vis_indexer.pool = mocker.MagicMock()
+    vis_indexer.pool.imap_unordered.side_effect = lambda task, shards: [
+        ([uuid for uuid in shard if uuid != 'e'], [], [{'uuid': 'e'}] if 'e' in shard else [], len(shard))
+        for (shard, force) in shards
+    ]
+    uuids = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+    assert vis_indexer.update_objects(mocker.MagicMock(), uuids, 1) == [{'uuid': 'e'}]
+    (task, shards) = vis_indexer.pool.imap_unordered.call_args[0]
+    assert shards == [(['a', 'b', 'c'], False), (['d', 'e', 'f'], False), (['g'], False)]
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['a', 'b', 'c', 'd', 'f', 'g'])
+    assert not vis_indexer.state.viscached_uuid.called
+
+
+def test_vis_indexer_vis_fingerprint(mocker):
+    from encoded.visualization import vis_fingerprint
+    request = mocker.MagicMock()
+    request.registry.settings = {'snovault.app_version': 'v1'}
+    dataset = {
+        'accession': 'ENCSR000AAA',
+        'assay_term_name': 'ChIP-seq',
+        'audit': {'WARNING': []},
+        'files': [{'accession': 'ENCFF000AAA', 'status': 'released', 'date_created': '2019-01-01'}],
+    }
+    fingerprint = vis_fingerprint(request, dataset)
+    # Audits and file fields that tracks don't use don't change it
+    dataset['audit'] = {'ERROR': [{'category': 'missing documents'}]}
+    dataset['files'][0]['date_created'] = '2019-01-02'
+    assert vis_fingerprint(request, dataset) == fingerprint
+    dataset['files'][0]['status'] = 'revoked'
+    assert vis_fingerprint(request, dataset) != fingerprint
+    dataset['files'][0]['status'] = 'released'
+    request.registry.settings['snovault.app_version'] = 'v2'
+    assert vis_fingerprint(request, dataset) != fingerprint
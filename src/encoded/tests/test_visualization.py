@@ -0,0 +1,86 @@
+import pytest
+
+
+def test_visualization_rendered_text_cache_bounds(mocker):
+    from encoded.visualization import RenderedTextCache
+    cache = RenderedTextCache(max_bytes=10, ttl=60)
+    (body, etag, rendered) = cache.set('a', b'12345')
+    assert cache.get('a') == (body, etag, rendered)
+    cache.set('b', b'12345')
+    assert cache.get('a') is not None  # 'b' is now least recently used
+    cache.set('c', b'1')
+    assert cache.get('b') is None
+    assert cache.size == 6
+    # Too big to cache, but still rendered
+    assert cache.set('d', b'12345678901')[0] == b'12345678901'
+    assert cache.get('d') is None
+    mocker.patch('encoded.visualization.time.time', return_value=rendered + 61)
+    assert cache.get('a') is None
+
+
+@pytest.fixture
+def hub_request(mocker):
+    from encoded.visualization import TRACKDB_CACHE, RenderedTextCache
+    request = mocker.MagicMock()
+    request.registry = {TRACKDB_CACHE: RenderedTextCache()}
+    request.url = 'http://localhost/batch_hub/type=Experiment,,assay_title=RNA-seq/hg19/trackDb.txt'
+    request.host_url = 'http://localhost'
+    request.path_info = '/batch_hub/type=Experiment,,assay_title=RNA-seq/hg19/trackDb.txt'
+    request.matchdict = {'search_params': 'type=Experiment,,assay_title=RNA-seq', 'assembly': 'hg19'}
+    request.query_string = ''
+    request.effective_principals = ['system.Everyone']
+    request.headers = {}
+    request.if_none_match = set()
+    mocker.patch('encoded.visualization.VisCache').return_value.generation.return_value = '1'
+    return request
+
+
+def test_visualization_respond_with_cached_text_ranges(hub_request, mocker):
+    from encoded.visualization import respond_with_cached_text
+    generate = mocker.MagicMock(return_value='track one\ntrack two\n')
+    response = respond_with_cached_text(hub_request, 'text/plain', generate)
+    assert response.body == b'track one\ntrack two\n'
+    etag = response.etag
+    # Same search in another order, asking for a range
+    hub_request.path_info = '/batch_hub/assay_title=RNA-seq,,type=Experiment/hg19/trackDb.txt'
+    hub_request.matchdict['search_params'] = 'assay_title=RNA-seq,,type=Experiment'
+    hub_request.headers = {'Range': 'bytes=10-'}
+    response = respond_with_cached_text(hub_request, 'text/plain', generate)
+    assert response.body == b'track two\n'
+    assert response.content_range == 'bytes 10-19/20'
+    assert response.status_code == 206
+    hub_request.if_none_match = {etag}
+    assert respond_with_cached_text(hub_request, 'text/plain', generate).status_code == 304
+    assert generate.call_count == 1
+
+
+def test_visualization_respond_with_cached_text_new_generation(hub_request, mocker):
+    from encoded.visualization import respond_with_cached_text
+    generate = mocker.MagicMock(return_value='track one\n')
+    respond_with_cached_text(hub_request, 'text/plain', generate)
+    from encoded.visualization import VisCache
+    VisCache.return_value.generation.return_value = '2'
+    respond_with_cached_text(hub_request, 'text/plain', generate)
+    assert generate.call_count == 2
+
+
+def test_visualization_compiled_masks(mocker):
+    from encoded.vis_defines import VisDefines, compile_mask
+    dataset = {
+        'accession': 'ENCSR000AAA',
+        'assay_title': 'TF ChIP-seq',
+        'target': {'label': 'CTCF'},
+        'biosample_ontology': {'term_name': 'K562'},
+        'lab': {'title': 'ENCODE Lab'},
+    }
+    a_file = {'accession': 'ENCFF000AAA', 'output_type': 'signal p-value', 'rep_tech': 'rep2_1', 'rep_tag': 'rep02'}
+    vis_defines = VisDefines(mocker.MagicMock(), dataset)
+    mask = '{target} {assay_title} of {biosample_term_name} {replicate} - {file.accession} {bogus}'
+    compiled = compile_mask(mask)
+    assert compiled is compile_mask(mask)
+    assert compiled[1] == ' '
+    assert compiled[-1] == 'unknown token'
+    assert vis_defines.convert_mask(mask, dataset, a_file) == \
+        'CTCF TF ChIP-seq of K562 rep2 - ENCFF000AAA unknown token'
+    # Without a file, other tokens are looked up in the dataset
+    assert vis_defines.convert_mask('{lab.title}: {output_type}') == 'ENCODE Lab: unknown'
@@ -7,6 +7,7 @@ from snovault import (
 from pyramid.traversal import find_root
 from .base import (
     Item,
+    embedded_object,
     paths_filtered_by_status,
     ALLOW_CURRENT,
     DELETED,
@@ -17,6 +18,7 @@ def includeme(config):
     config.scan()
     config.add_request_method(lambda request: set(), '_set_status_changed_paths', reify=True)
     config.add_request_method(lambda request: set(), '_set_status_considered_paths', reify=True)
+    config.add_request_method(lambda request: {}, '_embedded_objects', reify=True)
 
 
 @collection(
@@ -216,7 +218,7 @@ class Library(Item):
     def antibodies(self, request, replicates):
         antibodies = []
         for rep_id in replicates:
-            rep = request.embed(rep_id, '@@object?skip_calculated=true')
+            rep = embedded_object(request, rep_id, '@@object?skip_calculated=true')
             if 'antibody' in rep:
                 antibodies.append(rep['antibody'])
         return antibodies or None
@@ -23,10 +23,23 @@ import snovault
 from snovault.validation import ValidationFailure
 from snovault.schema_utils import validate_request
 from snovault.auditor import traversed_path_ids
+from snovault.cache import ManagerLRUCache
+from snovault.storage import (
+    Key,
+    Resource,
+)
 from snovault import (
     AfterModified,
-    BeforeModified
+    BeforeModified,
+    CONNECTION,
+    DBSESSION,
+)
+from sqlalchemy import (
+    and_,
+    false,
+    tuple_,
 )
+from uuid import UUID
 
 
 @lru_cache()
@@ -114,16 +127,147 @@ STATUS_HIERARCHY = {
 }
 
 
+# Upgraded properties of items read by the status filters, shared by all the
+# calculated properties rendered for one request and dropped with its
+# transaction like snovault's embed cache.
+# Capacity set with encoded.types.item_properties_cache.capacity
+item_properties_cache = ManagerLRUCache('encoded.types.item_properties_cache', 5000)
+
+
+def database_session(request):
+    '''
+    Return the postgres session of request, or None when it reads from
+    elasticsearch or other storage, which the batched queries do not cover.
+    '''
+    if getattr(request, 'datastore', 'database') != 'database':
+        return None
+    DBSession = request.registry.get(DBSESSION)
+    if DBSession is None:
+        return None
+    session = DBSession()
+    if session.get_bind().dialect.name != 'postgresql':
+        return None
+    return session
+
+
+def _key_match(keys):
+    return tuple_(Key.name, Key.value).in_(sorted(keys)) if keys else false()
+
+
+def cache_item(conn, model, key=None):
+    '''
+    Cache the item of a stored model in conn the way snovault's
+    Connection.get_by_uuid and Connection.get_by_unique_key do after their
+    storage lookups, so that they then return it without one. Keep in step
+    with those methods.
+    '''
+    type_info = conn.types.by_item_type.get(model.item_type)
+    if type_info is None:
+        # Left for get_by_uuid to raise UnknownItemTypeError
+        return
+    uuid = str(model.uuid)
+    if conn.item_cache.get(uuid) is None:
+        item = type_info.factory(conn.registry, model)
+        model.used_for(item)
+        conn.item_cache[uuid] = item
+    if key is not None:
+        conn.unique_key_cache[(key.name, key.value)] = model.uuid
+
+
+def load_items(request, paths):
+    '''
+    Load the items at paths from the database in one query into the
+    connection's item cache, so that traversing them afterwards needs no
+    further round trips. Items named by a unique key (accessions) are also
+    added to the connection's unique key cache.
+    '''
+    session = database_session(request)
+    if session is None:
+        return
+    conn = request.registry[CONNECTION]
+    rids = set()
+    keys = set()
+    for path in paths:
+        names = [name for name in path.split('/') if name]
+        if not names:
+            continue
+        try:
+            rid = UUID(names[-1])
+        except ValueError:
+            pass
+        else:
+            if conn.item_cache.get(str(rid)) is None:
+                rids.add(rid)
+            continue
+        if len(names) != 2:
+            continue
+        unique_key = getattr(request.root.collections.get(names[0]), 'unique_key', None)
+        if unique_key is not None and conn.unique_key_cache.get((unique_key, names[1])) is None:
+            keys.add((unique_key, names[1]))
+    if not rids and not keys:
+        return
+    wanted = [
+        session.query(Resource.rid).filter(Resource.rid.in_(sorted(rids)) if rids else false()),
+        session.query(Key.rid).filter(_key_match(keys)),
+    ]
+    # Resource eagerly joins its current propsheets, so this one query loads
+    # the properties too. The keys are joined again for their names.
+    query = session.query(Resource, Key).outerjoin(
+        Key, and_(Key.rid == Resource.rid, _key_match(keys))
+    ).filter(Resource.rid.in_(wanted[0].union(wanted[1])))
+    for (model, key) in query:
+        cache_item(conn, model, key)
+
+
+def item_properties(request, paths):
+    '''
+    Return the upgraded properties of the items at paths keyed by path.
+    Each item is traversed and upgraded once per request, later lookups
+    only record it as embedded in the current (sub)request. Items not seen
+    yet in the request are loaded from the database together first.
+    '''
+    results = {}
+    load_items(request, {
+        path for path in paths if item_properties_cache.get(path) is None
+    })
+    for path in paths:
+        if path in results:
+            continue
+        cached = item_properties_cache.get(path)
+        if cached is None:
+            context = traverse(request.root, path)['context']
+            properties = context.__json__(request)
+            cached = (getattr(context, 'uuid', None), properties)
+            item_properties_cache[path] = cached
+        elif cached[0] is not None:
+            request._embedded_uuids.add(str(cached[0]))
+        results[path] = cached[1]
+    return results
+
+
+def embedded_object(request, path, view='@@object'):
+    '''
+    request.embed of path, made once per request. The calculated properties
+    of an item are rendered with the same request and share these objects,
+    so they must not be modified.
+    '''
+    key = (path, view)
+    if key not in request._embedded_objects:
+        request._embedded_objects[key] = request.embed(path, view)
+    return request._embedded_objects[key]
+
+
 def paths_filtered_by_status(request, paths, exclude=('deleted', 'replaced'), include=None):
+    properties = item_properties(request, paths)
     if include is not None:
         return [
             path for path in paths
-            if traverse(request.root, path)['context'].__json__(request).get('status') in include
+            if properties[path].get('status') in include
         ]
     else:
         return [
             path for path in paths
-            if traverse(request.root, path)['context'].__json__(request).get('status') not in exclude
+            if properties[path].get('status') not in exclude
         ]
 
 
@@ -6,6 +6,7 @@ from snovault import (
 )
 from .base import (
     Item,
+    item_properties,
     paths_filtered_by_status,
 )
 
@@ -36,15 +37,16 @@ import datetime
 
 
 def item_is_revoked(request, path):
-    return request.embed(path, '@@object?skip_calculated=true').get('status') == 'revoked'
+    return item_properties(request, [path])[path].get('status') == 'revoked'
 
 
 def calculate_assembly(request, files_list, status):
     assembly = set()
     viewable_file_status = ['released','in progress']
 
+    files_properties = item_properties(request, files_list)
     for path in files_list:
-        properties = request.embed(path, '@@object?skip_calculated=true')
+        properties = files_properties[path]
         if properties['status'] in viewable_file_status:
             if 'assembly' in properties:
                 assembly.add(properties['assembly'])
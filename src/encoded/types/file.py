@@ -13,6 +13,8 @@ from snovault.schema_utils import schema_validator
 from snovault.validation import ValidationFailure
 from .base import (
     Item,
+    database_session,
+    embedded_object,
     paths_filtered_by_status
 )
 from pyramid.httpexceptions import (
@@ -23,6 +25,7 @@ from pyramid.httpexceptions import (
 from pyramid.settings import asbool
 from pyramid.traversal import traverse
 from pyramid.view import view_config
+from sqlalchemy.sql import text
 from urllib.parse import (
     parse_qs,
     urlparse,
@@ -54,7 +57,39 @@ def show_cloud_metadata(status=None, md5sum=None, file_size=None, restricted=Non
     return True
 
 
+# UNION (not UNION ALL) drops rows already in the closure, which also stops
+# the recursion on cycles.
+PROPERTY_CLOSURE_QUERY = text('''
+WITH RECURSIVE closure(rid) AS (
+    SELECT CAST(:root_uuid AS uuid)
+    UNION
+    SELECT CAST(target.rid AS uuid)
+    FROM closure
+    JOIN current_propsheets
+        ON current_propsheets.rid = closure.rid AND current_propsheets.name = ''
+    JOIN propsheets ON propsheets.sid = current_propsheets.sid
+    CROSS JOIN LATERAL jsonb_array_elements_text(
+        CASE WHEN jsonb_typeof(propsheets.properties -> :propname) = 'array'
+        THEN propsheets.properties -> :propname END
+    ) AS target(rid)
+)
+SELECT rid FROM closure
+''')
+
+
 def property_closure(request, propname, root_uuid):
+    # The recursive query needs the postgres database, requests reading
+    # from elasticsearch and other storage walk the items instead.
+    session = database_session(request)
+    if session is not None:
+        result = session.execute(
+            PROPERTY_CLOSURE_QUERY,
+            {'root_uuid': str(root_uuid), 'propname': propname})
+        seen = {str(rid) for rid, in result}
+        # Record the items as embedded, like __json__ does, so changes to
+        # any of them invalidate the calculated property
+        request._embedded_uuids.update(seen)
+        return seen
     # Must avoid cycles
     conn = request.registry[CONNECTION]
     seen = set()
@@ -336,7 +371,7 @@ class File(Item):
         # self.uuid can be skipped. It should be skipped here to avoid infinite
         # embedding/calculating loop
         derived_from_closure = property_closure(request, 'derived_from', self.uuid) - {str(self.uuid)}
-        obj_props = (request.embed(uuid, '@@object')
+        obj_props = (embedded_object(request, uuid)
                      for uuid in derived_from_closure)
         # dataset is a required property of file and should be @id which
         # matches props['dataset']
@@ -9,10 +9,52 @@ from encoded.vis_defines import (
 from .biosample import construct_biosample_summary
 from .shared_biosample import biosample_summary_information
 from .base import (
+    embedded_object,
+    load_items,
     paths_filtered_by_status
 )
 
 
+# Links followed from replicates down to the biosamples and their genetic
+# modifications, hop by hop, with the view each linked object is embedded
+# with. Replicates need their calculated libraries and biosamples their
+# calculated applied_modifications and summary fields, the others are only
+# read for stored properties so skip their calculated properties.
+REPLICATE_GRAPH_LINKS = (
+    ('library', '@@object?skip_calculated=true'),
+    ('libraries', '@@object?skip_calculated=true'),
+    ('biosample', '@@object'),
+    ('biosample_ontology', '@@object?skip_calculated=true'),
+    ('applied_modifications', '@@object?skip_calculated=true'),
+)
+
+
+def replicate_graph(request, replicates):
+    '''
+    Embed the replicate -> library -> biosample -> genetic modification
+    subgraph of a dataset breadth-first, and return the object of every node
+    keyed by path. The items of each level are loaded from the database
+    together before they are embedded, and objects are embedded once per
+    request so the calculated properties walking the same replicates share
+    them.
+    '''
+    graph = {}
+    level = [(path, '@@object') for path in replicates or []]
+    while level:
+        load_items(request, {path for (path, view) in level if path not in graph})
+        next_level = []
+        for (path, view) in level:
+            if path in graph:
+                continue
+            graph[path] = embedded_object(request, path, view)
+            for (link, link_view) in REPLICATE_GRAPH_LINKS:
+                next_level.extend(
+                    (linked, link_view) for linked in ensurelist(graph[path].get(link, []))
+                )
+        level = next_level
+    return graph
+
+
 class CalculatedAssaySynonyms:
     @calculated_property(condition='assay_term_id', schema={
         "title": "Assay synonyms",
@@ -220,16 +262,17 @@ class CalculatedBiosampleSummary:
         dictionaries_of_phrases = []
         biosample_accessions = set()
         if replicates is not None:
+            graph = replicate_graph(request, replicates)
             for rep in replicates:
-                replicateObject = request.embed(rep, '@@object')
+                replicateObject = graph[rep]
                 if replicateObject['status'] == 'deleted':
                     continue
                 if 'library' in replicateObject:
-                    libraryObject = request.embed(replicateObject['library'], '@@object')
+                    libraryObject = graph[replicateObject['library']]
                     if libraryObject['status'] == 'deleted':
                         continue
                     if 'biosample' in libraryObject:
-                        biosampleObject = request.embed(libraryObject['biosample'], '@@object')
+                        biosampleObject = graph[libraryObject['biosample']]
                         if biosampleObject['status'] == 'deleted':
                             continue
                         if biosampleObject['accession'] not in biosample_accessions:
@@ -313,14 +356,15 @@ class CalculatedAssayTitle:
             preferred_name = registry['ontology'][assay_term_id].get('preferred_name',
                                                                      assay_term_name)
             if preferred_name == 'RNA-seq' and replicates is not None:
+                graph = replicate_graph(request, replicates)
                 for rep in replicates:
-                    replicate_object = request.embed(rep, '@@object')
+                    replicate_object = graph[rep]
                     if replicate_object['status'] == 'deleted':
                         continue
                     if 'libraries' in replicate_object:
                         preferred_name = 'total RNA-seq'
                         for lib in replicate_object['libraries']:
-                            library_object = request.embed(lib, '@@object')
+                            library_object = graph[lib]
                             if 'size_range' in library_object and \
                             library_object['size_range'] == '<200':
                                 preferred_name = 'small RNA-seq'
@@ -339,22 +383,23 @@ class CalculatedAssayTitle:
                         preferred_name = 'TF ChIP-seq'
             elif preferred_name == 'CRISPR screen' and not control_type and replicates is not None:
                 CRISPR_gms = []
+                graph = replicate_graph(request, replicates)
                 for rep in replicates:
-                    replicate_object = request.embed(rep, '@@object?skip_calculated=true')
+                    replicate_object = graph[rep]
                     if replicate_object['status'] in ('deleted', 'revoked'):
                         continue
                     if 'library' in replicate_object:
-                        library_object = request.embed(replicate_object['library'], '@@object?skip_calculated=true')
+                        library_object = graph[replicate_object['library']]
                         if library_object['status'] in ('deleted', 'revoked'):
                             continue
                         if 'biosample' in library_object:
-                            biosample_object = request.embed(library_object['biosample'], '@@object')
+                            biosample_object = graph[library_object['biosample']]
                             if biosample_object['status'] in ('deleted', 'revoked'):
                                 continue
                             genetic_modifications = biosample_object.get('applied_modifications')
                             if genetic_modifications:
                                 for gm in genetic_modifications:
-                                    gm_object = request.embed(gm, '@@object?skip_calculated=true')
+                                    gm_object = graph[gm]
                                     if gm_object.get('purpose') == 'characterization' and gm_object.get('method') == 'CRISPR':
                                         CRISPR_gms.append(gm_object['category'])
                 # Return a specific CRISPR assay title if there is only one category type for CRISPR characterization genetic modifications for all replicate biosample genetic modifications
@@ -443,8 +488,9 @@ class CalculatedReplicationType:
         # possible technical replicates belong to the biological replicate.
         # TODO: change this once we remove technical_replicate_number.
         bio_rep_dict = {}
+        graph = replicate_graph(request, replicates)
         for rep in replicates:
-            replicate_object = request.embed(rep, '@@object')
+            replicate_object = graph[rep]
             if replicate_object['status'] == 'deleted':
                 continue
             bio_rep_num = replicate_object['biological_replicate_number']
@@ -462,12 +508,14 @@ class CalculatedReplicationType:
 
         for replicate_object in bio_rep_dict.values():
             if 'libraries' in replicate_object and replicate_object['libraries']:
-                biosamples = request.select_distinct_values(
-                    'biosample', *replicate_object['libraries']
-                )
+                biosamples = list({
+                    biosample
+                    for library in replicate_object['libraries']
+                    for biosample in ensurelist(graph[library].get('biosample', []))
+                })
                 if biosamples:
                     for b in biosamples:
-                        biosample_object = request.embed(b, '@@object')
+                        biosample_object = graph[b]
                         biosample_donor_list.append(
                             biosample_object.get('donor')
                         )
@@ -475,10 +523,7 @@ class CalculatedReplicationType:
                             replicate_object.get('biological_replicate_number')
                         )
                         biosample_species = biosample_object.get('organism')
-                        biosample_type_object = request.embed(
-                            biosample_object['biosample_ontology'],
-                            '@@object'
-                        )
+                        biosample_type_object = graph[biosample_object['biosample_ontology']]
                         biosample_type = biosample_type_object.get('classification')
                 else:
                     # special treatment for "RNA Bind-n-Seq" they will be called unreplicated
@@ -4,6 +4,7 @@ from pyramid.compat import bytes_
 from snovault import Item
 from collections import OrderedDict
 from copy import deepcopy
+import hashlib
 import json
 import os
 from urllib.parse import (
@@ -11,6 +12,7 @@ from urllib.parse import (
     urlencode,
 )
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+from elasticsearch.helpers import bulk
 import time
 from pkg_resources import resource_filename
 
@@ -412,6 +414,10 @@ BIOSAMPLE_COLOR = {
     }
 
 VIS_CACHE_INDEX = "vis_cache"
+VIS_CACHE_BULK_SIZE = 500  # buffered vis_blobs per bulk write. Set with visindexer_bulk_size
+VIS_CACHE_GENERATION_ID = "vis_cache_generation"  # Changed by the vis indexer whenever it writes vis_blobs
+VIS_CACHE_FINGERPRINT_TYPE = "fingerprint"  # dataset uuid: fingerprint of what its vis_blobs were built from
+VIS_DEFS_FINGERPRINT = None
 
 
 class Sanitize(object):
@@ -505,12 +511,27 @@ class VisDefines(object):
                     vis_def = json.load(fh)
                     # Could alter vis_defs here if desired.
                     if vis_def:
+                        compile_vis_def_masks(vis_def)
                         VIS_DEFS_BY_TYPE.update(vis_def)
 
         self.vis_defs = VIS_DEFS_BY_TYPE
         VIS_DEFS_DEFAULT = self.vis_defs.get("opaque",{})
         self.vis_def_default = VIS_DEFS_DEFAULT
 
+    def vis_defs_fingerprint(self):
+        '''Returns a hash of the vis_def static files, which vis_blobs are also built from.'''
+        global VIS_DEFS_FINGERPRINT
+        if VIS_DEFS_FINGERPRINT is None:
+            folder = resource_filename(__name__, VIS_DEFS_FOLDER)
+            digest = hashlib.sha1()
+            for filename in sorted(os.listdir(folder)):
+                if filename.endswith('.json'):
+                    with open(folder + filename, 'rb') as fh:
+                        digest.update(filename.encode('utf-8'))
+                        digest.update(fh.read())
+            VIS_DEFS_FINGERPRINT = digest.hexdigest()
+        return VIS_DEFS_FINGERPRINT
+
     def get_vis_type(self):
         '''returns the best visualization definition type, based upon dataset.'''
         assert(self.dataset is not None)
@@ -737,162 +758,163 @@ class VisDefines(object):
     def lookup_token(self, token, dataset, a_file=None):
         '''Encodes the string to swap special characters and remove spaces.'''
         # dataset might not be self.dataset
-
         if token not in SUPPORTED_MASK_TOKENS:
             log.warn("Attempting to look up unexpected token: '%s'" % token)
             return "unknown token"
+        return token_resolver(token)(self, token, dataset, a_file)
+
+    # Token resolvers: (self, token, dataset, a_file) -> value.  token_resolver() picks one per token.
+
+    def _simple_dataset_token(self, token, dataset, a_file):
+        term = dataset.get(token[1:-1])
+        if term is None:
+            return "Unknown " + token[1:-1].split('_')[0].capitalize()
+        elif isinstance(term,list) and len(term) > 3:
+            return "Collection of %d %ss" % (len(term),token[1:-1].split('_')[0].capitalize())
+        return term
+
+    def _experiment_accession(self, token, dataset, a_file):
+        return dataset['accession']
+
+    def _target_token(self, token, dataset, a_file):
+        if token == '{target}':
+            token = '{target.label}'
+        term = self.lookup_embedded_token(token, dataset)
+        if term is None and token == '{target.name}':
+            term = self.lookup_embedded_token('{target.label}', dataset)
+        if term is not None:
+            if isinstance(term, list) and len(term) > 0:
+                return term[0]
+            return term
+        return "Unknown Target"
 
-        if token in SIMPLE_DATASET_TOKENS:
-            term = dataset.get(token[1:-1])
-            if term is None:
-                return "Unknown " + token[1:-1].split('_')[0].capitalize()
-            elif isinstance(term,list) and len(term) > 3:
-                return "Collection of %d %ss" % (len(term),token[1:-1].split('_')[0].capitalize())
+    def _biosample_summary(self, token, dataset, a_file):
+        term = self.lookup_embedded_token('{replicates.library.biosample.summary}', dataset)
+        if term is None:
+            term = dataset.get("{biosample_term_name}")
+        if term is not None:
             return term
-        elif token == "{experiment.accession}":
-            return dataset['accession']
-        elif token in ["{target}", "{target.label}", "{target.name}", "{target.title}", "{target.investigated_as}"]:
-            if token == '{target}':
-                token = '{target.label}'
-            term = self.lookup_embedded_token(token, dataset)
-            if term is None and token == '{target.name}':
-                term = self.lookup_embedded_token('{target.label}', dataset)
-            if term is not None:
-                if isinstance(term, list) and len(term) > 0:
-                    return term[0]
-                return term
-            return "Unknown Target"
-        elif token in ["{replicates.library.biosample.summary}",
-                    "{replicates.library.biosample.summary|multiple}"]:
-            term = self.lookup_embedded_token('{replicates.library.biosample.summary}', dataset)
-            if term is None:
-                term = dataset.get("{biosample_term_name}")
-            if term is not None:
-                return term
-            if token.endswith("|multiple}"):
-                return "multiple biosamples"
+        if token.endswith("|multiple}"):
+            return "multiple biosamples"
+        return "Unknown Biosample"
+
+    def _biosample_term_name(self, token, dataset, a_file):
+        biosample_ontology = dataset.get('biosample_ontology')
+        if biosample_ontology is None:
             return "Unknown Biosample"
-        elif token == "{biosample_term_name}":
-            biosample_ontology = dataset.get('biosample_ontology')
-            if biosample_ontology is None:
-                return "Unknown Biosample"
-            if isinstance(biosample_ontology, dict):
-                return biosample_ontology['term_name']
-            if isinstance(biosample_ontology, list) and len(biosample_ontology) > 3:
-                return "Collection of %d Biosamples" % (len(biosample_ontology))
-            # The following got complicated because general Dataset objects
-            # cannot have biosample_ontology embedded properly. As a base class,
-            # some of the children, PublicationData, Project and 8 Series
-            # objects, have biosample_ontology embedded as array of objects,
-            # while experiment and annotation have it embedded as one single
-            # object. This becomes a problem when File object linkTo Dataset in
-            # general rather than one specific type. Current embedding system
-            # don't know how to map a property with type = ["array", "string"]
-            # in elasticsearch. Therefore, it is possible the
-            # "biosample_ontology" we got here is @id which should be embedded
-            # with the following code.
-            if not isinstance(biosample_ontology, list):
-                biosample_ontology = [biosample_ontology]
-            term_names = []
-            for type_obj in biosample_ontology:
-                if isinstance(type_obj, str):
-                    term_names.append(
-                        self._request.embed(type_obj, '@@object')['term_name']
-                    )
-                elif 'term_name' in type_obj:
-                    term_names.append(type_obj['term_name'])
-            if len(term_names) == 1:
-                return term_names[0]
-            else:
-                return term_names
-
-        elif token == "{biosample_term_name|multiple}":
-            biosample_ontology = dataset.get('biosample_ontology')
-            if biosample_ontology is None:
-                return "multiple biosamples"
-            return biosample_ontology.get('term_name')
-        # TODO: rna_species
-        # elif token == "{rna_species}":
-        #     if replicates.library.nucleic_acid = polyadenylated mRNA
-        #        rna_species = "polyA RNA"
-        #     elif replicates.library.nucleic_acid == "RNA":
-        #        if "polyadenylated mRNA" in replicates.library.depleted_in_term_name
-        #                rna_species = "polyA depleted RNA"
-        #        else
-        #                rna_species = "total RNA"
-        elif a_file is not None:
-            if token == "{file.accession}":
-                return a_file['accession']
-            #elif token == "{output_type}":
-            #    return a_file['output_type']
-            elif token == "{output_type_short_label}":
-                output_type = a_file['output_type']
-                return OUTPUT_TYPE_8CHARS.get(output_type, output_type)
-            elif token == "{replicate}":
-                rep_tag = a_file.get("rep_tag")
-                if rep_tag is not None:
-                    while len(rep_tag) > 4:
-                        if rep_tag[3] != '0':
-                            break
-                        rep_tag = rep_tag[0:3] + rep_tag[4:]
-                    return rep_tag
-                rep_tech = a_file.get("rep_tech")
-                if rep_tech is not None:
-                    return rep_tech.split('_')[0]  # Should truncate tech_rep
-                rep_tech = self.rep_for_file(a_file)
-                return rep_tech.split('_')[0]  # Should truncate tech_rep
-            elif token == "{replicate_number}":
-                rep_tag = a_file.get("rep_tag", a_file.get("rep_tech", self.rep_for_file(a_file)))
-                if not rep_tag.startswith("rep"):
-                    return "0"
-                return rep_tag[3:].split('_')[0]
-            elif token == "{biological_replicate_number}":
-                rep_tech = a_file.get("rep_tech", self.rep_for_file(a_file))
-                if not rep_tech.startswith("rep"):
-                    return "0"
-                return rep_tech[3:].split('_')[0]
-            elif token == "{technical_replicate_number}":
-                rep_tech = a_file.get("rep_tech", self.rep_for_file(a_file))
-                if not rep_tech.startswith("rep"):
-                    return "0"
-                return rep_tech.split('_')[1]
-            elif token == "{rep_tech}":
-                return a_file.get("rep_tech", self.rep_for_file(a_file))
-            else:
-                val = self.lookup_embedded_token(token, a_file)
-                if val is not None and isinstance(val, str):
-                    return val
-                return ""
+        if isinstance(biosample_ontology, dict):
+            return biosample_ontology['term_name']
+        if isinstance(biosample_ontology, list) and len(biosample_ontology) > 3:
+            return "Collection of %d Biosamples" % (len(biosample_ontology))
+        # The following got complicated because general Dataset objects
+        # cannot have biosample_ontology embedded properly. As a base class,
+        # some of the children, PublicationData, Project and 8 Series
+        # objects, have biosample_ontology embedded as array of objects,
+        # while experiment and annotation have it embedded as one single
+        # object. This becomes a problem when File object linkTo Dataset in
+        # general rather than one specific type. Current embedding system
+        # don't know how to map a property with type = ["array", "string"]
+        # in elasticsearch. Therefore, it is possible the
+        # "biosample_ontology" we got here is @id which should be embedded
+        # with the following code.
+        if not isinstance(biosample_ontology, list):
+            biosample_ontology = [biosample_ontology]
+        term_names = []
+        for type_obj in biosample_ontology:
+            if isinstance(type_obj, str):
+                term_names.append(
+                    self._request.embed(type_obj, '@@object')['term_name']
+                )
+            elif 'term_name' in type_obj:
+                term_names.append(type_obj['term_name'])
+        if len(term_names) == 1:
+            return term_names[0]
         else:
-            val = self.lookup_embedded_token(token, dataset)
-            if val is not None and isinstance(val, str):
-                return val
-            log.debug('Untranslated token: "%s"' % token)
-            return "unknown"
+            return term_names
+
+    def _biosample_term_name_multiple(self, token, dataset, a_file):
+        biosample_ontology = dataset.get('biosample_ontology')
+        if biosample_ontology is None:
+            return "multiple biosamples"
+        return biosample_ontology.get('term_name')
+    # TODO: rna_species
+    # elif token == "{rna_species}":
+    #     if replicates.library.nucleic_acid = polyadenylated mRNA
+    #        rna_species = "polyA RNA"
+    #     elif replicates.library.nucleic_acid == "RNA":
+    #        if "polyadenylated mRNA" in replicates.library.depleted_in_term_name
+    #                rna_species = "polyA depleted RNA"
+    #        else
+    #                rna_species = "total RNA"
+
+    def _embedded_dataset_token(self, token, dataset, a_file):
+        val = self.lookup_embedded_token(token, dataset)
+        if val is not None and isinstance(val, str):
+            return val
+        log.debug('Untranslated token: "%s"' % token)
+        return "unknown"
+
+    def _file_accession(self, token, dataset, a_file):
+        return a_file['accession']
+
+    def _output_type_short_label(self, token, dataset, a_file):
+        output_type = a_file['output_type']
+        return OUTPUT_TYPE_8CHARS.get(output_type, output_type)
+
+    def _replicate(self, token, dataset, a_file):
+        rep_tag = a_file.get("rep_tag")
+        if rep_tag is not None:
+            while len(rep_tag) > 4:
+                if rep_tag[3] != '0':
+                    break
+                rep_tag = rep_tag[0:3] + rep_tag[4:]
+            return rep_tag
+        rep_tech = a_file.get("rep_tech")
+        if rep_tech is not None:
+            return rep_tech.split('_')[0]  # Should truncate tech_rep
+        rep_tech = self.rep_for_file(a_file)
+        return rep_tech.split('_')[0]  # Should truncate tech_rep
+
+    def _replicate_number(self, token, dataset, a_file):
+        rep_tag = a_file.get("rep_tag", a_file.get("rep_tech", self.rep_for_file(a_file)))
+        if not rep_tag.startswith("rep"):
+            return "0"
+        return rep_tag[3:].split('_')[0]
+
+    def _biological_replicate_number(self, token, dataset, a_file):
+        rep_tech = a_file.get("rep_tech", self.rep_for_file(a_file))
+        if not rep_tech.startswith("rep"):
+            return "0"
+        return rep_tech[3:].split('_')[0]
+
+    def _technical_replicate_number(self, token, dataset, a_file):
+        rep_tech = a_file.get("rep_tech", self.rep_for_file(a_file))
+        if not rep_tech.startswith("rep"):
+            return "0"
+        return rep_tech.split('_')[1]
+
+    def _rep_tech(self, token, dataset, a_file):
+        return a_file.get("rep_tech", self.rep_for_file(a_file))
+
+    def _embedded_file_token(self, token, dataset, a_file):
+        val = self.lookup_embedded_token(token, a_file)
+        if val is not None and isinstance(val, str):
+            return val
+        return ""
 
     def convert_mask(self, mask, dataset=None, a_file=None):
         '''Given a mask with one or more known {term_name}s, replaces with values.'''
-        working_on = mask
+        return self.evaluate_mask(compile_mask(mask), dataset, a_file)
+
+    def evaluate_mask(self, compiled_mask, dataset=None, a_file=None):
+        '''Given a mask from compile_mask(), replaces its {term_name}s with values.'''
         # dataset might not be self.dataset
         if dataset is None:
             dataset = self.dataset
-        chars = len(working_on)
-        while chars > 0:
-            beg_ix = working_on.find('{')
-            if beg_ix == -1:
-                break
-            end_ix = working_on.find('}')
-            if end_ix == -1:
-                break
-            term = self.lookup_token(working_on[beg_ix:end_ix+1], dataset, a_file=a_file)
-            new_mask = []
-            if beg_ix > 0:
-                new_mask = working_on[0:beg_ix]
-            new_mask += "%s%s" % (term, working_on[end_ix+1:])
-            chars = len(working_on[end_ix+1:])
-            working_on = ''.join(new_mask)
-
-        return working_on
+        return ''.join([
+            part if isinstance(part, str) else str(part[0](self, part[1], dataset, a_file))
+            for part in compiled_mask
+        ])
 
     def ucsc_single_composite_trackDb(self, vis_format, title):
         '''Given a single vis_format (vis_dataset or vis_by_type dict, returns single UCSC trackDb composite text'''
@@ -1041,6 +1063,90 @@ class VisDefines(object):
         return blob
 
 
+# Dataset tokens resolve the same with or without a file
+DATASET_TOKEN_RESOLVERS = dict.fromkeys(SIMPLE_DATASET_TOKENS, VisDefines._simple_dataset_token)
+DATASET_TOKEN_RESOLVERS.update(dict.fromkeys(
+    ["{target}", "{target.label}", "{target.name}", "{target.title}", "{target.investigated_as}"],
+    VisDefines._target_token
+))
+DATASET_TOKEN_RESOLVERS.update(dict.fromkeys(
+    ["{replicates.library.biosample.summary}", "{replicates.library.biosample.summary|multiple}"],
+    VisDefines._biosample_summary
+))
+DATASET_TOKEN_RESOLVERS.update({
+    "{experiment.accession}": VisDefines._experiment_accession,
+    "{biosample_term_name}": VisDefines._biosample_term_name,
+    "{biosample_term_name|multiple}": VisDefines._biosample_term_name_multiple,
+})
+# Other tokens are looked up in the file, or else in the dataset when there is no file
+FILE_TOKEN_RESOLVERS = {
+    "{file.accession}": VisDefines._file_accession,
+    "{output_type_short_label}": VisDefines._output_type_short_label,
+    "{replicate}": VisDefines._replicate,
+    "{replicate_number}": VisDefines._replicate_number,
+    "{biological_replicate_number}": VisDefines._biological_replicate_number,
+    "{technical_replicate_number}": VisDefines._technical_replicate_number,
+    "{rep_tech}": VisDefines._rep_tech,
+}
+COMPILED_MASKS = {}  # mask: compiled mask.  vis_def masks are compiled when the vis_defs are loaded
+COMPILED_MASKS_MAX = 10000
+
+
+def token_resolver(token):
+    '''Returns the resolver of a supported token: resolver(vis_defines, token, dataset, a_file).'''
+    resolver = DATASET_TOKEN_RESOLVERS.get(token)
+    if resolver is not None:
+        return resolver
+    file_resolver = FILE_TOKEN_RESOLVERS.get(token, VisDefines._embedded_file_token)
+
+    def resolve(vis_defines, token, dataset, a_file):
+        if a_file is None:
+            return vis_defines._embedded_dataset_token(token, dataset, a_file)
+        return file_resolver(vis_defines, token, dataset, a_file)
+    return resolve
+
+
+def compile_mask(mask):
+    '''Parses a mask into a list of literal strings and (resolver, token) pairs, once per mask.'''
+    compiled_mask = COMPILED_MASKS.get(mask)
+    if compiled_mask is not None:
+        return compiled_mask
+    compiled_mask = []
+    working_on = mask
+    while working_on:
+        beg_ix = working_on.find('{')
+        end_ix = working_on.find('}', beg_ix)
+        if beg_ix == -1 or end_ix == -1:
+            break
+        if beg_ix > 0:
+            compiled_mask.append(working_on[0:beg_ix])
+        token = working_on[beg_ix:end_ix+1]
+        if token in SUPPORTED_MASK_TOKENS:
+            compiled_mask.append((token_resolver(token), token))
+        else:
+            log.warn("Attempting to look up unexpected token: '%s'" % token)
+            compiled_mask.append("unknown token")
+        working_on = working_on[end_ix+1:]
+    if working_on:
+        compiled_mask.append(working_on)
+    if len(COMPILED_MASKS) >= COMPILED_MASKS_MAX:
+        COMPILED_MASKS.clear()
+    COMPILED_MASKS[mask] = compiled_mask
+    return compiled_mask
+
+
+def compile_vis_def_masks(vis_def):
+    '''Compiles every mask found in a vis_def.'''
+    if isinstance(vis_def, dict):
+        for value in vis_def.values():
+            compile_vis_def_masks(value)
+    elif isinstance(vis_def, list):
+        for value in vis_def:
+            compile_vis_def_masks(value)
+    elif isinstance(vis_def, str) and '{' in vis_def:
+        compile_mask(vis_def)
+
+
 class IhecDefines(object):
     # Defines and formatting code for IHEC JSON
 
@@ -1557,30 +1663,154 @@ class IhecDefines(object):
 # TODO: move to separate vis_cache module?
 class VisCache(object):
     # Stores and recalls vis_dataset formatted json to/from es vis_cache
+    # With a bulk_size, add() buffers vis_blobs and writes them with es bulk at flush().
+    # Next to the vis_blobs, the vis indexer keeps a fingerprint of each dataset they were built from.
+    # A buffered fingerprint is only written once all of its dataset's vis_blobs are.
 
-    def __init__(self, request):
+    def __init__(self, request, bulk_size=None):
         self.request = request
         self.es = self.request.registry.get(ELASTIC_SEARCH, None)
         self.index = VIS_CACHE_INDEX
+        self.index_exists = False  # Only checked once per VisCache
+        self.bulk_size = bulk_size
+        self.pending = []
+        self.added = []  # (doc_type, id) buffered since the last fingerprint
+        self.pending_fingerprints = []  # (uuid, fingerprint, (doc_type, id) of its vis_blobs)
+        self.failed = set()  # (doc_type, id) that failed to write
+        self.failed_uuids = set()  # datasets whose buffered writes failed
 
     def create_cache(self):
         if not self.es:
             return None
+        if self.index_exists:
+            return
         if not self.es.indices.exists(self.index):
             one_shard = {'index': {'number_of_shards': 1, 'max_result_window': 99999 }}
             mapping = {'default': {"enabled": False}}
             self.es.indices.create(index=self.index, body=one_shard, wait_for_active_shards=1)
             self.es.indices.put_mapping(index=self.index, doc_type='default', body=mapping)
+            mapping = {VIS_CACHE_FINGERPRINT_TYPE: {"enabled": False}}
+            self.es.indices.put_mapping(index=self.index, doc_type=VIS_CACHE_FINGERPRINT_TYPE, body=mapping)
             log.debug("created %s index" % self.index)
+        self.index_exists = True
 
     def add(self, vis_id, vis_dataset):
         '''Adds a vis_dataset (aka vis_blob) json object to elastic-search'''
+        self.write('default', vis_id, vis_dataset)
+
+    def add_fingerprint(self, uuid, fingerprint):
+        '''Records the fingerprint of the dataset that the vis_blobs added since the last fingerprint were built from'''
+        if self.bulk_size and self.es:
+            self.pending_fingerprints.append((str(uuid), fingerprint, self.added))
+            self.added = []
+            return
+        self.write(VIS_CACHE_FINGERPRINT_TYPE, str(uuid), {'fingerprint': fingerprint})
+
+    def forget_added(self):
+        '''Leaves the vis_blobs added since the last fingerprint out of the next dataset, e.g. when building failed'''
+        self.added = []
+
+    def write(self, doc_type, id, body):
         if not self.es:
             return
-        if not self.es.indices.exists(self.index):
-            self.create_cache()  # Only bother creating on add
+        self.create_cache()  # Only bother creating on add
+
+        if self.bulk_size:
+            self.pending.append({
+                '_index': self.index,
+                '_type': doc_type,
+                '_id': id,
+                '_source': body,
+            })
+            self.added.append((doc_type, id))
+            if len(self.pending) >= self.bulk_size:
+                self.flush()
+            return
+        self.es.index(index=self.index, doc_type=doc_type, body=body, id=id)
+
+    def flush(self):
+        '''Writes buffered vis_blobs to elastic-search in bulk_size batches, then the fingerprints of the datasets
+           whose vis_blobs were all written. Returns the uuids of all datasets that had a vis_blob fail so far.'''
+        pending = self.pending
+        self.pending = []
+        fingerprints = self.pending_fingerprints
+        self.pending_fingerprints = []
+        try:
+            self.failed.update(self.bulk_write(pending, 'vis_blobs'))
+        except:
+            self.failed.update((action['_type'], action['_id']) for action in pending)
+            self.failed_uuids.update(uuid for (uuid, fingerprint, ids) in fingerprints)
+            raise
+
+        # A dataset with a missing vis_blob keeps its old fingerprint, if any, so it is rebuilt next time
+        written = []
+        for (uuid, fingerprint, ids) in fingerprints:
+            if self.failed.isdisjoint(ids):
+                written.append({
+                    '_index': self.index,
+                    '_type': VIS_CACHE_FINGERPRINT_TYPE,
+                    '_id': uuid,
+                    '_source': {'fingerprint': fingerprint},
+                })
+            else:
+                self.failed_uuids.add(uuid)
+        try:
+            self.bulk_write(written, 'fingerprints')
+        except Exception:
+            # Their vis_blobs are written, the datasets are only rebuilt next time
+            log.warn('vis_cache fingerprint bulk write failed', exc_info=True)
+        return self.failed_uuids
+
+    def bulk_write(self, actions, what):
+        '''Writes actions with es bulk. Returns the (doc_type, id) of those that failed.'''
+        if not actions:
+            return set()
+        (written, errors) = bulk(
+            self.es, actions, chunk_size=self.bulk_size or len(actions), raise_on_error=False
+        )
+        if errors:
+            log.warn("vis_cache bulk write failed for %d of %d %s: %s" %
+                     (len(errors), len(actions), what, errors[:5]))
+        log.debug("wrote %d %s" % (written, what))
+        failed = set()
+        for error in errors:
+            for (op_type, item) in error.items():
+                failed.add((item.get('_type'), item.get('_id')))
+        return failed
+
+    def fingerprints(self, uuids):
+        '''Returns {uuid: fingerprint} of those datasets that have one.'''
+        if not self.es or not uuids:
+            return {}
+        try:
+            res = self.es.mget(
+                index=self.index, doc_type=VIS_CACHE_FINGERPRINT_TYPE, body={'ids': [str(uuid) for uuid in uuids]}
+            )
+        except:
+            return {}  # Missing index has no fingerprints
+        return {
+            doc['_id']: doc['_source'].get('fingerprint')
+            for doc in res.get('docs', [])
+            if doc.get('found')
+        }
 
-        self.es.index(index=self.index, doc_type='default', body=vis_dataset, id=vis_id)
+    def generation(self):
+        '''Returns the vis_cache generation, which changes whenever the vis indexer writes vis_blobs.'''
+        if self.es:
+            try:
+                result = self.es.get(index=self.index, doc_type='default', id=VIS_CACHE_GENERATION_ID)
+                return result['_source']['generation']
+            except:
+                pass  # Missing index or never written
+        return None
+
+    def new_generation(self):
+        '''Marks the vis_cache as changed, so text rendered from the vis_blobs is stale.'''
+        if not self.es:
+            return
+        self.create_cache()
+        self.es.index(index=self.index, doc_type='default', id=VIS_CACHE_GENERATION_ID,
+                      body={'generation': repr(time.time())})
 
     def get(self, vis_id=None, accession=None, assembly=None):
         '''Returns the vis_dataset json object from elastic-search, or None if not found.'''
@@ -1595,17 +1825,18 @@ class VisCache(object):
         return None
 
     def search(self, accessions, assembly):
-        '''Returns a list of composites from elastic-search, or None if not found.'''
+        '''Returns {vis_id: vis_dataset} of the composites found in elastic-search.'''
         if self.es:
             ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)  # Normalized accession
             vis_ids = [accession + "_" + ucsc_assembly for accession in accessions]
+            if not vis_ids:
+                return {}
             try:
-                query = {"query": {"ids": {"values": vis_ids}}}
-                res = self.es.search(body=query, index=self.index, doc_type='default', size=99999)  # size=200?
-                hits = res.get("hits", {}).get("hits", [])
+                res = self.es.mget(index=self.index, doc_type='default', body={'ids': vis_ids})
                 results = {}
-                for hit in hits:
-                    results[hit["_id"]] = hit["_source"]  # make this a generator? No... len(results)
+                for doc in res.get("docs", []):
+                    if doc.get("found"):
+                        results[doc["_id"]] = doc["_source"]
                 log.debug("ids found: %d" % (len(results)))
                 return results
             except:
@@ -4,10 +4,15 @@ from elasticsearch.exceptions import (
     NotFoundError,
     TransportError,
 )
+from multiprocessing import get_context
+from multiprocessing.pool import Pool
+from pyramid.request import apply_request_extensions
+from pyramid.threadlocal import manager
 from pyramid.view import view_config
 from sqlalchemy.exc import StatementError
 
 from urllib3.exceptions import ReadTimeoutError
+from snovault.elasticsearch import APP_FACTORY
 from snovault.elasticsearch.interfaces import (
     ELASTIC_SEARCH,
     INDEXER,
@@ -34,13 +39,22 @@ from snovault.elasticsearch.indexer_state import (
 
 from .vis_defines import (
     VISIBLE_DATASET_TYPES_LC,
-    VIS_CACHE_INDEX
+    VIS_CACHE_BULK_SIZE,
+    VIS_CACHE_INDEX,
+    VisCache
+)
+from .visualization import (
+    vis_cache_add,
+    vis_fingerprint,
 )
-from .visualization import vis_cache_add
 
 
 log = logging.getLogger(__name__)
 
+VIS_INDEXER_PROCESSES = 1  # vis indexer worker processes. Set with visindexer_processes
+VIS_CACHED = 'cached'    # vis_blobs were built and added
+VIS_SKIPPED = 'skipped'  # dataset fingerprint unchanged, so vis_blobs were left as they were
+
 
 def includeme(config):
     config.add_route('index_vis', '/index_vis')
@@ -56,8 +70,10 @@ class VisIndexerState(IndexerState):
     def __init__(self, es, index):
         super(VisIndexerState, self).__init__(es, index, title='vis')
         self.viscached_set      = self.title + '_viscached'
+        self.skipped_set        = self.title + '_skipped'  # unchanged since their vis_blobs were built
         self.success_set        = self.viscached_set
         self.cleanup_last_cycle.append(self.viscached_set)  # Clean up at beginning of next cycle
+        self.cleanup_last_cycle.append(self.skipped_set)
         # DO NOT INHERIT! These keys are for passing on to other indexers
         self.followup_prep_list = None                        # No followup to a following indexer
         self.staged_cycles_list = self.title + '_staged'      # Will take from  primary self.staged_for_vis_list
@@ -69,6 +85,12 @@ class VisIndexerState(IndexerState):
     def viscached_uuid(self, uuid):
         self.list_extend(self.viscached_set, [uuid])
 
+    def viscached_uuids(self, uuids):
+        self.list_extend(self.viscached_set, uuids)
+
+    def skipped_uuids(self, uuids):
+        self.list_extend(self.skipped_set, uuids)
+
     def get_one_cycle(self, xmin, request):
         uuids = []
         next_xmin = None
@@ -123,6 +145,7 @@ class VisIndexerState(IndexerState):
         display = super(VisIndexerState, self).display(uuids=uuids)
         display['staged_to_process'] = self.get_count(self.staged_cycles_list)
         display['datasets_vis_cached_current_cycle'] = self.get_count(self.success_set)
+        display['datasets_vis_skipped_current_cycle'] = self.get_count(self.skipped_set)
         return display
 
 
@@ -207,8 +230,10 @@ def index_vis(request):
     (xmin, next_xmin, uuids) = state.get_one_cycle(xmin, request)
     state.log_reindex_init_state()
     uuid_count = len(uuids)
+    force = False
     if uuid_count > 0 and (xmin is None or int(xmin) <= 0):  # Happens when the a reindex all signal occurs.
         xmin = get_current_xmin(request)
+        force = True  # Reindex all rebuilds every vis_blob, unchanged or not
 
     ### NOTE: These lines may not be appropriate when work other than vis_caching is being done.
     if uuid_count > 500:  # some arbitrary cutoff.
@@ -227,7 +252,7 @@ def index_vis(request):
         result = state.start_cycle(uuids, result)
 
         # Make no effort to incrementally index... all in
-        errors = indexer.update_objects(request, uuids, xmin)     # , snapshot_id)
+        errors = indexer.update_objects(request, uuids, xmin, force=force)     # , snapshot_id)
 
         indexing_errors.extend(errors)  # ignore errors?
         result['errors'] = indexing_errors
@@ -245,33 +270,168 @@ def all_visualizable_uuids(registry):
     return list(all_uuids(registry, types=VISIBLE_DATASET_TYPES_LC))
 
 
+# Running in vis indexer worker processes (visindexer_processes > 1)
+
+app = None
+
+
+def initializer(app_factory, settings):
+    '''Builds the app of a vis indexer worker process.'''
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global app
+    app = app_factory(settings, indexer_worker=True, create_tables=False)
+
+
+def worker_request():
+    registry = app.registry
+    request = app.request_factory.blank('/_vis_indexing_pool')
+    request.registry = registry
+    request.datastore = 'elasticsearch'  # vis_indexer works off of already indexed elasticsearch objects!
+    apply_request_extensions(request)
+    request.invoke_subrequest = app.invoke_subrequest
+    request.root = app.root_factory(request)
+    request._stats = {}
+    return request
+
+
+def vis_cache_uuids_in_worker(args):
+    '''Pool task: vis caches one shard of uuids. Returns (vis cached uuids, skipped uuids, errors, count).'''
+    (uuids, force) = args
+    request = worker_request()
+    manager.push({'request': request, 'registry': request.registry})
+    try:
+        indexer = request.registry['vis'+INDEXER]
+        return indexer.vis_cache_uuids(request, uuids, force=force)
+    finally:
+        manager.pop()
+
+
 class VisIndexer(Indexer):
+    maxtasksperchild = 100
+
     def __init__(self, registry):
         super(VisIndexer, self).__init__(registry)
         self.es = registry[ELASTIC_SEARCH]
         self.esstorage = registry[STORAGE]
         self.index = registry.settings['snovault.elasticsearch.index']
-        self.state = VisIndexerState(self.es, self.index)  # WARNING, race condition is avoided because there is only one worker
+        # Only this process writes state. Pool workers hand back the uuids they vis cached.
+        self.state = VisIndexerState(self.es, self.index)
+        self.bulk_size = int(registry.settings.get('visindexer_bulk_size', VIS_CACHE_BULK_SIZE))
+        self.processes = int(registry.settings.get('visindexer_processes', VIS_INDEXER_PROCESSES))
+        self.pool = None
+        if self.processes > 1 and not registry.settings.get('indexer_worker'):
+            self.initargs = (registry[APP_FACTORY], registry.settings,)
+
+    def init_pool(self):
+        return Pool(
+            processes=self.processes,
+            initializer=initializer,
+            initargs=self.initargs,
+            maxtasksperchild=self.maxtasksperchild,
+            context=get_context('forkserver'),
+        )
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
         return None
 
-    def update_objects(self, request, uuids, xmin):
+    def update_objects(self, request, uuids, xmin, force=False):
         # pylint: disable=too-many-arguments, unused-argument
-        '''Run indexing process on uuids'''
+        '''Run indexing process on uuids.  Unless forced, datasets with unchanged fingerprints are skipped.'''
+        if self.processes > 1 and len(uuids) > 1:
+            (viscached, skipped, errors) = self.pool_vis_cache_uuids(uuids, force)
+        else:
+            (viscached, skipped, errors, count) = self.vis_cache_uuids(request, uuids, force)
+        if skipped:
+            self.state.skipped_uuids(skipped)
+        if viscached:
+            self.state.viscached_uuids(viscached)
+            try:
+                VisCache(request).new_generation()  # Rendered trackDbs are now stale
+            except Exception:
+                log.error('Error updating vis_cache generation', exc_info=True)
+        return errors
+
+    def shards(self, uuids):
+        '''Splits uuids into shards for the pool: at least one per process, at most bulk_size long.'''
+        shard_size = max(1, min(self.bulk_size, -(-len(uuids) // self.processes)))
+        return [uuids[i:i + shard_size] for i in range(0, len(uuids), shard_size)]
+
+    def pool_vis_cache_uuids(self, uuids, force=False):
+        '''Vis caches uuids in the worker pool. Returns (vis cached uuids, skipped uuids, errors).'''
+        if self.pool is None:
+            self.pool = self.init_pool()
+        viscached = []
+        skipped = []
+        errors = []
+        done = 0
+        tasks = [(shard, force) for shard in self.shards(uuids)]
+        try:
+            for (shard_viscached, shard_skipped, shard_errors, shard_count) in self.pool.imap_unordered(
+                    vis_cache_uuids_in_worker, tasks):
+                viscached.extend(shard_viscached)
+                skipped.extend(shard_skipped)
+                errors.extend(shard_errors)
+                if (done + shard_count) // 1000 > done // 1000:
+                    log.info('Indexing %d', done + shard_count)
+                done += shard_count
+        except:
+            self.pool.terminate()
+            self.pool = None
+            raise
+        return (viscached, skipped, errors)
+
+    def vis_cache_uuids(self, request, uuids, force=False):
+        '''Vis caches uuids, writing vis_blobs in bulk.
+           Returns (vis cached uuids, skipped uuids, errors, count).'''
+        viscached = []
+        skipped = []
         errors = []
+        vis_cache = VisCache(request, bulk_size=self.bulk_size)  # vis_blobs are written in bulk
+        fingerprints = {}
         for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, xmin)
+            if not force and i % self.bulk_size == 0:
+                fingerprints = vis_cache.fingerprints(uuids[i:i + self.bulk_size])
+            (outcome, error) = self.vis_cache_uuid(
+                request, uuid, vis_cache, fingerprint=fingerprints.get(str(uuid))
+            )
+            if outcome == VIS_CACHED:
+                viscached.append(uuid)
+            elif outcome == VIS_SKIPPED:
+                skipped.append(uuid)
             if error is not None:
                 errors.append(error)
-            if (i + 1) % 1000 == 0:
+            if self.pool is None and (i + 1) % 1000 == 0:
                 log.info('Indexing %d', i + 1)
-        return errors
-
-    def update_object(self, request, uuid, xmin, restart=False):
-
+        try:
+            failed = vis_cache.flush()
+        except Exception:
+            log.error('Error writing vis_blobs', exc_info=True)  # They are only vis_blobs.
+            failed = vis_cache.failed_uuids
+        if failed:
+            # Not written, so retried next cycle rather than recorded as vis cached
+            timestamp = datetime.datetime.now().isoformat()
+            viscached = [uuid for uuid in viscached if str(uuid) not in failed]
+            errors.extend(
+                {'error_message': 'vis_blobs failed to write', 'timestamp': timestamp, 'uuid': uuid}
+                for uuid in sorted(failed)
+            )
+        return (viscached, skipped, errors, len(uuids))
+
+    def update_object(self, request, uuid, xmin, restart=False, vis_cache=None):
+        (outcome, error) = self.vis_cache_uuid(request, uuid, vis_cache)
+        if outcome == VIS_CACHED:
+            self.state.viscached_uuid(uuid)
+        return error
+
+    def vis_cache_uuid(self, request, uuid, vis_cache=None, fingerprint=None):
+        '''Builds and adds the vis_blobs of one uuid, unless its dataset still has the given fingerprint.
+           Returns (VIS_CACHED, VIS_SKIPPED or None; error or None).'''
         last_exc = None
+        outcome = None
+        if vis_cache is None:
+            vis_cache = VisCache(request)
         # First get the object currently in es
         try:
             result = self.esstorage.get_by_uuid(uuid)  # No reason to restrict by version and that could interfere with reindex all signal.
@@ -288,19 +448,25 @@ class VisIndexer(Indexer):
 
         if last_exc is None:
             try:
+                new_fingerprint = vis_fingerprint(request, doc['embedded'])
+                if new_fingerprint == fingerprint:
+                    return (VIS_SKIPPED, None)  # Nothing its vis_blobs are built from has changed
                 result = vis_cache_add(
                     request,
                     doc['embedded'],
                     is_vis_indexer=True,
+                    vis_cache=vis_cache,
                 )
+                vis_cache.add_fingerprint(uuid, new_fingerprint)
                 if len(result):
-                    # Warning: potentiallly slow uuid-level accounting, but single process so no concurency issue
-                    self.state.viscached_uuid(uuid)
+                    outcome = VIS_CACHED
             except Exception as e:
                 log.error('Error indexing %s', uuid, exc_info=True)
+                vis_cache.forget_added()
                 #last_exc = repr(e)
                 pass  # It's only a vis_blob.
 
         if last_exc is not None:
             timestamp = datetime.datetime.now().isoformat()
-            return {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(uuid)}
+            return (outcome, {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(uuid)})
+        return (outcome, None)
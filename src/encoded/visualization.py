@@ -4,8 +4,10 @@ from pyramid.compat import bytes_
 from snovault import Item
 from collections import OrderedDict
 from copy import deepcopy
+import hashlib
 import json
 import os
+import threading
 from urllib.parse import (
     parse_qs,
     urlencode,
@@ -20,6 +22,7 @@ from .vis_defines import (
     VisDefines,
     IhecDefines,
     VisCache,
+    compile_mask,
     object_is_visualizable
 )
 import time
@@ -31,10 +34,22 @@ log = logging.getLogger(__name__)
 #log.setLevel(logging.DEBUG)
 log.setLevel(logging.INFO)
 
+TRACKDB_CACHE = 'trackdb_cache'
+TRACKDB_CACHE_SIZE = 64 * 1024 * 1024  # bytes of rendered hub text. Set with trackdb_cache_size, 0 disables
+TRACKDB_CACHE_TTL = 600  # seconds. Set with trackdb_cache_ttl
+
+
 def includeme(config):
     config.add_route('batch_hub', '/batch_hub/{search_params}/{txt}')
     config.add_route('batch_hub:trackdb', '/batch_hub/{search_params}/{assembly}/{txt}')
     config.scan(__name__)
+    settings = config.registry.settings
+    max_bytes = int(settings.get('trackdb_cache_size', TRACKDB_CACHE_SIZE))
+    if max_bytes > 0:
+        config.registry[TRACKDB_CACHE] = RenderedTextCache(
+            max_bytes=max_bytes,
+            ttl=float(settings.get('trackdb_cache_ttl', TRACKDB_CACHE_TTL))
+        )
 
 PROFILE_START_TIME = 0  # For profiling within this module
 
@@ -348,12 +363,12 @@ class VisCollections(object):
 class VisDataset(object):
     # Finds, builds, stores, remodels vis_blobs
 
-    def __init__(self, request, vis_dataset=None):
+    def __init__(self, request, vis_dataset=None, vis_cache=None):
         self.found = False
         self.built = False
         self.request = request
         self.page_requested = self.request.url.split('/')[-1]
-        self.vis_cache = VisCache(self.request)
+        self.vis_cache = vis_cache if vis_cache is not None else VisCache(self.request)
         self.vis_defines = None
         self.ihec = None
         self.host = self.request.host_url
@@ -724,6 +739,16 @@ class VisDataset(object):
         tracks = []
         if self.host is None:
             self.host = "https://www.encodeproject.org"
+        longLabel = self.vis_def.get('file_defs', {}).get('longLabel')
+        if longLabel is None:
+            longLabel = ("{assay_title} of {biosample_term_name} {output_type} "
+                        "{biological_replicate_number}")
+        longLabel += " {experiment.accession} - {file.accession}"  # Always add the accessions
+        longLabel = compile_mask(longLabel)
+        # Expecting short label to change when making assay based vis formats
+        shortLabel = compile_mask(self.vis_def.get('file_defs', {}).get('shortLabel',
+                                                            "{replicate} {output_type_short_label}"))
+        lab = self.vis_defines.convert_mask("{lab.title}")
         for view_tag in self.vis_dataset["view"].get("group_order", []):
             view = self.vis_dataset["view"]["groups"][view_tag]
             output_types = view.get("output_type", [])
@@ -759,12 +784,7 @@ class VisDataset(object):
                 track["bigDataUrl"] = a_file.get("cloud_metadata", {}).get(
                     "url", "%s?proxy=true" % a_file["href"]
                 )
-                longLabel = self.vis_def.get('file_defs', {}).get('longLabel')
-                if longLabel is None:
-                    longLabel = ("{assay_title} of {biosample_term_name} {output_type} "
-                                "{biological_replicate_number}")
-                longLabel += " {experiment.accession} - {file.accession}"  # Always add the accessions
-                track["longLabel"] = sanitize.label(self.vis_defines.convert_mask(longLabel, files_dataset, a_file))
+                track["longLabel"] = sanitize.label(self.vis_defines.evaluate_mask(longLabel, files_dataset, a_file))
                 # Specialized addendum comments because subtle details alway get in the way of elegance.
                 addendum = ""
                 submitted_name = a_file.get('submitted_file_name', "none")
@@ -779,17 +799,13 @@ class VisDataset(object):
                 metadata_pairs['file&#32;download'] = ( \
                     '"<a href=\'%s%s\' title=\'Download this file from the ENCODE portal\'>%s</a>"' %
                     (self.host, a_file["href"], a_file["accession"]))
-                lab = self.vis_defines.convert_mask("{lab.title}")
                 if len(lab) > 0 and not lab.startswith('unknown'):
                     metadata_pairs['laboratory'] = '"' + sanitize.label(lab) + '"'  # 'lab' is UCSC word
                 (rep_key, rep_val) = self.replicates_pair(a_file)
                 if rep_key != "":
                     metadata_pairs[rep_key] = '"' + rep_val + '"'
 
-                # Expecting short label to change when making assay based vis formats
-                shortLabel = self.vis_def.get('file_defs', {}).get('shortLabel',
-                                                            "{replicate} {output_type_short_label}")
-                track["shortLabel"] = sanitize.label(self.vis_defines.convert_mask(shortLabel, files_dataset, a_file))
+                track["shortLabel"] = sanitize.label(self.vis_defines.evaluate_mask(shortLabel, files_dataset, a_file))
 
                 # How about subgroups!
                 membership = {}
@@ -1136,8 +1152,41 @@ class VisDataset(object):
         return self.ucsc_trackDb()
 
 
-def vis_cache_add(request, dataset, is_vis_indexer=False):
-    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant assembly.'''
+# Parts of an embedded dataset and its files that vis_blobs are built from (see vis_fingerprint)
+VIS_FINGERPRINT_DATASET_FIELDS = [
+    '@id', '@type', 'accession', 'annotation_type', 'assay_term_id', 'assay_term_name', 'assay_title',
+    'assembly', 'award', 'biosample_ontology', 'biosample_summary', 'control_type', 'lab',
+    'related_datasets', 'replicates', 'status', 'target',
+]
+VIS_FINGERPRINT_FILE_FIELDS = [
+    '@id', 'accession', 'analysis_step_version', 'assembly', 'biological_replicates', 'cloud_metadata',
+    'dataset', 'derived_from', 'file_format', 'file_format_type', 'href', 'lab', 'md5sum', 'output_type',
+    'replicate', 'status', 'submitted_file_name', 'tech_replicates', 'technical_replicates',
+]
+
+
+def vis_fingerprint(request, dataset):
+    '''Returns a stable hash of what the vis_blobs of an embedded dataset are built from.
+       Edits elsewhere in the dataset (audits, documents, ...) leave it unchanged.'''
+    def pick(obj, fields):
+        return {field: obj[field] for field in fields if field in obj}
+
+    files = []
+    for a_file in dataset.get('files', []):
+        a_file = pick(a_file, VIS_FINGERPRINT_FILE_FIELDS)
+        if isinstance(a_file.get('dataset'), dict):
+            a_file['dataset'] = pick(a_file['dataset'], VIS_FINGERPRINT_DATASET_FIELDS)
+        files.append(a_file)
+    parts = pick(dataset, VIS_FINGERPRINT_DATASET_FIELDS)
+    parts['files'] = files
+    parts['vis_defs'] = VisDefines(request).vis_defs_fingerprint()
+    parts['version'] = request.registry.settings.get('snovault.app_version')
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def vis_cache_add(request, dataset, is_vis_indexer=False, vis_cache=None):
+    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant assembly.
+       A shared, buffering vis_cache leaves the writes to its caller's flush().'''
     if (
             not is_vis_indexer and
             not object_is_visualizable(dataset, exclude_quickview=True)
@@ -1151,7 +1200,7 @@ def vis_cache_add(request, dataset, is_vis_indexer=False):
     assemblies = dataset['assembly']
 
     vis_datasets = []
-    vis_factory = VisDataset(request)
+    vis_factory = VisDataset(request, vis_cache=vis_cache)
     for assembly in assemblies:
         vis_dataset = vis_factory.find_or_build(accession, assembly, dataset, must_build=True)
         if vis_dataset:  # Don't bother caching empties (e.g. {} == no visualizable files).
@@ -1472,38 +1521,126 @@ def generate_batch_hubs(context, request):
                        'ENCODE data use policy</p>')
         return generate_html(context, request) + data_policy
 
-def respond_with_text(request, text, content_mime):
+class RenderedTextCache(object):
+    # Bounded LRU of rendered hub text: key -> (utf-8 bytes, etag, rendered time), dropped after ttl seconds.
+    # UCSC fetches the same trackDb.txt over and over in byte ranges, so each is only rendered once.
+
+    def __init__(self, max_bytes=TRACKDB_CACHE_SIZE, ttl=TRACKDB_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl:
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body):
+        '''Caches body, unless it alone is over the size bound. Returns its (body, etag, rendered time).'''
+        entry = (body, hashlib.md5(body).hexdigest(), time.time())
+        if len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+        return entry
+
+    def _drop(self, key):
+        (body, etag, rendered) = self.entries.pop(key)
+        self.size -= len(body)
+
+
+def rendered_text_key(request):
+    '''Returns the trackDb cache key of a hub request: its search, assembly, user and vis_cache generation.'''
+    path = request.path_info
+    search_params = (request.matchdict or {}).get('search_params')
+    if search_params:
+        # Order of the search params makes no difference to the trackDb
+        params = sorted(parse_qs(search_params.replace(',,', '&')).items())
+        path = path.replace(search_params, urlencode(params, True), 1)
+    return (
+        request.host_url,
+        path,
+        request.query_string,
+        tuple(sorted(request.effective_principals)),
+        VisCache(request).generation(),
+    )
+
+
+def respond_with_text(request, text, content_mime, etag=None, last_modified=None):
     '''Resonse that can handle range requests.'''
     # UCSC broke trackhubs and now we must handle byterange requests on these CGI files
+    body = text if isinstance(text, bytes) else bytes_(text, 'utf-8')
     response = request.response
     response.content_type = content_mime
     response.charset = 'UTF-8'
-    response.body = bytes_(text, 'utf-8')
     response.accept_ranges = "bytes"
-    response.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+    response.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(last_modified))
+    if etag is not None:
+        response.etag = etag
+        if etag in request.if_none_match:
+            response.status_code = 304
+            return response
     if 'Range' in request.headers:
-        range_request = True
         range = request.headers['Range']
         if range.startswith('bytes'):
             range = range.split('=')[1]
         range = range.split('-')
         # One final present... byterange '0-' with no end in sight
         if range[1] == '':
-            range[1] = len(response.body) - 1
-        response.content_range = 'bytes %d-%d/%d' % (int(range[0]),int(range[1]),len(response.body))
-        response.app_iter = request.response.app_iter_range(int(range[0]),int(range[1]) + 1)
+            range[1] = len(body) - 1
+        (start, end) = (int(range[0]), int(range[1]))
+        response.body = body[start:end + 1]
+        response.content_range = 'bytes %d-%d/%d' % (start, end, len(body))
         response.status_code = 206
+    else:
+        response.body = body
     return response
 
+
+def respond_with_cached_text(request, content_mime, generate):
+    '''respond_with_text() of the text from generate(), rendered only once while it is in the trackDb cache.'''
+    cache = request.registry.get(TRACKDB_CACHE)
+    if cache is None:
+        return respond_with_text(request, generate(), content_mime)
+    key = rendered_text_key(request)
+    (page, suffix, cmd) = urlpage(request.url)
+    entry = cache.get(key) if cmd != 'regen' else None
+    if entry is None:
+        entry = cache.set(key, bytes_(generate(), 'utf-8'))
+    (body, etag, rendered) = entry
+    return respond_with_text(request, body, content_mime, etag=etag, last_modified=rendered)
+
 @view_config(name='hub', context=Item, request_method='GET', permission='view')
 def hub(context, request):
     ''' Creates trackhub on fly for a given experiment '''
     global PROFILE_START_TIME
     PROFILE_START_TIME = time.time()
 
-    embedded = request.embed(request.resource_path(context))
-
     (page,suffix,cmd) = urlpage(request.url)
+    if (suffix == 'txt' and page == 'trackDb') or \
+         (suffix == 'json' and page in ['trackDb','ihec','vis_blob']):
+        url_ret = (request.url).split('@@hub')
+        url_end = url_ret[1][1:]
+        return respond_with_cached_text(
+            request,
+            'text/plain',
+            lambda: generate_trackDb(request, request.embed(request.resource_path(context)), url_end.split('/')[0])
+        )
+
+    embedded = request.embed(request.resource_path(context))
     content_mime = 'text/plain'
     if page == 'hub' and suffix == 'txt':
         typeof = embedded.get("assay_title")
@@ -1520,11 +1657,6 @@ def hub(context, request):
 
         text = get_genomes_txt(assemblies)
 
-    elif (suffix == 'txt' and page == 'trackDb') or \
-         (suffix == 'json' and page in ['trackDb','ihec','vis_blob']):
-        url_ret = (request.url).split('@@hub')
-        url_end = url_ret[1][1:]
-        text = generate_trackDb(request, embedded, url_end.split('/')[0])
     else:
         data_policy = ('<br /><a href="http://encodeproject.org/ENCODE/terms.html">'
                        'ENCODE data use policy</p>')
@@ -1539,5 +1671,4 @@ def hub(context, request):
 def batch_hub(context, request):
     ''' View for batch track hubs '''
 
-    text = generate_batch_hubs(context, request)
-    return respond_with_text(request, text, 'text/plain')
+    return respond_with_cached_text(request, 'text/plain', lambda: generate_batch_hubs(context, request))